@@ -0,0 +1,6 @@
+import sys
+
+from plugin import batch
+
+if __name__ == '__main__':
+    sys.exit(batch.main())
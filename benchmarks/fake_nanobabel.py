@@ -0,0 +1,100 @@
+"""Scripted stand-in for nanobabel's minimize command, for benchmarks.
+
+Reads the atoms of the V3000 SDF given with -i, then prints the energy log
+and a PDB frame every -l steps for -n steps, moving every movable atom a
+little each time, and writes the last frame to the -o file. The pace is
+controlled with environment variables:
+
+FAKE_NANOBABEL_FRAME_RATE   frames printed per second, 0 for as fast as possible
+FAKE_NANOBABEL_STARTUP      seconds to wait before the first frame
+"""
+import os
+import sys
+import time
+
+START_MARKER = "Step update start"
+END_MARKER = "Step update end"
+# angstroms every movable atom moves per step
+STEP_SHIFT = 0.001
+
+
+def option(args, name, default=None):
+    return args[args.index(name) + 1] if name in args else default
+
+
+def read_sdf(path):
+    """(serial, symbol, x, y, z) of every atom in a V3000 SDF."""
+    atoms = []
+    with open(path) as f:
+        in_atoms = False
+        for line in f:
+            if 'BEGIN ATOM' in line:
+                in_atoms = True
+            elif 'END ATOM' in line:
+                break
+            elif in_atoms:
+                fields = line.split()
+                atoms.append((int(fields[2]), fields[3], float(fields[4]), float(fields[5]), float(fields[6])))
+    return atoms
+
+
+def read_fixed(path):
+    if path is None or not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        return set(int(line.rsplit(':', 1)[1]) for line in f if line.startswith('ATOM:FIXED:'))
+
+
+def energy(step):
+    return 100.0 / (step + 1)
+
+
+def energy_line(step, previous_step):
+    previous = "----" if previous_step is None else "%8.3f" % energy(previous_step)
+    return " %4d    %8.3f    %s\n" % (step, energy(step), previous)
+
+
+def frame_text(atoms, step, fixed=()):
+    lines = [START_MARKER]
+    shift = STEP_SHIFT * step
+    for serial, symbol, x, y, z in atoms:
+        if serial not in fixed:
+            x += shift
+        lines.append("HETATM%5d %-4s UNL     1    %8.3f%8.3f%8.3f  1.00  0.00          %2s" % (serial % 100000, symbol, x, y, z, symbol))
+    lines.append(END_MARKER)
+    return '\n'.join(lines) + '\n'
+
+
+def output(atoms, steps, interval, fixed=()):
+    """Everything nanobabel would print for a run, step by step."""
+    previous_step = None
+    for step in range(0, steps + 1, interval):
+        yield energy_line(step, previous_step) + frame_text(atoms, step, fixed)
+        previous_step = step
+
+
+def main(args):
+    atoms = read_sdf(option(args, '-i'))
+    fixed = read_fixed(option(args, '-cx'))
+    steps = int(option(args, '-n', 2500))
+    interval = int(option(args, '-l', 20))
+    frame_rate = float(os.environ.get('FAKE_NANOBABEL_FRAME_RATE', 0))
+    time.sleep(float(os.environ.get('FAKE_NANOBABEL_STARTUP', 0)))
+
+    last = None
+    for text in output(atoms, steps, interval, fixed):
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        last = text
+        if frame_rate > 0:
+            time.sleep(1.0 / frame_rate)
+
+    output_path = option(args, '-o')
+    if output_path is not None and last is not None:
+        with open(output_path, 'w') as f:
+            f.write(last)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,216 @@
+"""Times each stage of the minimization pipeline on scaled copies of the 1tyl fixture.
+
+Run from the repository root:
+
+    python -m benchmarks.run_benchmarks --sizes 10000,100000 --output results.json
+
+Every copy of 1tyl is its own complex, moved to its own spot of a grid, with
+its TYL ligand selected (or all of its atoms with --selection all). Results
+are printed, and written as JSON with --output, so runs of different plugin
+versions can be compared.
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import tempfile
+import time
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import nanome
+from nanome._internal.network.data import Data
+from nanome.api.streams.messages import FeedStream
+from nanome.api.structure import Complex, Workspace
+from nanome.util import Vector3
+from nanome.util.enums import StreamDataType
+from nanome.util.stream import StreamCreationError
+
+from benchmarks import fake_nanobabel
+from plugin import __version__
+from plugin.frames import FrameDecoder, StepParser
+from plugin.nanobabel import READ_CHUNK_SIZE
+from plugin.process import SHELL_CUTOFF, MinimizationProcess
+from plugin.streaming import FrameQueue
+from plugin.system import prepare_system, split_clusters
+
+benchmarks_dir = os.path.dirname(os.path.abspath(__file__))
+FIXTURE = os.path.join(os.path.dirname(benchmarks_dir), 'tests', 'fixtures', '1tyl.pdb')
+FAKE_NANOBABEL_DIR = os.path.join(benchmarks_dir, 'bin')
+STAGES = ['prepare_system', 'split_clusters', 'write_input', 'save_atoms', 'parse_stdout', 'decode_frame', 'pack_stream', 'end_to_end']
+# room left between copies, in angstroms, so copies never share a shell
+COPY_MARGIN = 2 * SHELL_CUTOFF
+
+
+def build_workspace(atom_count, selection):
+    """Workspace of copies of 1tyl, with at least atom_count atoms."""
+    template = Complex.io.from_pdb(path=FIXTURE)
+    positions = np.array([[atom.position.x, atom.position.y, atom.position.z] for atom in template.atoms])
+    spacing = (positions.max(axis=0) - positions.min(axis=0)).max() + COPY_MARGIN
+    copy_count = max(1, math.ceil(atom_count / len(positions)))
+    side = math.ceil(copy_count ** (1 / 3))
+
+    workspace = Workspace()
+    index = 0
+    for i in range(copy_count):
+        complex = template._deep_copy()
+        complex.position = Vector3(*(spacing * np.array([i % side, i // side % side, i // side // side], dtype=float)))
+        for residue in complex.residues:
+            selected = selection == 'all' or residue.name == 'TYL'
+            for atom in residue.atoms:
+                atom.index = index
+                atom.selected = selected
+                index += 1
+        workspace.add_complex(complex)
+        # add_complex clears the index Nanome would have given the complex
+        complex.index = i
+    return workspace, index
+
+
+def timed(fn, repeat):
+    """Best wall time of repeat calls to fn, and its last result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def stdout_bytes(system, frame_count, interval=20):
+    atoms = [(int(serial), atom.symbol, *position) for serial, atom, position in zip(system.serials, system.atoms, system.positions.tolist())]
+    fixed = set(system.serials[~system.selected].tolist())
+    return ''.join(fake_nanobabel.output(atoms, (frame_count - 1) * interval, interval, fixed)).encode()
+
+
+def parse_stdout(data):
+    frames = FrameQueue(coalesce=False)
+    parser = StepParser(frames.push)
+    view = memoryview(data)
+    for start in range(0, len(data), READ_CHUNK_SIZE):
+        parser.feed(bytes(view[start:start + READ_CHUNK_SIZE]))
+    parser.flush()
+    return [frames.pop() for _ in range(len(frames))]
+
+
+def pack_stream(positions):
+    FeedStream().serialize(2, (0, positions.tolist(), StreamDataType.float), Data())
+
+
+def end_to_end(workspace, steps, frame_rate):
+    """Run the whole pipeline with the fake nanobabel, returning latency and throughput figures."""
+    stream = MagicMock()
+    update_times = []
+
+    async def run():
+        loop = asyncio.get_event_loop()
+
+        def update(data, done_callback):
+            update_times.append(time.perf_counter())
+            loop.call_soon(done_callback)
+        stream.update.side_effect = update
+
+        async def create_writing_stream(indices, stream_type):
+            return (stream, StreamCreationError.NoError)
+
+        plugin = MagicMock()
+        plugin.create_writing_stream = create_writing_stream
+        process = MinimizationProcess(plugin, FAKE_NANOBABEL_DIR)
+        start = time.perf_counter()
+        await process.start_process(workspace, 'Uff', steps, True)
+        await process.wait()
+        return start, time.perf_counter(), process.stream_stats
+
+    environment = {'FAKE_NANOBABEL_FRAME_RATE': str(frame_rate)}
+    with patch.dict(os.environ, environment), patch('nanome._internal.network.PluginNetwork._instance'):
+        loop = asyncio.new_event_loop()
+        start, end, stats = loop.run_until_complete(run())
+        loop.close()
+    return {
+        'seconds': end - start,
+        'first_frame_seconds': update_times[0] - start if update_times else None,
+        'updates_per_second': len(update_times) / (end - start),
+        **stats
+    }
+
+
+def benchmark_size(size, args):
+    results = []
+
+    def record(stage, seconds, **extra):
+        if stage not in args.stages:
+            return
+        results.append({'stage': stage, 'seconds': seconds, **extra})
+        print(f"{size:>9} {stage:<16} {seconds * 1000:10.2f} ms  {extra if extra else ''}", flush=True)
+
+    workspace, atom_count = build_workspace(size, args.selection)
+    seconds, system = timed(lambda: prepare_system(workspace, SHELL_CUTOFF), args.repeat)
+    record('prepare_system', seconds, workspace_atoms=atom_count, system_atoms=len(system))
+    seconds, clusters = timed(lambda: split_clusters(system, SHELL_CUTOFF), args.repeat)
+    record('split_clusters', seconds, cluster_count=len(clusters))
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        def write_input():
+            for i, cluster in enumerate(clusters):
+                cluster.write_sdf(os.path.join(temp_dir, f'{i}.sdf'))
+                cluster.write_constraints(os.path.join(temp_dir, f'{i}.txt'))
+        seconds, _ = timed(write_input, args.repeat)
+        record('write_input', seconds)
+
+    process = MinimizationProcess(MagicMock(), FAKE_NANOBABEL_DIR)
+    seconds, runs = timed(lambda: process._MinimizationProcess__save__atoms(workspace, SHELL_CUTOFF, 'Uff', 100, True), args.repeat)
+    record('save_atoms', seconds, run_count=len(runs))
+
+    data = stdout_bytes(system, args.frames)
+    seconds, frames = timed(lambda: parse_stdout(data), args.repeat)
+    record('parse_stdout', seconds / len(frames), frame_count=len(frames), megabytes_per_second=len(data) / seconds / 1e6)
+
+    decoder = FrameDecoder(system.serials, system.complexes, system.positions)
+    seconds, positions = timed(lambda: [decoder.decode(frame) for frame in frames][-1], args.repeat)
+    record('decode_frame', seconds / len(frames), atom_count=len(system))
+
+    seconds, _ = timed(lambda: pack_stream(positions), args.repeat)
+    record('pack_stream', seconds, float_count=len(positions))
+
+    if 'end_to_end' in args.stages:
+        figures = end_to_end(workspace, (args.frames - 1) * 20, args.frame_rate)
+        record('end_to_end', figures.pop('seconds'), **figures)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='10000,100000,300000', help='comma separated workspace atom counts')
+    parser.add_argument('--selection', choices=['ligands', 'all'], default='ligands')
+    parser.add_argument('--frames', type=int, default=10, help='frames parsed, decoded and streamed per size')
+    parser.add_argument('--frame-rate', type=float, default=0, help='frames per second printed by the fake nanobabel, 0 for unthrottled')
+    parser.add_argument('--repeat', type=int, default=3, help='timings keep the best of this many repeats')
+    parser.add_argument('--stages', default=','.join(STAGES), help='comma separated stages to report')
+    parser.add_argument('--output', help='JSON file to write results to')
+    args = parser.parse_args()
+    args.stages = args.stages.split(',')
+
+    report = {
+        'plugin_version': __version__,
+        'nanome_version': nanome.__version__,
+        'numpy_version': np.__version__,
+        'python_version': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': {'selection': args.selection, 'frames': args.frames, 'frame_rate': args.frame_rate, 'repeat': args.repeat},
+        'results': []
+    }
+    for size in [int(size) for size in args.sizes.split(',')]:
+        for result in benchmark_size(size, args):
+            report['results'].append({'size': size, **result})
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,362 @@
+"""Load and soak test of many Minimization sessions sharing one plugin server process.
+
+Run from the repository root:
+
+    python -m benchmarks.soak --sessions 20 --duration 600 --output soak.json
+
+Every session is a Minimization instance with its own workspace of 1tyl
+copies, talking to a fake network that answers requests and acknowledges
+stream updates after --latency seconds, through real nanome streams. Sessions
+share one RunScheduler and run benchmarks/bin/nanobabel, and loop over
+--cycles until --duration is up:
+
+run           press Run and wait for the minimization to finish
+stop          press Run, then press it again once running to stop it
+integration   start through the minimization integration, as another plugin would
+
+Selected atoms are nudged by up to --jitter angstroms before every cycle, so
+the result cache does not answer every repeat. Every --sample-interval
+seconds, throughput, open file descriptors, scratch files, memory and the
+size of every per-session table known to grow are printed, and the growth
+between the first and last samples is reported at the end, with latency
+percentiles per cycle. With --tracemalloc, the allocations that grew the
+most are reported too.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import random
+import time
+import tracemalloc
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+import nanome
+from nanome._internal.enums import Messages
+from nanome.api.streams import Stream
+from nanome.util import Vector3
+from nanome.util.enums import StreamDataType
+from nanome.util.stream import StreamCreationError
+
+from benchmarks.run_benchmarks import FAKE_NANOBABEL_DIR, build_workspace
+from plugin import __version__
+from plugin.Minimization import Minimization
+from plugin.scheduler import RunScheduler, SchedulerClient
+from plugin.telemetry import peak_memory
+
+CYCLES = ('run', 'stop', 'integration')
+# the Universal force field, as the integration numbers it
+INTEGRATION_FORCE_FIELD = 0
+# allocation sites reported with --tracemalloc
+TOP_ALLOCATIONS = 10
+PERCENTILES = (50, 90, 99)
+
+
+class FakeNetwork():
+    """One session's connection to Nanome, answering instance's requests after latency seconds.
+
+    Workspace requests get workspace, stream creations a writing Stream over
+    this network, and stream updates are acknowledged. Other requests
+    expecting a response get None. Message ids come from ids, shared by every
+    session, as callbacks are stored per process.
+    """
+
+    def __init__(self, instance, workspace, ids, latency):
+        self.workspace = workspace
+        self.sent = 0
+        self.__instance = instance
+        self.__ids = ids
+        self.__latency = latency
+
+    def send_connect(self, code, arg):
+        return self.send(code, arg, False)
+
+    def send(self, code, arg, expects_response):
+        id = next(self.__ids)
+        self.sent += 1
+        if code == Messages.stream_create:
+            stream = Stream(self, next(self.__ids), StreamDataType.float, arg[2])
+            self.__respond(id, stream, StreamCreationError.NoError)
+        elif code == Messages.workspace_request:
+            self.__respond(id, self.workspace)
+        elif code == Messages.stream_feed:
+            self.__respond(id)
+        elif expects_response:
+            self.__respond(id, None)
+        return id
+
+    def __respond(self, id, *args):
+        asyncio.get_event_loop().call_later(self.__latency, self.__instance._call, id, *args)
+
+
+class Session():
+    """A Minimization instance, driven through the buttons and integration Nanome would call."""
+
+    def __init__(self, number, scheduler, ids, args):
+        self.number = number
+        self.args = args
+        self.latencies = {cycle: [] for cycle in CYCLES}
+        self.first_frame_latencies = []
+        self.errors = 0
+        workspace, _ = build_workspace(args.atoms, 'ligands')
+        self.__selected = [atom for complex in workspace.complexes for atom in complex.atoms if atom.selected]
+        self.__done = asyncio.Event()
+
+        with patch('plugin.Minimization.NANOBABEL', FAKE_NANOBABEL_DIR):
+            self.instance = Minimization()
+            network = FakeNetwork(self.instance, workspace, ids, args.latency)
+            # as the plugin server sets up every session's process
+            self.instance._setup(number, network, None, None, None, None, (scheduler,), {})
+            self.instance.start()
+        self.process = self.instance._process
+        # every session would have its own pid, which the scheduler tells sessions apart by
+        self.process._MinimizationProcess__scheduler = SchedulerClient(scheduler, number)
+        minimization_done = self.instance.minimization_done
+
+        def on_done():
+            minimization_done()
+            self.__done.set()
+        self.instance.minimization_done = on_done
+
+    @property
+    def network(self):
+        return self.instance._network
+
+    async def soak(self, deadline):
+        for cycle in itertools.islice(itertools.cycle(self.args.cycles), self.number, None):
+            if time.perf_counter() >= deadline:
+                return
+            self.__jitter()
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.__run_cycle(cycle), self.args.cycle_timeout)
+            except Exception as e:
+                self.errors += 1
+                print(f"session {self.number}: {cycle} failed: {e!r}", flush=True)
+                await self.process.stop_process()
+                continue
+            self.latencies[cycle].append(time.perf_counter() - start)
+            if cycle != 'stop' and len(self.process.metrics) > 0:
+                first_frame = self.process.metrics.runs[-1]['first_frame_seconds']
+                if first_frame is not None:
+                    self.first_frame_latencies.append(first_frame)
+
+    async def __run_cycle(self, cycle):
+        self.__done.clear()
+        if cycle == 'integration':
+            request = MagicMock()
+            request.get_args.return_value = (INTEGRATION_FORCE_FIELD, self.args.steps, True, None)
+            self.instance.start_integration(request)
+        else:
+            self.instance.on_run()
+        if cycle == 'stop':
+            while not self.process.is_running and not self.__done.is_set():
+                await asyncio.sleep(0.01)
+            await asyncio.sleep(random.uniform(0, self.args.stop_after))
+            # pressing Run again after the minimization finished would start another one
+            if self.process.is_running:
+                self.instance.on_run()
+        await self.__done.wait()
+        await self.process.wait()
+
+    def __jitter(self):
+        if self.args.jitter <= 0:
+            return
+        for atom in self.__selected:
+            shift = np.random.uniform(-self.args.jitter, self.args.jitter, 3)
+            atom.position = Vector3(atom.position.x + shift[0], atom.position.y + shift[1], atom.position.z + shift[2])
+
+    async def close(self):
+        await self.process.stop_process()
+        self.process.temp_dir.cleanup()
+
+
+def open_file_count():
+    for path in ('/proc/self/fd', '/dev/fd'):
+        if os.path.isdir(path):
+            return len(os.listdir(path))
+    return None
+
+
+def resident_memory():
+    """Current resident set size of this process, in bytes, None where /proc is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def directory_size(paths):
+    """Number of files under paths, and their size in bytes."""
+    count = 0
+    size = 0
+    for path in paths:
+        for root, _, files in os.walk(path):
+            for name in files:
+                try:
+                    size += os.path.getsize(os.path.join(root, name))
+                    count += 1
+                except OSError:
+                    # removed by a run finishing meanwhile
+                    pass
+    return count, size
+
+
+def sample(sessions, start):
+    """Figures of the whole server at this time, fit for growth comparisons."""
+    file_count, file_bytes = directory_size([session.process.temp_dir.name for session in sessions])
+    self_peak, children_peak = peak_memory()
+    cycles = sum(len(latencies) for session in sessions for latencies in session.latencies.values())
+    return {
+        'seconds': time.perf_counter() - start,
+        'cycles': cycles,
+        'errors': sum(session.errors for session in sessions),
+        'open_files': open_file_count(),
+        'scratch_files': file_count,
+        'scratch_bytes': file_bytes,
+        'resident_bytes': resident_memory(),
+        'peak_memory_bytes': self_peak,
+        'children_peak_memory_bytes': children_peak,
+        'traced_bytes': tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None,
+        'tasks': len(asyncio.all_tasks()),
+        'pending_callbacks': len(nanome.PluginInstance._PluginInstance__callbacks),
+        'pending_futures': len(nanome.PluginInstance._PluginInstance__futures),
+        'open_streams': len(Stream._streams),
+        'messages_sent': sum(session.network.sent for session in sessions),
+        'stored_summaries': sum(len(session.process.metrics) for session in sessions),
+        'depth_samples': sum(len(session.process.telemetry.queue_depths) for session in sessions if session.process.telemetry is not None),
+        'cached_results': sum(len(session.process._MinimizationProcess__cache) for session in sessions),
+        'cached_topologies': sum(len(session.process._MinimizationProcess__topologies) for session in sessions)
+    }
+
+
+def percentiles(values):
+    if len(values) == 0:
+        return None
+    figures = {f'p{p}': float(np.percentile(values, p)) for p in PERCENTILES}
+    return {'count': len(values), 'mean': float(np.mean(values)), **figures, 'max': float(np.max(values))}
+
+
+def print_sample(figures, previous):
+    window = figures['seconds'] - previous['seconds'] if previous is not None else figures['seconds']
+    cycles = figures['cycles'] - previous['cycles'] if previous is not None else figures['cycles']
+    resident = figures['resident_bytes'] if figures['resident_bytes'] is not None else figures['peak_memory_bytes']
+    print(f"{figures['seconds']:8.1f} s {figures['cycles']:7d} cycles {cycles / window if window > 0 else 0:7.2f}/s "
+          f"{figures['errors']:4d} errors {figures['open_files'] or 0:5d} fds "
+          f"{figures['scratch_files']:5d} files {figures['scratch_bytes'] / 1e6:8.2f} MB scratch "
+          f"{(resident or 0) / 1e6:8.1f} MB memory {figures['pending_callbacks']:6d} callbacks "
+          f"{figures['open_streams']:4d} streams {figures['tasks']:5d} tasks", flush=True)
+
+
+async def soak(args):
+    scheduler = RunScheduler(args.max_runs)
+    ids = itertools.count()
+    sessions = [Session(i, scheduler, ids, args) for i in range(args.sessions)]
+    start = time.perf_counter()
+    deadline = start + args.duration
+    samples = []
+    baseline = None
+
+    async def sampler():
+        nonlocal baseline
+        while True:
+            await asyncio.sleep(args.sample_interval)
+            figures = sample(sessions, start)
+            print_sample(figures, samples[-1] if samples else None)
+            samples.append(figures)
+            if baseline is None and tracemalloc.is_tracing():
+                baseline = tracemalloc.take_snapshot()
+
+    sampling = asyncio.ensure_future(sampler())
+    try:
+        await asyncio.gather(*(session.soak(deadline) for session in sessions))
+    finally:
+        sampling.cancel()
+    elapsed = time.perf_counter() - start
+    samples.append(sample(sessions, start))
+
+    allocations = None
+    if baseline is not None:
+        growth = tracemalloc.take_snapshot().compare_to(baseline, 'lineno')[:TOP_ALLOCATIONS]
+        allocations = [{'site': str(stat.traceback), 'size_diff': stat.size_diff, 'count_diff': stat.count_diff} for stat in growth]
+    for session in sessions:
+        await session.close()
+
+    cycles = samples[-1]['cycles']
+    first, last = samples[0], samples[-1]
+    return {
+        'seconds': elapsed,
+        'cycles': cycles,
+        'cycles_per_second': cycles / elapsed,
+        'errors': last['errors'],
+        'latency_seconds': {cycle: percentiles([latency for session in sessions for latency in session.latencies[cycle]]) for cycle in args.cycles},
+        'first_frame_seconds': percentiles([latency for session in sessions for latency in session.first_frame_latencies]),
+        # from the first sample on, so imports and first runs do not count as growth
+        'growth': {key: last[key] - first[key] for key in last if key not in ('seconds', 'cycles') and last[key] is not None and first[key] is not None},
+        'allocation_growth': allocations,
+        'samples': samples
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sessions', type=int, default=10, help='Minimization instances sharing the process')
+    parser.add_argument('--duration', type=float, default=60, help='seconds to keep starting cycles for')
+    parser.add_argument('--cycles', default=','.join(CYCLES), help='comma separated cycles every session goes through in turn')
+    parser.add_argument('--atoms', type=int, default=2000, help='atoms in the workspace of every session')
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--frame-rate', type=float, default=50, help='frames per second printed by the fake nanobabel, 0 for unthrottled')
+    parser.add_argument('--latency', type=float, default=0.01, help='seconds the fake network takes to answer')
+    parser.add_argument('--stop-after', type=float, default=0.5, help='stop cycles stop a random time up to this many seconds after starting')
+    parser.add_argument('--jitter', type=float, default=0.05, help='angstroms selected atoms are nudged by before every cycle, 0 to let the cache answer repeats')
+    parser.add_argument('--max-runs', type=int, default=os.cpu_count() or 1, help='nanobabel processes running at once, over every session')
+    parser.add_argument('--cycle-timeout', type=float, default=120, help='seconds after which a cycle counts as an error')
+    parser.add_argument('--sample-interval', type=float, default=5, help='seconds between samples')
+    parser.add_argument('--tracemalloc', action='store_true', help='report the allocations that grew the most, at a large speed cost')
+    parser.add_argument('--output', help='JSON file to write the report to')
+    args = parser.parse_args()
+    args.cycles = args.cycles.split(',')
+    unknown = set(args.cycles) - set(CYCLES)
+    if unknown:
+        parser.error(f"unknown cycles: {', '.join(sorted(unknown))}")
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    environment = {'FAKE_NANOBABEL_FRAME_RATE': str(args.frame_rate)}
+    with patch.dict(os.environ, environment), patch('nanome._internal.network.PluginNetwork._instance'):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            results = loop.run_until_complete(soak(args))
+        finally:
+            loop.close()
+
+    print(f"{results['cycles']} cycles in {results['seconds']:.1f} s, {results['cycles_per_second']:.2f} cycles/s, {results['errors']} errors")
+    for cycle, figures in results['latency_seconds'].items():
+        if figures is not None:
+            print(f"{cycle:<12} " + ' '.join(f"{key} {value:.3f}" for key, value in figures.items() if key != 'count') + f" over {figures['count']}")
+    print('growth: ' + ', '.join(f"{key} {value:+g}" for key, value in results['growth'].items()))
+    for allocation in results['allocation_growth'] or []:
+        print(f"{allocation['size_diff']:+12d} B {allocation['count_diff']:+8d} blocks  {allocation['site']}")
+
+    if args.output:
+        report = {
+            'plugin_version': __version__,
+            'nanome_version': nanome.__version__,
+            'python_version': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'settings': {key: value for key, value in vars(args).items() if key != 'output'},
+            **results
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0 if results['errors'] == 0 else 1
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
@@ -1,22 +1,38 @@
 import os
 import sys
+import time
 import nanome
 from nanome.util import Logs, async_callback
 from nanome.util.enums import Integrations
 
 from .menu import MinimizationMenu
-from .process import MinimizationProcess
+from .cache import ResultCache
+from .process import MinimizationProcess, NANOBABEL_ENGINE, SHELL_CUTOFF
+from .scheduler import INTEGRATION_PRIORITY, MENU_PRIORITY, start_scheduler
 
 NANOBABEL = os.environ.get('NANOBABEL', os.path.join(os.getcwd(), 'nanobabel'))
 if not os.path.exists(NANOBABEL):
     NANOBABEL = None
+MAX_CONCURRENT_RUNS = int(os.environ.get('MAX_CONCURRENT_RUNS', os.cpu_count() or 1))
+CPU_AFFINITY = os.environ.get('CPU_AFFINITY', '').lower() in ('1', 'true', 'yes')
+CACHE_DIR = os.environ.get('MINIMIZATION_CACHE_DIR')
+# nanobabel or numpy, nanobabel when it is found by default
+ENGINE = os.environ.get('MINIMIZATION_ENGINE')
+# profile the first minimization of every session into this directory
+PROFILE_DIR = os.environ.get('MINIMIZATION_PROFILE_DIR')
+# record the frames of every minimization into this directory, to replay or export them
+RECORD_DIR = os.environ.get('MINIMIZATION_RECORD_DIR')
 
 
 class Minimization(nanome.AsyncPluginInstance):
 
     def start(self):
         self.__menu = MinimizationMenu(self)
-        self._process = MinimizationProcess(self, NANOBABEL)
+        # the server wide scheduler is shared with every session through the plugin's custom data
+        custom_data = getattr(self, 'custom_data', None) or (None,)
+        self._process = MinimizationProcess(self, NANOBABEL, scheduler=custom_data[0], cache=ResultCache(directory=CACHE_DIR), engine=ENGINE, record_directory=RECORD_DIR)
+        if PROFILE_DIR:
+            self._process.capture_profile(PROFILE_DIR)
         self.__menu.build_menu()
         self.__integration_request = None
         self.integration.minimization_start = self.start_integration
@@ -28,11 +44,13 @@ class Minimization(nanome.AsyncPluginInstance):
         if self._process.is_running == True:
             if self.__integration_request != None:
                 self.__integration_request.send_response(False)
-            self._process.stop_process()
+            await self._process.stop_process()
         ff = self.convert_forcefield_value(ff)
+        if not cutoff or cutoff <= 0:
+            cutoff = SHELL_CUTOFF
 
         self.__menu.change_running_status(True)
-        await self.start_minimization(ff, steps, steepest)
+        await self.start_minimization(ff, steps, steepest, cutoff, INTEGRATION_PRIORITY)
 
     def stop_integration(self, request):
         self._process.stop_process()
@@ -41,9 +59,6 @@ class Minimization(nanome.AsyncPluginInstance):
             self.__integration_request.send_response(True)
         self.__menu.change_running_status(False)
 
-    def update(self):
-        self._process.update()
-
     def on_run(self):
         self.__menu.toggle_minimization()
 
@@ -53,16 +68,36 @@ class Minimization(nanome.AsyncPluginInstance):
     def on_stop(self):
         self.stop_minimization()
 
-    async def start_minimization(self, ff, steps, steepest):
+    async def start_minimization(self, ff, steps, steepest, cutoff=SHELL_CUTOFF, priority=MENU_PRIORITY, protocol=False, all_frames=False):
         ff = self.convert_forcefield_value(ff)
+        requested_at = time.perf_counter()
         workspace = await self.request_workspace()
-        await self._process.start_process(workspace, ff, steps, steepest)
+        if all_frames:
+            await self._process.start_frames(workspace, ff, steps, steepest, cutoff, priority, protocol=protocol)
+        else:
+            await self._process.start_process(workspace, ff, steps, steepest, cutoff, priority, requested_at, protocol=protocol)
 
     def stop_minimization(self):
         self._process.stop_process()
 
+    async def replay_minimization(self):
+        if not await self._process.replay():
+            self.send_notification(nanome.util.enums.NotificationTypes.message, "Nothing to replay")
+
+    async def export_minimization(self):
+        exported = await self._process.export_recording()
+        if len(exported) == 0:
+            self.send_notification(nanome.util.enums.NotificationTypes.message, "Nothing to export")
+
+    def minimization_queued(self, position):
+        self.__menu.change_queue_position(position)
+
+    def minimization_progress(self, done, total):
+        self.__menu.change_progress(done, total)
+
     def minimization_done(self):
         self.__menu.change_running_status(False)
+        self.__menu.change_recording_status(self._process.recording is not None)
         if self.__integration_request != None:
             self.__integration_request.send_response(True)
 
@@ -87,11 +122,16 @@ class Minimization(nanome.AsyncPluginInstance):
 
 def main():
     if not NANOBABEL:
-        Logs.error('Error: nanobabel not found, please set NANOBABEL env var')
-        sys.exit(1)
+        if ENGINE == NANOBABEL_ENGINE:
+            Logs.error('Error: nanobabel not found, please set NANOBABEL env var')
+            sys.exit(1)
+        Logs.warning('nanobabel not found, minimizing with the in-process numpy engine')
 
     plugin = nanome.Plugin("Minimization", "Run minimization on selected structures. See Advanced Parameters for forcefield, number of steps, and steepest descent", "Minimization", True, integrations=[Integrations.minimization])
     plugin.set_plugin_class(Minimization)
+    # the manager process must outlive plugin.run(), it is shut down once collected
+    scheduler_manager, scheduler = start_scheduler(MAX_CONCURRENT_RUNS, CPU_AFFINITY)
+    plugin.set_custom_data(scheduler)
     plugin.run()
 
 
@@ -0,0 +1,243 @@
+"""Minimize structures from files, without a Nanome session.
+
+Every model of a PDB file and every record of an SDF file is its own job. The
+input is a file or a directory of .pdb and .sdf files, read lazily so only the
+jobs queued for the worker pool are held in memory. Each minimized structure
+is written to the output directory in its input format, as <file>_<n>.<ext>,
+and the timings of every job are appended to timings.jsonl as it finishes.
+
+The selection picks the atoms allowed to move:
+
+ligands             hetero residues other than water, or every atom of a
+                    record without any, like the poses of an SDF library
+all                 every atom
+residues:NAME,...   residues with these names
+chains:NAME,...     chains with these names
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from nanome.api.structure import Complex, Workspace
+from nanome.util import Vector3
+
+from .Minimization import NANOBABEL
+from .engine import EngineRun
+from .nanobabel import SCRATCH_DIR, NanobabelRun
+from .process import ENGINES, NANOBABEL_ENGINE, NUMPY_ENGINE, SHELL_CUTOFF, engine_interaction_cutoff
+from .system import prepare_system, split_clusters
+
+FORMATS = ('.pdb', '.sdf')
+SELECTIONS = ('ligands', 'all', 'residues', 'chains')
+WATER_NAMES = {'HOH', 'WAT', 'DOD', 'H2O'}
+# jobs read ahead of the pool per worker, so workers never wait on the reader
+JOBS_PER_WORKER = 2
+TIMINGS_FILE = 'timings.jsonl'
+
+
+def split_pdb_models(lines):
+    """Lines of every model of a PDB file, each with the header lines before the first MODEL.
+
+    A file without MODEL records is a single model. Records after the last
+    ENDMDL, like CONECT, are only kept in that case.
+    """
+    header = []
+    model = None
+    has_models = False
+    for line in lines:
+        record = line[:6].strip()
+        if record == 'MODEL':
+            has_models = True
+            model = []
+        elif record == 'ENDMDL' and model is not None:
+            yield header + model + ['END']
+            model = None
+        elif model is not None:
+            model.append(line.rstrip('\r\n'))
+        elif not has_models:
+            header.append(line.rstrip('\r\n'))
+    if not has_models and any(line[:6].strip() in ('ATOM', 'HETATM') for line in header):
+        yield header
+
+
+def split_sdf_records(lines):
+    record = []
+    for line in lines:
+        record.append(line.rstrip('\r\n'))
+        if line.startswith('$$$$'):
+            yield record
+            record = []
+    if any(line.strip() for line in record):
+        yield record
+
+
+def read_records(path):
+    """(name, extension, lines) of every structure in path, a file or a directory of files."""
+    if os.path.isdir(path):
+        for entry in sorted(os.listdir(path)):
+            file_path = os.path.join(path, entry)
+            if os.path.isfile(file_path) and os.path.splitext(entry)[1].lower() in FORMATS:
+                yield from read_file(file_path)
+    else:
+        yield from read_file(path)
+
+
+def read_file(path):
+    base, extension = os.path.splitext(os.path.basename(path))
+    extension = extension.lower()
+    if extension not in FORMATS:
+        raise ValueError(f"Unsupported structure file: {path}")
+    split = split_pdb_models if extension == '.pdb' else split_sdf_records
+    with open(path) as f:
+        for i, lines in enumerate(split(f), 1):
+            yield (f'{base}_{i}', extension, lines)
+
+
+def select_atoms(complex, selection):
+    """Select the atoms of complex matching selection, described in this module's docstring."""
+    kind, _, names = selection.partition(':')
+    names = set(name.strip() for name in names.split(',') if name.strip())
+    if kind not in SELECTIONS:
+        raise ValueError(f"Unknown selection: {selection}")
+    atoms = list(complex.atoms)
+    has_het = any(atom.is_het for atom in atoms)
+    for atom in atoms:
+        if kind == 'residues':
+            atom.selected = atom.residue.name in names
+        elif kind == 'chains':
+            atom.selected = atom.chain.name in names
+        elif kind == 'ligands' and has_het:
+            atom.selected = atom.is_het and atom.residue.name not in WATER_NAMES
+        else:
+            atom.selected = True
+    return sum(1 for atom in atoms if atom.selected)
+
+
+def minimize_record(record, settings):
+    """Minimize one structure in its own event loop, writing it to settings.output.
+
+    Returns the job's timings and status. Errors are reported there, so one bad
+    structure never stops the batch.
+    """
+    name, extension, lines = record
+    result = {'name': name, 'status': 'ok'}
+    start = time.perf_counter()
+    try:
+        complex = (Complex.io.from_pdb if extension == '.pdb' else Complex.io.from_sdf)(lines=lines)
+        parsed = time.perf_counter()
+        result['parse_seconds'] = parsed - start
+        result['atom_count'] = sum(1 for _ in complex.atoms)
+        result['selected_count'] = select_atoms(complex, settings.selection)
+
+        workspace = Workspace()
+        workspace.add_complex(complex)
+        system = prepare_system(workspace, settings.cutoff, engine_interaction_cutoff(settings.force_field, settings.engine))
+        clusters = [cluster for cluster in split_clusters(system, settings.cutoff) if cluster.selected.any()]
+        prepared = time.perf_counter()
+        result['prepare_seconds'] = prepared - parsed
+        result['system_atom_count'] = len(system)
+        result['cluster_count'] = len(clusters)
+
+        with tempfile.TemporaryDirectory(dir=SCRATCH_DIR) as temp_dir:
+            loop = asyncio.new_event_loop()
+            try:
+                if settings.engine == NUMPY_ENGINE:
+                    runs = [EngineRun(cluster) for cluster in clusters]
+                    for run in runs:
+                        loop.run_until_complete(run.run(settings.force_field, settings.steps, settings.steepest, protocol=settings.protocol))
+                else:
+                    runs = [NanobabelRun(cluster, temp_dir) for cluster in clusters]
+                    for run in runs:
+                        loop.run_until_complete(run.run(settings.nanobabel, settings.force_field, settings.steps, settings.steepest, protocol=settings.protocol))
+            finally:
+                loop.close()
+        minimized = time.perf_counter()
+        result['minimize_seconds'] = minimized - prepared
+        result['energies'] = [run.convergence.energy for run in runs]
+        result['converged_count'] = sum(1 for run in runs if run.convergence.is_converged)
+
+        for run in runs:
+            if not run.succeeded or not run.has_frames:
+                result['status'] = 'failed'
+                continue
+            # the newest frame, every other one was coalesced away
+            positions = run.pop_positions().reshape(-1, 3).tolist()
+            for atom, position in zip(run.system.atoms, positions):
+                atom.position = Vector3(*position)
+        if len(runs) == 0:
+            result['status'] = 'skipped'
+
+        path = os.path.join(settings.output, name + extension)
+        if extension == '.pdb':
+            complex.io.to_pdb(path)
+        else:
+            complex.io.to_sdf(path)
+        result['write_seconds'] = time.perf_counter() - minimized
+    except Exception:
+        result['status'] = 'error'
+        result['error'] = traceback.format_exc()
+    result['total_seconds'] = time.perf_counter() - start
+    return result
+
+
+def run_batch(records, settings, workers, on_result):
+    """Minimize records over a pool of workers, calling on_result with each job's result as it finishes.
+
+    Records are pulled from the iterable only as the pool has room for them.
+    """
+    with ProcessPoolExecutor(workers) as pool:
+        pending = set()
+        for record in records:
+            if len(pending) >= workers * JOBS_PER_WORKER:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    on_result(future.result())
+            pending.add(pool.submit(minimize_record, record, settings))
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                on_result(future.result())
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='PDB or SDF file, or directory of them')
+    parser.add_argument('-o', '--output', default='minimized', help='directory to write minimized structures and timings to')
+    parser.add_argument('-s', '--selection', default='ligands', help='atoms allowed to move, see above')
+    parser.add_argument('-c', '--cutoff', type=float, default=SHELL_CUTOFF, help='angstroms around the selection included in the minimization')
+    parser.add_argument('--force-field', default='Uff', choices=['Uff', 'Gaff', 'Ghemical', 'MMFF94', 'MMFF94s'])
+    parser.add_argument('--steps', type=int, default=2500)
+    parser.add_argument('--conjugate-gradient', dest='steepest', action='store_false', help='use conjugate gradients instead of steepest descent')
+    parser.add_argument('--protocol', action='store_true', help='start with steepest descent and switch to conjugate gradients once the energy stops dropping quickly')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--engine', choices=ENGINES, help='nanobabel by default, numpy when nanobabel is not found')
+    parser.add_argument('--nanobabel', default=NANOBABEL, help='directory of the nanobabel executable')
+    settings = parser.parse_args(args)
+    if settings.engine is None:
+        settings.engine = NANOBABEL_ENGINE if settings.nanobabel is not None else NUMPY_ENGINE
+    if settings.engine == NANOBABEL_ENGINE and settings.nanobabel is None:
+        parser.error('nanobabel not found, set NANOBABEL or pass --nanobabel')
+    os.makedirs(settings.output, exist_ok=True)
+
+    counts = {}
+    start = time.perf_counter()
+    with open(os.path.join(settings.output, TIMINGS_FILE), 'a') as timings:
+        def on_result(result):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            timings.write(json.dumps(result) + '\n')
+            timings.flush()
+            print(f"{result['name']}: {result['status']} in {result['total_seconds']:.2f} s", flush=True)
+            if result['status'] == 'error':
+                print(result['error'], flush=True)
+
+        run_batch(read_records(settings.input), settings, settings.workers, on_result)
+
+    elapsed = time.perf_counter() - start
+    job_count = sum(counts.values())
+    print(f"{job_count} jobs in {elapsed:.2f} s, {job_count / elapsed if elapsed > 0 else 0:.2f} jobs/s: {counts}")
+    return 0 if counts.get('error', 0) == 0 and counts.get('failed', 0) == 0 else 1
@@ -0,0 +1,179 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from collections import OrderedDict
+
+import numpy as np
+
+from nanome.util import Logs
+
+from .frames import FrameDecoder
+from .streaming import FrameQueue
+
+MAX_CACHED_RESULTS = 32
+MAX_STORED_RESULTS = 1024
+# frames kept per cached trajectory, the final frame included
+CACHED_FRAMES = 10
+
+
+def system_key(system, ff, steps, steepest, *options):
+    """Hash of everything nanobabel's result depends on, options being any other setting that changes it."""
+    digest = hashlib.sha256()
+    digest.update(repr((ff, int(steps), bool(steepest), len(system)) + options).encode())
+    digest.update(' '.join(atom.symbol for atom in system.atoms).encode())
+    digest.update(np.array([atom.formal_charge for atom in system.atoms], dtype=np.int64).tobytes())
+    # coordinates are written to the input file with 4 decimals
+    digest.update(np.round(system.positions, 4).astype(np.float64).tobytes())
+    digest.update(np.ascontiguousarray(system.bonds, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(system.bond_kinds, dtype=np.int64).tobytes())
+    digest.update(np.packbits(system.selected).tobytes())
+    return digest.hexdigest()
+
+
+class TrajectoryRecorder():
+    """Keeps an evenly thinned subset of the frames it is given, and always the last one."""
+
+    def __init__(self, max_frames=CACHED_FRAMES):
+        self.max_frames = max(2, max_frames)
+        self.__frames = []
+        self.__last = None
+        self.__stride = 1
+        self.__count = 0
+
+    def __len__(self):
+        return len(self.__frames) + (self.__last is not None)
+
+    def add(self, positions):
+        frame = np.array(positions, dtype=np.float32)
+        self.__last = None
+        if self.__count % self.__stride == 0:
+            self.__frames.append(frame)
+            # leave room for the last frame
+            if len(self.__frames) >= self.max_frames:
+                self.__frames = self.__frames[::2]
+                self.__stride *= 2
+                if self.__frames[-1] is not frame:
+                    self.__last = frame
+        else:
+            self.__last = frame
+        self.__count += 1
+
+    def result(self):
+        """Recorded frames, as a (frame_count, atom_count, 3) float32 array."""
+        frames = self.__frames + ([self.__last] if self.__last is not None else [])
+        return np.stack(frames)
+
+
+class ResultCache():
+    """Least recently used minimization results, keyed by system_key.
+
+    Results are trajectories of workspace positions. With a directory, results
+    are also stored there as .npy files, so they outlive the session and are
+    shared with every session of the plugin server.
+    """
+
+    def __init__(self, max_entries=MAX_CACHED_RESULTS, directory=None, max_stored=MAX_STORED_RESULTS):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_stored = max_stored
+        self.hits = 0
+        self.misses = 0
+        self.__entries = OrderedDict()
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key):
+        trajectory = self.__entries.get(key)
+        if trajectory is None:
+            trajectory = self.__load(key)
+        if trajectory is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.__remember(key, trajectory)
+        return trajectory
+
+    def put(self, key, trajectory):
+        self.__remember(key, trajectory)
+        if self.directory is not None:
+            self.__store(key, trajectory)
+
+    def __remember(self, key, trajectory):
+        self.__entries[key] = trajectory
+        self.__entries.move_to_end(key)
+        while len(self.__entries) > self.max_entries:
+            self.__entries.popitem(last=False)
+
+    def __path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def __load(self, key):
+        if self.directory is None or not os.path.exists(self.__path(key)):
+            return None
+        try:
+            trajectory = np.load(self.__path(key))
+            os.utime(self.__path(key))
+            return trajectory
+        except (OSError, ValueError) as e:
+            Logs.warning(f"Could not read cached result {key}: {e}")
+            return None
+
+    def __store(self, key, trajectory):
+        try:
+            # write then rename, so other sessions never read a partial file
+            with tempfile.NamedTemporaryFile(dir=self.directory, suffix='.tmp', delete=False) as f:
+                np.save(f, trajectory)
+            os.replace(f.name, self.__path(key))
+            self.__prune()
+        except OSError as e:
+            Logs.warning(f"Could not store cached result {key}: {e}")
+
+    def __prune(self):
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.npy')]
+        if len(paths) <= self.max_stored:
+            return
+        paths.sort(key=os.path.getmtime)
+        for path in paths[:len(paths) - self.max_stored]:
+            os.remove(path)
+
+
+class CachedRun():
+    """Replays a cached trajectory in place of a nanobabel run, with the same frame interface."""
+
+    def __init__(self, system, trajectory, on_frame=None):
+        self.system = system
+        self.frames = FrameQueue(False)
+        self.decoder = FrameDecoder(system.serials, system.complexes, system.positions)
+        self.on_frame = on_frame or (lambda: None)
+        self.is_running = False
+        self.is_done = False
+        self.__trajectory = trajectory
+
+    @property
+    def has_frames(self):
+        return len(self.frames) > 0
+
+    def pop_positions(self):
+        return self.decoder.place(self.frames.pop())
+
+    async def replay(self, frame_interval):
+        self.is_running = True
+        try:
+            for i, positions in enumerate(self.__trajectory):
+                if self.is_done:
+                    return
+                if i > 0:
+                    await asyncio.sleep(frame_interval)
+                self.frames.push(positions)
+                self.on_frame()
+        finally:
+            self.is_running = False
+            self.is_done = True
+
+    def stop(self):
+        self.is_done = True
+        self.frames.clear()
@@ -0,0 +1,73 @@
+import re
+
+# OpenBabel's minimizer log lines: step, E(n), then E(n-1) or ---- on the first step
+ENERGY_LINE = re.compile(rb'^[ \t]*(\d+)[ \t]+(-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?)[ \t]+(?:\S+)[ \t]*\r?$', re.MULTILINE)
+# largest energy change between two log lines still counted as converged
+ENERGY_THRESHOLD = 0.01
+# steps the energy must stay within threshold before the run is stopped
+CONVERGENCE_WINDOW = 100
+# energy drop per step under which a protocol's steepest descent pre-pass hands over to conjugate gradients
+SWITCH_RATE = 0.1
+# steps of the pre-pass, at least and at most
+PREPASS_MIN_STEPS = 60
+PREPASS_MAX_STEPS = 500
+
+
+class ConvergenceMonitor():
+    """Energy trace of a nanobabel run, read from the log lines around its frames.
+
+    The run is converged once every energy change between log lines stayed
+    under threshold for window steps. A falsy threshold never converges.
+    step_offset is added to the steps read, for runs continuing an earlier one.
+    """
+
+    def __init__(self, threshold=ENERGY_THRESHOLD, window=CONVERGENCE_WINDOW):
+        self.threshold = threshold
+        self.window = window
+        self.steps = []
+        self.energies = []
+        self.converged_step = None
+        self.step_offset = 0
+        self.__stable_since = None
+
+    @property
+    def is_converged(self):
+        return self.converged_step is not None
+
+    @property
+    def energy(self):
+        return self.energies[-1] if len(self.energies) > 0 else None
+
+    @property
+    def drop_rate(self):
+        """Energy drop per step between the last two energies, None before there are two."""
+        if len(self.energies) < 2:
+            return None
+        return (self.energies[-2] - self.energies[-1]) / (self.steps[-1] - self.steps[-2])
+
+    def prepass_over(self, rate=SWITCH_RATE):
+        """Whether a steepest descent pre-pass went on long enough, its energy dropping slower than rate per step."""
+        step = self.steps[-1] if len(self.steps) > 0 else 0
+        if step >= PREPASS_MAX_STEPS:
+            return True
+        return step >= PREPASS_MIN_STEPS and self.drop_rate is not None and self.drop_rate < rate
+
+    def feed(self, text):
+        """Read the energy lines out of text, made of whole lines. Returns True once converged."""
+        for match in ENERGY_LINE.finditer(bytes(text)):
+            self.add(int(match.group(1)) + self.step_offset, float(match.group(2)))
+        return self.is_converged
+
+    def add(self, step, energy):
+        if len(self.steps) > 0 and step <= self.steps[-1]:
+            # a continuing run logs its starting point again
+            return
+        stable = bool(self.threshold) and len(self.energies) > 0 and abs(energy - self.energies[-1]) < self.threshold
+        if not stable:
+            self.__stable_since = None
+        elif self.__stable_since is None:
+            self.__stable_since = self.steps[-1]
+        self.steps.append(step)
+        self.energies.append(energy)
+        if not self.is_converged and self.__stable_since is not None and step - self.__stable_since >= self.window:
+            self.converged_step = step
@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+import numpy as np
+
+from .cache import TrajectoryRecorder
+from .convergence import CONVERGENCE_WINDOW, ENERGY_THRESHOLD, ConvergenceMonitor
+from .forcefield import ForceField
+from .system import NONBONDED_CUTOFF
+from .frames import FrameDecoder
+from .streaming import FrameQueue
+
+# steps between frames, as nanobabel is asked to print them
+FRAME_INTERVAL = 20
+# distances the furthest moving atom goes in one step, in angstroms
+INITIAL_STEP = 0.05
+MAX_STEP = 0.3
+MIN_STEP = 1e-6
+# sufficient decrease factor and tries of the backtracking line search
+ARMIJO_FACTOR = 1e-4
+MAX_BACKTRACKS = 10
+# root mean square gradient, in kcal/mol A, under which the minimization is converged
+GRADIENT_TOLERANCE = 1e-3
+# nonbonded cutoff of a protocol's steepest descent pre-pass, still past the repulsive wall of every UFF pair
+PREPASS_CUTOFF = 4.5
+
+
+class Minimizer():
+    """Steepest descent, or Polak-Ribiere conjugate gradient, over the movable atoms of a force field.
+
+    Each step backtracks along its direction from a length moving the furthest
+    atom by the current step size, which grows after every successful step.
+    """
+
+    def __init__(self, force_field, positions, conjugate=False):
+        self.force_field = force_field
+        self.conjugate = conjugate
+        self.movable = force_field.movable
+        self.positions = np.array(positions, dtype=np.float64)
+        self.gradient = np.zeros_like(self.positions)
+        self.energy = force_field.energy(self.positions, self.gradient)
+        self.gradient[~self.movable] = 0
+        self.is_converged = self.rms_gradient < GRADIENT_TOLERANCE
+        self.__direction = -self.gradient
+        self.__step = INITIAL_STEP
+
+    @property
+    def rms_gradient(self):
+        count = np.count_nonzero(self.movable)
+        return float(np.sqrt(np.sum(self.gradient ** 2) / count)) if count > 0 else 0.0
+
+    def run(self, steps):
+        """Take up to steps steps, returning is_converged."""
+        for _ in range(steps):
+            if self.is_converged:
+                break
+            self.step()
+        return self.is_converged
+
+    def step(self):
+        direction = self.__direction
+        slope = np.sum(self.gradient * direction)
+        if slope >= 0:
+            # conjugate directions can stop going downhill, start over from the gradient
+            direction = -self.gradient
+            slope = -np.sum(self.gradient ** 2)
+        longest = np.sqrt(np.max(np.sum(direction ** 2, axis=1)))
+        length = self.__step / longest
+        gradient = np.empty_like(self.gradient)
+        for _ in range(MAX_BACKTRACKS):
+            positions = self.positions + length * direction
+            energy = self.force_field.energy(positions, gradient)
+            if energy <= self.energy + ARMIJO_FACTOR * length * slope:
+                break
+            length /= 2
+        else:
+            self.__step = length * longest
+            self.__direction = -self.gradient
+            self.is_converged = self.__step < MIN_STEP
+            return
+
+        gradient[~self.movable] = 0
+        if self.conjugate:
+            beta = max(0.0, np.sum(gradient * (gradient - self.gradient)) / np.sum(self.gradient ** 2))
+            self.__direction = -gradient + beta * direction
+        else:
+            self.__direction = -gradient
+        self.__step = min(MAX_STEP, 1.2 * length * longest)
+        self.positions = positions
+        self.energy = energy
+        self.gradient = gradient
+        self.is_converged = self.rms_gradient < GRADIENT_TOLERANCE
+
+
+class EngineRun():
+    """In-process minimization of a prepared system with the NumPy force field.
+
+    Streams like a NanobabelRun, without any file or text in between: every
+    FRAME_INTERVAL steps, the minimizer's positions are queued as a frame.
+    Steps run on the event loop's default executor, so the loop keeps serving
+    the stream meanwhile. A protocol run starts with a steepest descent
+    pre-pass over a shorter nonbonded cutoff, and refines its result with
+    conjugate gradients over the full one.
+    """
+
+    def __init__(self, system, coalesce_frames=True, on_frame=None, energy_threshold=ENERGY_THRESHOLD, convergence_window=CONVERGENCE_WINDOW):
+        self.system = system
+        self.frames = FrameQueue(coalesce_frames)
+        self.decoder = FrameDecoder(system.serials, system.complexes, system.positions)
+        self.trajectory = TrajectoryRecorder()
+        self.convergence = ConvergenceMonitor(energy_threshold, convergence_window)
+        self.on_frame = on_frame or (lambda: None)
+        self.is_running = False
+        self.is_done = False
+        self.return_code = None
+        self.started_at = None
+        self.first_output_at = None
+        self.finished_at = None
+        self.parse_seconds = 0.0
+
+    @property
+    def has_frames(self):
+        return len(self.frames) > 0
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0 or self.convergence.is_converged
+
+    def pop_positions(self):
+        """Place the next queued frame into stream positions, recording it in trajectory."""
+        positions = self.decoder.place(self.frames.pop())
+        self.trajectory.add(self.decoder.workspace_positions)
+        return positions
+
+    async def run(self, ff, steps, steepest, protocol=False):
+        """Minimize for up to steps steps, stopping early once converged.
+
+        The force field is always this engine's UFF, whatever ff names.
+        """
+        loop = asyncio.get_event_loop()
+        self.is_running = True
+        self.started_at = time.perf_counter()
+        try:
+            prepass = protocol
+            if prepass:
+                minimizer = await loop.run_in_executor(None, self.__minimizer, True, self.system.positions, PREPASS_CUTOFF)
+            else:
+                minimizer = await loop.run_in_executor(None, self.__minimizer, steepest, self.system.positions)
+            self.convergence.add(0, minimizer.energy)
+            step = 0
+            while step < steps and not self.is_done:
+                count = min(FRAME_INTERVAL, steps - step)
+                converged = await loop.run_in_executor(None, minimizer.run, count)
+                step += count
+                self.convergence.add(step, minimizer.energy)
+                if prepass and (converged or self.convergence.prepass_over()):
+                    prepass = False
+                    minimizer = await loop.run_in_executor(None, self.__minimizer, False, minimizer.positions)
+                    converged = minimizer.is_converged
+                if converged and not self.convergence.is_converged:
+                    self.convergence.converged_step = step
+                self.__push(minimizer.positions.copy())
+                if self.convergence.is_converged:
+                    break
+            self.return_code = 0
+        finally:
+            self.finished_at = time.perf_counter()
+            self.is_running = False
+            self.is_done = True
+        return self.return_code
+
+    def stop(self):
+        self.is_done = True
+        self.frames.clear()
+
+    def __minimizer(self, steepest, positions, cutoff=NONBONDED_CUTOFF):
+        return Minimizer(ForceField(self.system, cutoff), positions, conjugate=not steepest)
+
+    def __push(self, positions):
+        if self.is_done:
+            return
+        if self.first_output_at is None:
+            self.first_output_at = time.perf_counter()
+        self.frames.push(positions)
+        self.on_frame()
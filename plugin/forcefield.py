@@ -0,0 +1,257 @@
+import numpy as np
+
+from .geometry import CellList
+from .system import NONBONDED_CUTOFF
+
+# UFF parameters of each element's most common type (Rappe et al., 1992): bond radius and
+# nonbonded distance in angstroms, well depth in kcal/mol, effective charge, sp3 torsion barrier in kcal/mol
+UFF_PARAMETERS = {
+    'H': (0.354, 2.886, 0.044, 0.712, 0.0),
+    'C': (0.757, 3.851, 0.105, 1.912, 2.119),
+    'N': (0.700, 3.660, 0.069, 2.544, 0.450),
+    'O': (0.658, 3.500, 0.060, 2.300, 0.018),
+    'F': (0.668, 3.364, 0.050, 1.735, 0.0),
+    'Na': (1.539, 2.983, 0.030, 1.081, 0.0),
+    'Mg': (1.421, 3.021, 0.111, 1.787, 0.0),
+    'P': (1.101, 4.147, 0.305, 2.863, 2.400),
+    'S': (1.064, 4.035, 0.274, 2.703, 0.484),
+    'Cl': (1.044, 3.947, 0.227, 2.348, 0.0),
+    'K': (1.953, 3.812, 0.035, 1.165, 0.0),
+    'Ca': (1.761, 3.399, 0.238, 2.141, 0.0),
+    'Fe': (1.285, 2.912, 0.013, 2.430, 0.0),
+    'Zn': (1.193, 2.763, 0.124, 1.308, 0.0),
+    'Br': (1.192, 4.189, 0.251, 2.519, 0.0),
+    'I': (1.382, 4.500, 0.339, 2.650, 0.0),
+}
+DEFAULT_PARAMETERS = (0.9, 3.9, 0.1, 2.0, 0.0)
+# UFF's sp3 angles for elements whose lone pairs close them
+SP3_ANGLES = {'N': 106.7, 'O': 104.51, 'P': 93.8, 'S': 92.1}
+# bond orders of nanome's bond kinds: unknown, single, double, triple, aromatic
+BOND_ORDERS = np.array([1.0, 1.0, 2.0, 3.0, 1.5])
+# UFF's bond force constant scale, in kcal/mol A
+BOND_FORCE_SCALE = 664.12
+# pairs are listed this much past the cutoff, and only listed again once an atom moved half as much
+NEIGHBOR_SKIN = 1.0
+
+
+def accumulate(gradient, atoms, values):
+    for axis in range(3):
+        gradient[:, axis] += np.bincount(atoms, values[:, axis], minlength=len(gradient))
+
+
+def dot(a, b):
+    return np.einsum('ij,ij->i', a, b)
+
+
+def hybridizations(atom_count, bonds, bond_orders):
+    """1, 2 or 3 for sp, sp2 and sp3 atoms, guessed from their bond orders."""
+    multiple = np.zeros(atom_count, dtype=np.int64)
+    np.add.at(multiple, bonds[bond_orders > 1].ravel(), 1)
+    triple = np.zeros(atom_count, dtype=bool)
+    triple[bonds[bond_orders >= 3].ravel()] = True
+    result = np.full(atom_count, 3, dtype=np.int64)
+    result[multiple > 0] = 2
+    result[triple | (np.bincount(bonds[bond_orders == 2].ravel(), minlength=atom_count) > 1)] = 1
+    return result
+
+
+class ForceField():
+    """Simplified UFF energy and gradient of a prepared system, on NumPy arrays.
+
+    Harmonic bonds and cosine harmonic angles use UFF's rest lengths, rest angles
+    and force constants, torsions UFF's barriers and periodicities, and atoms more
+    than two bonds apart a 12-6 Lennard-Jones term shifted to zero at cutoff.
+    Inversion and electrostatic terms are left out. Terms between fixed atoms only
+    are skipped, their energy never changes.
+    """
+
+    def __init__(self, system, cutoff=NONBONDED_CUTOFF):
+        self.cutoff = cutoff
+        self.movable = system.selected.copy()
+        atom_count = len(system)
+        parameters = np.array([UFF_PARAMETERS.get(atom.symbol, DEFAULT_PARAMETERS) for atom in system.atoms]).reshape(-1, 5)
+        radii, distances, depths, charges, barriers = parameters.T
+        self.__distances = distances
+        self.__depths = depths
+
+        bonds = system.bonds
+        orders = BOND_ORDERS[np.clip(system.bond_kinds, 0, len(BOND_ORDERS) - 1)]
+        hybridization = hybridizations(atom_count, bonds, orders)
+        rest_lengths = radii[bonds[:, 0]] + radii[bonds[:, 1]]
+        rest_lengths -= 0.1332 * rest_lengths * np.log(orders)
+        neighbors = [[] for _ in range(atom_count)]
+        length_by_pair = {}
+        for (i, j), length in zip(bonds.tolist(), rest_lengths.tolist()):
+            neighbors[i].append(j)
+            neighbors[j].append(i)
+            length_by_pair[(i, j)] = length_by_pair[(j, i)] = length
+
+        keep = self.movable[bonds].any(axis=1)
+        self.__bonds = bonds[keep]
+        self.__bond_tengths = rest_lengths[keep]
+        self.__bond_forces = BOND_FORCE_SCALE * charges[bonds[keep, 0]] * charges[bonds[keep, 1]] / self.__bond_tengths ** 3
+
+        angles = [(i, j, k) for j in range(atom_count) for a, i in enumerate(neighbors[j]) for k in neighbors[j][a + 1:]]
+        self.__angles = np.array(angles, dtype=np.int64).reshape(-1, 3)
+        self.__angles = self.__angles[self.movable[self.__angles].any(axis=1)]
+        i, j, k = self.__angles.T
+        rest_angles = np.array([SP3_ANGLES.get(atom.symbol, 109.47) for atom in system.atoms], dtype=np.float64)
+        rest_angles[hybridization == 2] = 120.0
+        rest_angles[hybridization == 1] = 180.0
+        cos_rest = np.cos(np.radians(rest_angles[j]))
+        r_ij = np.array([length_by_pair[pair] for pair in zip(i.tolist(), j.tolist())])
+        r_jk = np.array([length_by_pair[pair] for pair in zip(j.tolist(), k.tolist())])
+        r_ik2 = r_ij ** 2 + r_jk ** 2 - 2 * r_ij * r_jk * cos_rest
+        angle_forces = BOND_FORCE_SCALE * charges[i] * charges[k] / r_ik2 ** 2.5 * (3 * r_ij * r_jk * (1 - cos_rest ** 2) - r_ik2 * cos_rest)
+        self.__linear = hybridization[j] == 1
+        self.__angle_cos = cos_rest
+        # near its minimum, UFF's angle term is K / (2 sin^2 theta0) (cos theta - cos theta0)^2
+        self.__angle_forces = np.where(self.__linear, angle_forces, angle_forces / (2 * np.maximum(1 - cos_rest ** 2, 1e-6)))
+
+        self.__set_torsions(neighbors, bonds, orders, hybridization, barriers)
+
+        # atoms one or two bonds apart do not interact through the nonbonded term
+        excluded = np.concatenate((bonds, np.array(angles, dtype=np.int64).reshape(-1, 3)[:, [0, 2]]))
+        self.__atom_count = atom_count
+        self.__excluded = np.unique(np.minimum(excluded[:, 0], excluded[:, 1]) * atom_count + np.maximum(excluded[:, 0], excluded[:, 1]))
+        self.__pairs = None
+        self.__listed_positions = None
+
+    def __set_torsions(self, neighbors, bonds, orders, hybridization, barriers):
+        torsions = []
+        periodicities = []
+        phases = []
+        heights = []
+        for (j, k), order in zip(bonds.tolist(), orders.tolist()):
+            if not (self.movable[j] or self.movable[k] or any(self.movable[neighbors[j]]) or any(self.movable[neighbors[k]])):
+                continue
+            hj, hk = hybridization[j], hybridization[k]
+            if hj == 1 or hk == 1:
+                continue
+            if hj == 3 and hk == 3:
+                periodicity, phase, height = 3, -1.0, np.sqrt(barriers[j] * barriers[k])
+            elif hj == 2 and hk == 2:
+                periodicity, phase, height = 2, 1.0, 5 * 1.25 * (1 + 4.18 * np.log(order))
+            else:
+                periodicity, phase, height = 6, 1.0, 1.0
+            around = [(i, j, k, t) for i in neighbors[j] if i != k for t in neighbors[k] if t != j and t != i]
+            if height == 0 or len(around) == 0:
+                continue
+            # UFF spreads the barrier over every torsion around the bond
+            torsions.extend(around)
+            periodicities.extend([periodicity] * len(around))
+            phases.extend([phase] * len(around))
+            heights.extend([height / len(around)] * len(around))
+        self.__torsions = np.array(torsions, dtype=np.int64).reshape(-1, 4)
+        self.__periodicities = np.array(periodicities, dtype=np.float64)
+        self.__phases = np.array(phases, dtype=np.float64)
+        self.__heights = np.array(heights, dtype=np.float64)
+
+    def energy(self, positions, gradient=None):
+        """Energy of positions in kcal/mol. When given, gradient is filled with its derivative."""
+        if gradient is not None:
+            gradient[:] = 0
+        return self.__bond_energy(positions, gradient) \
+            + self.__angle_energy(positions, gradient) \
+            + self.__torsion_energy(positions, gradient) \
+            + self.__nonbonded_energy(positions, gradient)
+
+    def __bond_energy(self, positions, gradient):
+        if len(self.__bonds) == 0:
+            return 0.0
+        delta = positions[self.__bonds[:, 0]] - positions[self.__bonds[:, 1]]
+        length = np.sqrt(dot(delta, delta))
+        stretch = length - self.__bond_tengths
+        if gradient is not None:
+            force = (self.__bond_forces * stretch / np.maximum(length, 1e-12))[:, None] * delta
+            accumulate(gradient, self.__bonds[:, 0], force)
+            accumulate(gradient, self.__bonds[:, 1], -force)
+        return float(0.5 * np.sum(self.__bond_forces * stretch ** 2))
+
+    def __angle_energy(self, positions, gradient):
+        if len(self.__angles) == 0:
+            return 0.0
+        i, j, k = self.__angles.T
+        u = positions[i] - positions[j]
+        v = positions[k] - positions[j]
+        u_length = np.maximum(np.sqrt(dot(u, u)), 1e-12)
+        v_length = np.maximum(np.sqrt(dot(v, v)), 1e-12)
+        cos = np.clip(dot(u, v) / (u_length * v_length), -1, 1)
+        # linear centers use UFF's K (1 + cos theta)
+        energy = np.where(self.__linear, self.__angle_forces * (1 + cos), self.__angle_forces * (cos - self.__angle_cos) ** 2)
+        if gradient is not None:
+            d_cos = np.where(self.__linear, self.__angle_forces, 2 * self.__angle_forces * (cos - self.__angle_cos))
+            d_i = (v / (u_length * v_length)[:, None] - (cos / u_length ** 2)[:, None] * u) * d_cos[:, None]
+            d_k = (u / (u_length * v_length)[:, None] - (cos / v_length ** 2)[:, None] * v) * d_cos[:, None]
+            accumulate(gradient, i, d_i)
+            accumulate(gradient, k, d_k)
+            accumulate(gradient, j, -d_i - d_k)
+        return float(np.sum(energy))
+
+    def __torsion_energy(self, positions, gradient):
+        if len(self.__torsions) == 0:
+            return 0.0
+        i, j, k, t = self.__torsions.T
+        b1 = positions[j] - positions[i]
+        b2 = positions[k] - positions[j]
+        b3 = positions[t] - positions[k]
+        m = np.cross(b1, b2)
+        n = np.cross(b2, b3)
+        b2_length = np.sqrt(dot(b2, b2))
+        angle = np.arctan2(b2_length * dot(b1, n), dot(m, n))
+        energy = 0.5 * self.__heights * (1 - self.__phases * np.cos(self.__periodicities * angle))
+        if gradient is not None:
+            d_angle = 0.5 * self.__heights * self.__phases * self.__periodicities * np.sin(self.__periodicities * angle)
+            m2 = np.maximum(dot(m, m), 1e-12)
+            n2 = np.maximum(dot(n, n), 1e-12)
+            b2_2 = np.maximum(b2_length ** 2, 1e-12)
+            d_i = -(b2_length / m2)[:, None] * m
+            d_t = (b2_length / n2)[:, None] * n
+            p = (dot(b1, b2) / b2_2)[:, None]
+            q = (dot(b3, b2) / b2_2)[:, None]
+            d_j = q * d_t - (1 + p) * d_i
+            d_k = p * d_i - (1 + q) * d_t
+            for atoms, d in ((i, d_i), (j, d_j), (k, d_k), (t, d_t)):
+                accumulate(gradient, atoms, d_angle[:, None] * d)
+        return float(np.sum(energy))
+
+    def __nonbonded_energy(self, positions, gradient):
+        pairs = self.__neighbor_pairs(positions)
+        if len(pairs) == 0:
+            return 0.0
+        i, j = pairs.T
+        delta = positions[i] - positions[j]
+        length2 = dot(delta, delta)
+        in_range = length2 < self.cutoff * self.cutoff
+        i, j, delta, length2 = i[in_range], j[in_range], delta[in_range], length2[in_range]
+        distance2 = self.__distances[i] * self.__distances[j]
+        depth = np.sqrt(self.__depths[i] * self.__depths[j])
+        ratio6 = (distance2 / np.maximum(length2, 1e-6)) ** 3
+        if gradient is not None:
+            force = (12 * depth * (ratio6 - ratio6 ** 2) / np.maximum(length2, 1e-6))[:, None] * delta
+            accumulate(gradient, i, force)
+            accumulate(gradient, j, -force)
+        # shifted to zero at the cutoff, so pairs crossing it do not make the energy jump
+        cutoff6 = (distance2 / self.cutoff ** 2) ** 3
+        return float(np.sum(depth * (ratio6 ** 2 - 2 * ratio6 - cutoff6 ** 2 + 2 * cutoff6)))
+
+    def __neighbor_pairs(self, positions):
+        if self.__listed_positions is not None:
+            moved = positions - self.__listed_positions
+            if dot(moved, moved).max(initial=0) < (NEIGHBOR_SKIN / 2) ** 2:
+                return self.__pairs
+        self.__listed_positions = positions.copy()
+        movable = np.flatnonzero(self.movable)
+        chunks = list(CellList(positions, self.cutoff + NEIGHBOR_SKIN).pairs(positions[movable]))
+        if len(chunks) == 0:
+            self.__pairs = np.empty((0, 2), dtype=np.int64)
+            return self.__pairs
+        i = movable[np.concatenate([chunk[0] for chunk in chunks])]
+        j = np.concatenate([chunk[1] for chunk in chunks])
+        # pairs of movable atoms are found from both ends, keep one
+        keep = (i != j) & (~self.movable[j] | (i < j))
+        i, j = i[keep], j[keep]
+        keys = np.minimum(i, j) * self.__atom_count + np.maximum(i, j)
+        keep = ~np.isin(keys, self.__excluded)
+        self.__pairs = np.stack((i[keep], j[keep]), axis=1)
+        return self.__pairs
@@ -0,0 +1,164 @@
+import numpy as np
+
+from .geometry import matrix_to_array, transform_positions
+
+NEWLINE = ord('\n')
+RECORD_NAMES = (b'ATOM', b'HETA')
+MIN_RECORD_LENGTH = 54
+# PDB columns read by the decoder: x, y, z are [30, 54)
+RECORD_NAME_COLUMNS = np.arange(0, 4)
+POSITION_COLUMNS = np.arange(30, 54)
+START_MARKER = b'Step update start'
+END_MARKER = b'Step update end'
+
+
+def read_columns(data, starts, columns, width):
+    chars = np.ascontiguousarray(data[starts[:, None] + columns])
+    return chars.view('S%d' % width)
+
+
+class FrameDecoder():
+    """Turns the PDB text of a nanobabel step into stream ready positions.
+
+    Only the coordinate columns of ATOM/HETATM records are read. nanobabel
+    writes atoms in the order of their serials, so records are matched to
+    atoms by position rather than by a serial field that overflows past 99,999
+    atoms. serials[i] is the serial written for stream index i, and complexes[i]
+    the complex that atom belongs to, whose workspace to complex transform is
+    cached here once. Optional workspace positions give the starting point of
+    atoms not yet seen in a frame.
+    """
+
+    def __init__(self, serials, complexes, positions=None):
+        serials = np.asarray(serials, dtype=np.int64)
+        self.atom_count = len(serials)
+        self.__index_by_record = np.argsort(serials, kind='stable')
+        self.__workspace_positions = np.zeros((self.atom_count, 3), dtype=np.float64)
+        if positions is not None:
+            self.__workspace_positions[:] = positions
+        self.__positions = np.zeros((self.atom_count, 3), dtype=np.float32)
+
+        self.__transforms = []
+        start = 0
+        for i in range(1, self.atom_count + 1):
+            if i == self.atom_count or complexes[i] is not complexes[start]:
+                matrix = matrix_to_array(complexes[start].get_workspace_to_complex_matrix())
+                self.__transforms.append((slice(start, i), matrix))
+                start = i
+        self.__transform()
+
+    @property
+    def positions(self):
+        """Latest decoded positions, as a flat x, y, z float32 array."""
+        return self.__positions.reshape(-1)
+
+    @property
+    def workspace_positions(self):
+        """Latest positions in workspace space, as an (atom_count, 3) float64 array owned by the decoder."""
+        return self.__workspace_positions
+
+    def place(self, workspace_positions):
+        """Move every atom to workspace_positions, returning the flat positions to stream like decode does."""
+        self.__workspace_positions[:] = workspace_positions
+        self.__transform()
+        return self.positions
+
+    def decode(self, frame):
+        """Decode a frame (bytes-like PDB text) into a flat x, y, z float32 array.
+
+        The returned array is owned by the decoder and overwritten by the next
+        call. Atoms past the last record of the frame keep their previous position.
+        """
+        data = np.frombuffer(frame, dtype=np.uint8)
+        line_ends = np.flatnonzero(data == NEWLINE)
+        starts = np.concatenate(([0], line_ends + 1))
+        ends = np.concatenate((line_ends, [len(data)]))
+        starts = starts[ends - starts >= MIN_RECORD_LENGTH]
+
+        names = read_columns(data, starts, RECORD_NAME_COLUMNS, 4).ravel()
+        starts = starts[np.isin(names, RECORD_NAMES)]
+        starts = starts[:self.atom_count]
+        coordinates = read_columns(data, starts, POSITION_COLUMNS, 8).astype(np.float64)
+        self.__workspace_positions[self.__index_by_record[:len(starts)]] = coordinates
+        self.__transform()
+        return self.positions
+
+    def __transform(self):
+        for atoms, matrix in self.__transforms:
+            self.__positions[atoms] = transform_positions(self.__workspace_positions[atoms], matrix)
+
+
+class StepParser():
+    """Splits raw nanobabel stdout into step frames, whatever the chunk boundaries.
+
+    Complete frames are handed to on_frame as memoryviews over the received
+    chunks, without copying unless a frame spans several chunks. Lines outside
+    of step blocks are handed to on_text.
+    """
+
+    def __init__(self, on_frame, on_text=None):
+        self.on_frame = on_frame
+        self.on_text = on_text or (lambda _: None)
+        self.__tail = b''
+        self.__frame_parts = None
+
+    def feed(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        first_newline = chunk.find(b'\n')
+        if first_newline < 0:
+            self.__tail += chunk
+            return
+        # the first line completes whatever partial line was left by the previous chunk
+        self.__line(self.__tail + chunk[:first_newline + 1])
+        last_newline = chunk.rfind(b'\n')
+        self.__scan(chunk, first_newline + 1, last_newline + 1)
+        self.__tail = chunk[last_newline + 1:]
+
+    def flush(self):
+        if self.__tail:
+            self.__line(self.__tail)
+            self.__tail = b''
+
+    def __line(self, line):
+        if self.__frame_parts is None:
+            if START_MARKER in line:
+                self.__frame_parts = []
+            else:
+                self.on_text(memoryview(line))
+        elif END_MARKER in line:
+            self.__finish_frame()
+        else:
+            self.__frame_parts.append(memoryview(line))
+
+    def __scan(self, chunk, start, end):
+        view = memoryview(chunk)
+        while start < end:
+            marker = chunk.find(START_MARKER if self.__frame_parts is None else END_MARKER, start, end)
+            if marker < 0:
+                self.__add(view[start:end])
+                return
+            line_start = max(start, chunk.rfind(b'\n', start, marker) + 1)
+            self.__add(view[start:line_start])
+            if self.__frame_parts is None:
+                self.__frame_parts = []
+            else:
+                self.__finish_frame()
+            start = chunk.find(b'\n', marker, end) + 1
+
+    def __add(self, view):
+        if len(view) == 0:
+            return
+        if self.__frame_parts is None:
+            self.on_text(view)
+        else:
+            self.__frame_parts.append(view)
+
+    def __finish_frame(self):
+        parts = self.__frame_parts
+        self.__frame_parts = None
+        if len(parts) == 1:
+            frame = parts[0]
+        else:
+            frame = memoryview(b''.join(parts))
+        self.on_frame(frame)
@@ -0,0 +1,123 @@
+import numpy as np
+
+# Upper bound on the number of candidate pairs expanded at once by CellList
+PAIR_CHUNK_SIZE = 1 << 20
+
+
+def matrix_to_array(matrix):
+    return np.array([matrix[i][:] for i in range(4)], dtype=np.float64)
+
+
+def positions_to_array(positions):
+    result = np.empty((len(positions), 3), dtype=np.float64)
+    for i, position in enumerate(positions):
+        result[i] = (position.x, position.y, position.z)
+    return result
+
+
+def transform_positions(positions, matrix):
+    # Same operation order as nanome's Matrix * Vector3, so results match bit for bit
+    x = positions[:, 0]
+    y = positions[:, 1]
+    z = positions[:, 2]
+    result = np.empty_like(positions)
+    for i in range(3):
+        result[:, i] = matrix[i, 0] * x + matrix[i, 1] * y + matrix[i, 2] * z + matrix[i, 3]
+    return result
+
+
+def connected_components(count, edges):
+    """Label each of count nodes with its connected component, numbered by first node."""
+    labels = np.arange(count)
+    if len(edges) == 0:
+        return labels
+    while True:
+        smallest = np.minimum(labels[edges[:, 0]], labels[edges[:, 1]])
+        merged = labels.copy()
+        np.minimum.at(merged, edges[:, 0], smallest)
+        np.minimum.at(merged, edges[:, 1], smallest)
+        # labels always point to a node with a smaller index, follow them to shortcut long chains
+        merged = merged[merged]
+        if np.array_equal(merged, labels):
+            break
+        labels = merged
+    return np.unique(labels, return_inverse=True)[1]
+
+
+class CellList():
+    """Uniform grid over a set of center positions, answering batched radius queries."""
+
+    def __init__(self, centers, cutoff):
+        self.cutoff = float(cutoff)
+        self.centers = np.asarray(centers, dtype=np.float64).reshape(-1, 3)
+        self.__sqr_cutoff = self.cutoff * self.cutoff
+        if len(self.centers) == 0:
+            return
+        self.__origin = self.centers.min(axis=0)
+        # two empty cells of padding on each side keep neighbor keys from wrapping
+        cells = self.__cells(self.centers) + 2
+        self.__dims = cells.max(axis=0) + 3
+        keys = self.__keys(cells)
+        self.__order = np.argsort(keys, kind='stable')
+        self.__sorted_keys = keys[self.__order]
+
+    def within(self, positions):
+        """Mask of the positions lying strictly closer than cutoff to any center."""
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        mask = np.zeros(len(positions), dtype=bool)
+        for position_idx, _ in self.pairs(positions, mask):
+            mask[position_idx] = True
+        return mask
+
+    def pairs(self, positions, skip=None):
+        """Yield (position indices, center indices) chunks of every pair closer than cutoff.
+
+        Positions flagged in the optional skip mask are left out. The mask is
+        re-read for each neighbor cell offset, so callers can grow it while iterating.
+        """
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        if len(self.centers) == 0 or len(positions) == 0:
+            return
+        cells = self.__cells(positions) + 2
+        near = np.all((cells >= 1) & (cells <= self.__dims - 2), axis=1)
+        candidates = np.flatnonzero(near)
+        cells = cells[candidates]
+
+        for offset in np.ndindex(3, 3, 3):
+            if skip is not None:
+                keep = ~skip[candidates]
+                candidates = candidates[keep]
+                cells = cells[keep]
+            if len(candidates) == 0:
+                return
+            keys = self.__keys(cells + np.array(offset) - 1)
+            starts = np.searchsorted(self.__sorted_keys, keys, side='left')
+            counts = np.searchsorted(self.__sorted_keys, keys, side='right') - starts
+            found = np.flatnonzero(counts)
+            if len(found) == 0:
+                continue
+            # split the candidates so the expanded pair arrays stay bounded
+            bounds = np.cumsum(counts[found])
+            chunk_ends = np.searchsorted(bounds, np.arange(PAIR_CHUNK_SIZE, bounds[-1], PAIR_CHUNK_SIZE), side='right')
+            for chunk in np.split(found, np.unique(chunk_ends)):
+                if len(chunk) == 0:
+                    continue
+                yield self.__chunk_pairs(positions, candidates[chunk], starts[chunk], counts[chunk])
+
+    def __chunk_pairs(self, positions, position_idx, starts, counts):
+        total = counts.sum()
+        position_idx = np.repeat(position_idx, counts)
+        run_starts = np.repeat(np.cumsum(counts) - counts, counts)
+        center_idx = self.__order[np.repeat(starts, counts) + np.arange(total) - run_starts]
+        delta = positions[position_idx] - self.centers[center_idx]
+        x = delta[:, 0]
+        y = delta[:, 1]
+        z = delta[:, 2]
+        close = x * x + y * y + z * z < self.__sqr_cutoff
+        return (position_idx[close], center_idx[close])
+
+    def __cells(self, positions):
+        return np.floor((positions - self.__origin) / self.cutoff).astype(np.int64)
+
+    def __keys(self, cells):
+        return (cells[:, 0] * self.__dims[1] + cells[:, 1]) * self.__dims[2] + cells[:, 2]
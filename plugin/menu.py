@@ -2,6 +2,8 @@ import nanome
 from nanome.util import async_callback
 import os
 
+from .process import SHELL_CUTOFF
+
 
 class MinimizationMenu():
     def __init__(self, plugin):
@@ -10,21 +12,54 @@ class MinimizationMenu():
         self.__selected_ff_btn = None
         self.__nb_steps = 2500
         self.__steepest_descent = True
+        self.__protocol = False
+        self.__all_frames = False
+        self.__cutoff = SHELL_CUTOFF
         self.__steepest_descent_btn = None
         self.__conjugate_gradient_btn = None
+        self.__protocol_btn = None
+        self.__all_frames_btn = None
         self.__steps_label = None
         self.__start_btn = None
+        self.__replay_btn = None
+        self.__export_btn = None
         self.__running = False
+        self.__queue_position = None
+        self.__progress = None
 
     def __update_start_btn(self, running):
         self.__start_btn.selected = running
+        if self.__queue_position is not None:
+            text = "Queued (%d)" % (self.__queue_position + 1)
+        elif self.__progress is not None:
+            text = "Stop Minimizing (%d/%d)" % self.__progress
+        else:
+            text = "Stop Minimizing"
+        self.__start_btn.text.value.selected = text
+        self.__start_btn.text.value.selected_highlighted = text
         self.__plugin.update_content(self.__start_btn)
         self.__plugin.set_run_status(running)
 
     def change_running_status(self, running):
         self.__running = running
+        if not running:
+            self.__queue_position = None
+            self.__progress = None
         self.__update_start_btn(running)
 
+    def change_queue_position(self, position):
+        self.__queue_position = position
+        self.__update_start_btn(self.__running)
+
+    def change_progress(self, done, total):
+        self.__progress = (done, total)
+        self.__update_start_btn(self.__running)
+
+    def change_recording_status(self, available):
+        for btn in (self.__replay_btn, self.__export_btn):
+            btn.unusable = not available
+            self.__plugin.update_content(btn)
+
     def toggle_minimization(self):
         if self.__plugin._process.is_running:
             self.stop_minimization()
@@ -34,7 +69,7 @@ class MinimizationMenu():
     @async_callback
     async def start_minimization(self):
         self.change_running_status(True)
-        await self.__plugin.start_minimization(self.__get_selected_forcefield(), self.__nb_steps, self.__steepest_descent)
+        await self.__plugin.start_minimization(self.__get_selected_forcefield(), self.__nb_steps, self.__steepest_descent, self.__cutoff, protocol=self.__protocol, all_frames=self.__all_frames)
 
     def stop_minimization(self):
         self.change_running_status(False)
@@ -63,23 +98,29 @@ class MinimizationMenu():
             self.__steps_label.text_value = str(self.__nb_steps)
             self.__plugin.update_content(self.__steps_label)
 
-        def switch_steepest(btn):
-            self.__steepest_descent = not self.__steepest_descent
-            btn.selected = self.__steepest_descent
-            self.__plugin.update_content(btn)
-            self.__conjugate_gradient_btn.selected = not self.__steepest_descent
-            self.__plugin.update_content(self.__conjugate_gradient_btn)
+        def select_method(btn):
+            self.__steepest_descent = btn is self.__steepest_descent_btn
+            self.__protocol = btn is self.__protocol_btn
+            for method_btn in (self.__steepest_descent_btn, self.__conjugate_gradient_btn, self.__protocol_btn):
+                method_btn.selected = method_btn is btn
+                self.__plugin.update_content(method_btn)
 
-        def switch_conjugate_gradient(btn):
-            self.__steepest_descent = not self.__steepest_descent
-            btn.selected = not self.__steepest_descent
+        def toggle_all_frames(btn):
+            self.__all_frames = not self.__all_frames
+            btn.selected = self.__all_frames
             self.__plugin.update_content(btn)
-            self.__steepest_descent_btn.selected = self.__steepest_descent
-            self.__plugin.update_content(self.__steepest_descent_btn)
 
         def switch_minimization(btn):
             self.toggle_minimization()
 
+        @async_callback
+        async def replay(btn):
+            await self.__plugin.replay_minimization()
+
+        @async_callback
+        async def export(btn):
+            await self.__plugin.export_minimization()
+
         # loading menus
         menu = nanome.ui.Menu.io.from_json(os.path.join(os.path.dirname(__file__), "minimization_menu.json"))
         self.__menu = menu
@@ -88,6 +129,8 @@ class MinimizationMenu():
         # getting elements, for future update
         self.__steps_label = menu.root.find_node("steps_label", True).get_content()
         self.__start_btn = menu.root.find_node("start", True).get_content()
+        self.__replay_btn = menu.root.find_node("replay", True).get_content()
+        self.__export_btn = menu.root.find_node("export", True).get_content()
 
         # setting callbacks
         menu.root.find_node("general_amber", True).get_content().register_pressed_callback(ff_selected)
@@ -101,13 +144,21 @@ class MinimizationMenu():
         menu.root.find_node("add_steps", True).get_content().register_pressed_callback(change_steps)
         menu.root.find_node("remove_steps", True).get_content().register_pressed_callback(change_steps)
         self.__steepest_descent_btn = menu.root.find_node("steepest", True).get_content()
-        self.__steepest_descent_btn.register_pressed_callback(switch_steepest)
+        self.__steepest_descent_btn.register_pressed_callback(select_method)
         self.__steepest_descent_btn.selected = True
         self.__conjugate_gradient_btn = menu.root.find_node("CG", True).get_content()
-        self.__conjugate_gradient_btn.register_pressed_callback(switch_conjugate_gradient)
+        self.__conjugate_gradient_btn.register_pressed_callback(select_method)
         self.__conjugate_gradient_btn.selected = False
+        self.__protocol_btn = menu.root.find_node("protocol", True).get_content()
+        self.__protocol_btn.register_pressed_callback(select_method)
+        self.__protocol_btn.selected = False
+        self.__all_frames_btn = menu.root.find_node("all_frames", True).get_content()
+        self.__all_frames_btn.register_pressed_callback(toggle_all_frames)
+        self.__all_frames_btn.selected = False
 
         self.__start_btn.register_pressed_callback(switch_minimization)
+        self.__replay_btn.register_pressed_callback(replay)
+        self.__export_btn.register_pressed_callback(export)
 
     def __get_selected_forcefield(self):
         if self.__selected_ff_btn == None:
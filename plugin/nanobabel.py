@@ -0,0 +1,255 @@
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from nanome.util import Logs
+
+from .cache import TrajectoryRecorder
+from .convergence import CONVERGENCE_WINDOW, ENERGY_THRESHOLD, PREPASS_MAX_STEPS, ConvergenceMonitor
+from .frames import FrameDecoder, StepParser
+from .streaming import FrameQueue
+
+IS_WIN = sys.platform.startswith('win')
+READ_CHUNK_SIZE = 1 << 16
+# seconds nanobabel gets to exit after being terminated, before it is killed
+TERMINATE_TIMEOUT = 2
+# nanobabel's files go to memory backed storage where there is some
+SCRATCH_DIR = '/dev/shm' if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK) else None
+
+
+class NanobabelRun():
+    """One nanobabel minimization of a prepared system, and the frames it streams back.
+
+    on_frame is called, without arguments, every time a new frame is queued.
+    Once the energy log shows convergence, nanobabel is stopped right after
+    its next frame, which is still streamed. The run's files live in their own
+    directory under temp_dir, removed once the run is over.
+
+    A protocol run starts with a steepest descent pre-pass, stopped the same
+    way once its energy stops dropping quickly, and carries on with conjugate
+    gradients from the pre-pass's last frame, so the stream never jumps back.
+    """
+
+    def __init__(self, system, temp_dir, coalesce_frames=True, on_frame=None, energy_threshold=ENERGY_THRESHOLD, convergence_window=CONVERGENCE_WINDOW):
+        self.system = system
+        self.frames = FrameQueue(coalesce_frames)
+        self.decoder = FrameDecoder(system.serials, system.complexes, system.positions)
+        self.trajectory = TrajectoryRecorder()
+        self.convergence = ConvergenceMonitor(energy_threshold, convergence_window)
+        self.on_frame = on_frame or (lambda: None)
+        self.is_running = False
+        self.is_done = False
+        self.return_code = None
+        # perf_counter times of the spawn, first output and exit of nanobabel
+        self.started_at = None
+        self.first_output_at = None
+        self.finished_at = None
+        self.parse_seconds = 0.0
+        self.__stopping = False
+        self.__prepass = False
+        self.__last_frame = None
+        self.__parser = None
+        self.__process = None
+
+        self.run_dir = None
+        try:
+            self.__write_inputs(temp_dir)
+        except OSError as e:
+            if temp_dir is None:
+                raise
+            # memory backed scratch space is small, the regular temp directory still takes large systems
+            Logs.warning(f"Could not write nanobabel input files to {temp_dir}, using {tempfile.gettempdir()}: {e}")
+            self.__write_inputs(None)
+        Logs.debug("Wrote input files to", self.run_dir)
+
+    @property
+    def has_frames(self):
+        return len(self.frames) > 0
+
+    @property
+    def succeeded(self):
+        return self.return_code == 0 or self.convergence.is_converged
+
+    def pop_positions(self):
+        """Decode the next queued frame into stream positions, recording it in trajectory."""
+        positions = self.decoder.decode(self.frames.pop())
+        self.trajectory.add(self.decoder.workspace_positions)
+        return positions
+
+    def args(self, ff, steps, steepest):
+        args = ['minimize', '-h', '-l', '20', '-n', str(steps), '-ff', ff, '-i', self.input_path, '-cx', self.constraints_path, '-o', self.output_path]
+        if IS_WIN:
+            args += ['-dd', 'data']
+        if steepest:
+            args.append('-sd')
+        return args
+
+    async def run(self, nanobabel_dir, ff, steps, steepest, cpu=None, protocol=False):
+        """Run nanobabel to completion, queuing frames as soon as they are read.
+
+        When cpu is given, nanobabel is pinned to it where the platform allows.
+        With protocol, steepest is ignored for the pre-pass and refinement.
+        Cancelling the task running this coroutine terminates nanobabel and
+        waits for it to exit.
+        """
+        exe = 'nanobabel.exe' if IS_WIN else 'nanobabel'
+        exe_path = os.path.join(nanobabel_dir, exe)
+
+        self.is_running = True
+        self.started_at = time.perf_counter()
+        try:
+            if not protocol:
+                await self.__run_stage(exe_path, self.args(ff, steps, steepest), cpu)
+            else:
+                await self.__run_stage(exe_path, self.args(ff, min(steps, PREPASS_MAX_STEPS), True), cpu, prepass=True)
+                done_steps = self.convergence.steps[-1] if len(self.convergence.steps) > 0 else 0
+                if not self.is_done and not self.convergence.is_converged and self.__last_frame is not None and done_steps < steps:
+                    Logs.debug(f"Switching to conjugate gradients at step {done_steps}, energy {self.convergence.energy}")
+                    self.__write_handover()
+                    self.convergence.step_offset = done_steps
+                    await self.__run_stage(exe_path, self.args(ff, steps - done_steps, False), cpu)
+        finally:
+            try:
+                await self.__terminate()
+            finally:
+                self.finished_at = time.perf_counter()
+                self.is_running = False
+                self.is_done = True
+                self.cleanup()
+        return self.return_code
+
+    def stop(self):
+        """Stop the run, terminating nanobabel if it still runs.
+
+        Returns a future done once nanobabel exited and the run's files are
+        removed, None when nanobabel was not running.
+        """
+        self.is_done = True
+        self.frames.clear()
+        if not self.is_running:
+            self.cleanup()
+            return None
+        return asyncio.ensure_future(self.__exit())
+
+    def cleanup(self):
+        """Remove the run's files. Safe to call more than once."""
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+
+    def __write_inputs(self, temp_dir):
+        self.run_dir = tempfile.mkdtemp(prefix='nanobabel-', dir=temp_dir)
+        self.input_path = os.path.join(self.run_dir, 'input.sdf')
+        self.constraints_path = os.path.join(self.run_dir, 'constraints.txt')
+        self.output_path = os.path.join(self.run_dir, 'output.pdb')
+        try:
+            self.system.write_sdf(self.input_path)
+            self.system.write_constraints(self.constraints_path)
+        except OSError:
+            self.cleanup()
+            raise
+
+    async def __run_stage(self, exe_path, args, cpu, prepass=False):
+        Logs.debug(args)
+        self.__prepass = prepass
+        self.__stopping = False
+        self.__parser = StepParser(self.__on_frame, self.__on_text)
+        self.__process = await asyncio.create_subprocess_exec(
+            exe_path, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        if cpu is not None:
+            self.__pin(cpu)
+        readers = [asyncio.ensure_future(self.__read_output()), asyncio.ensure_future(self.__read_errors())]
+        try:
+            await asyncio.gather(*readers)
+        finally:
+            # a failed reader leaves the pipes to __terminate, which drains them
+            for reader in readers:
+                reader.cancel()
+            await asyncio.gather(*readers, return_exceptions=True)
+        self.return_code = await self.__process.wait()
+        self.__parser.flush()
+
+    def __write_handover(self):
+        decoder = FrameDecoder(self.system.serials, self.system.complexes, self.system.positions)
+        decoder.decode(self.__last_frame)
+        self.system.moved_to(decoder.workspace_positions).write_sdf(self.input_path)
+
+    def __pin(self, cpu):
+        if not hasattr(os, 'sched_setaffinity'):
+            return
+        try:
+            os.sched_setaffinity(self.__process.pid, {cpu})
+        except OSError as e:
+            Logs.warning(f"Could not pin nanobabel to CPU {cpu}: {e}")
+
+    async def __read_output(self):
+        stdout = self.__process.stdout
+        while True:
+            chunk = await stdout.read(READ_CHUNK_SIZE)
+            if not chunk:
+                return
+            start = time.perf_counter()
+            if self.first_output_at is None:
+                self.first_output_at = start
+            self.__parser.feed(chunk)
+            self.parse_seconds += time.perf_counter() - start
+
+    async def __read_errors(self):
+        error = await self.__process.stderr.read()
+        if error:
+            Logs.warning('Error in nanobabel process:')
+            Logs.warning(error.decode(errors='replace'))
+
+    async def __terminate(self):
+        process = self.__process
+        if process is None or process.returncode is not None:
+            return
+        try:
+            process.terminate()
+        except ProcessLookupError:
+            pass
+        try:
+            # drain the pipes as well, so their transports close with the process
+            await asyncio.wait_for(process.communicate(), TERMINATE_TIMEOUT)
+        except asyncio.TimeoutError:
+            process.kill()
+            await process.wait()
+
+    async def __exit(self):
+        process = self.__process
+        if process is not None and process.returncode is None:
+            try:
+                process.terminate()
+            except ProcessLookupError:
+                pass
+            # the pipes are left to the run reading them, which sees them close
+            try:
+                await asyncio.wait_for(process.wait(), TERMINATE_TIMEOUT)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+        self.cleanup()
+
+    def __on_text(self, text):
+        if self.__stopping:
+            return
+        was_converged = self.convergence.is_converged
+        if self.convergence.feed(text) and not was_converged:
+            Logs.debug(f"Minimization converged at step {self.convergence.converged_step}, energy {self.convergence.energy}")
+
+    def __on_frame(self, frame):
+        if self.is_done or self.__stopping:
+            return
+        self.frames.push(frame)
+        self.on_frame()
+        self.__last_frame = frame
+        if self.convergence.is_converged or (self.__prepass and self.convergence.prepass_over()):
+            # this frame is the result, or the refinement's start, whatever nanobabel prints until it exits
+            self.__stopping = True
+            if self.__process is not None and self.__process.returncode is None:
+                try:
+                    self.__process.terminate()
+                except ProcessLookupError:
+                    pass
@@ -1,244 +1,624 @@
+import asyncio
 import time
-import nanome
-from nanome.util import Logs, Octree, Process
-from nanome.api.structure import Complex
+from nanome.util import Logs, Vector3
 from nanome.util.stream import StreamCreationError
 from nanome.util.enums import StreamType
 
 import tempfile
-from collections import deque
 from functools import partial
 import os
-import sys
+import numpy as np
 
-PACKET_QUEUE_LEN = 20
+from .cache import CachedRun, ResultCache, system_key
+from .convergence import CONVERGENCE_WINDOW, ENERGY_THRESHOLD
+from .engine import EngineRun
+from .nanobabel import SCRATCH_DIR, NanobabelRun
+from .recording import DELTA_ENCODING, EXPORT_FRAMES, TrajectoryReader, TrajectoryWriter, export_frames
+from .scheduler import MENU_PRIORITY, RunScheduler, SchedulerClient
+from .streaming import FlowControl, TARGET_UPDATE_RATE
+from .system import ComplexFrame, TopologyCache, WarmStart, all_frames, assemble_system, displayed_frames, interaction_cutoff, prepare_system, split_clusters
+from .telemetry import MetricsStore, ProfileCapture, RunTelemetry
 
-IS_WIN = sys.platform.startswith('win')
-SDFOPTIONS = Complex.io.SDFSaveOptions()
-SDFOPTIONS.write_bonds = True
+SHELL_CUTOFF = 7
+MAX_PARALLEL_RUNS = os.cpu_count() or 1
+NANOBABEL_ENGINE = 'nanobabel'
+NUMPY_ENGINE = 'numpy'
+ENGINES = (NANOBABEL_ENGINE, NUMPY_ENGINE)
 
-# hack to fix convert_to_frames killing atom indices:
-_atom_shallow_copy = nanome._internal.structure._Atom._shallow_copy
 
-
-def _atom_shallow_copy_fix(self, *args):
-    atom = _atom_shallow_copy(self, *args)
-    atom._index = self._index
-    return atom
-
-
-nanome._internal.structure._Atom._shallow_copy = _atom_shallow_copy_fix
+def engine_interaction_cutoff(ff, engine):
+    """Distance past which fixed atoms no longer interact with movable ones, for ff on engine."""
+    # the numpy engine leaves electrostatics out whatever the force field
+    return interaction_cutoff('Uff' if engine == NUMPY_ENGINE else ff)
 
 
 class MinimizationProcess():
-    def __init__(self, plugin, nanobabel_dir):
+    def __init__(self, plugin, nanobabel_dir, coalesce_frames=True, target_update_rate=TARGET_UPDATE_RATE, max_parallel_runs=MAX_PARALLEL_RUNS, scheduler=None, cache=None, cache_trajectory=True, energy_threshold=ENERGY_THRESHOLD, convergence_window=CONVERGENCE_WINDOW, metrics=None, engine=None, warm_start=True, record_directory=None, record_encoding=DELTA_ENCODING):
         self.__plugin = plugin
+        # without nanobabel, minimizations run in process
+        self.engine = engine or (NANOBABEL_ENGINE if nanobabel_dir is not None else NUMPY_ENGINE)
         self.is_running = False
-        self.__process_running = False
         self.__stream = None
-        self.__data_queue = []
+        self.coalesce_frames = coalesce_frames
+        self.target_update_rate = target_update_rate
+        self.max_parallel_runs = max_parallel_runs
+        # without a server wide scheduler, only this session's runs are limited
+        self.__scheduler = SchedulerClient(scheduler if scheduler is not None else RunScheduler())
+        self.__queued = False
+        self.__cache = cache if cache is not None else ResultCache()
+        self.cache_trajectory = cache_trajectory
+        self.energy_threshold = energy_threshold
+        self.convergence_window = convergence_window
+        self.__runs = []
+        # restarts resume from where the last minimization left the atoms the user did not move
+        self.warm_start = warm_start
+        self.__warm_start = None
+        self.__cutoff = None
+        self.__protocol = False
+        # bonds of the complexes minimized before, rebuilt only when their structure changes
+        self.__topologies = TopologyCache()
+        self.__flow_control = FlowControl(target_update_rate)
+        self.__packet_id = 0
+        self.__task = None
+        self.metrics = metrics if metrics is not None else MetricsStore()
+        self.telemetry = None
+        self.__profile_directory = None
+        self.__profile = None
+        # with a directory, every minimization's frames are recorded there, to replay or export them
+        self.record_directory = record_directory
+        self.record_encoding = record_encoding
+        self.recording = None
+        self.__recorder = None
+        self.__replay = None
         self.__nanobabel_dir = nanobabel_dir
-        self.temp_dir = tempfile.TemporaryDirectory()
-
-    async def start_process(self, workspace, ff, steps, steepest):
+        self.temp_dir = tempfile.TemporaryDirectory(dir=SCRATCH_DIR)
+
+    def capture_profile(self, directory):
+        """Profile the next minimization, writing its cProfile stats and tracemalloc snapshot to directory."""
+        self.__profile_directory = directory
+
+    async def start_process(self, workspace, ff, steps, steepest, cutoff=SHELL_CUTOFF, priority=MENU_PRIORITY, requested_at=None, engine=None, protocol=False):
+        """requested_at is the perf_counter time the workspace was requested at, to time its fetch.
+
+        engine is one of ENGINES, the process's own engine by default. With
+        protocol, steepest is ignored: each run starts with a steepest descent
+        pre-pass and switches to conjugate gradients once the energy stops
+        dropping quickly, all within steps.
+        """
+        engine = self.__check_engine(engine, ff)
+        if engine is None:
+            return
+        telemetry = RunTelemetry(requested_at)
+        self.__start_profile()
         if sum(1 for _ in workspace.complexes) == 0:
             Logs.message('No structures to minimize')
+            self.__stop_profile()
             return
-        input_file = tempfile.NamedTemporaryFile(delete=False, suffix='.sdf', dir=self.temp_dir.name)
-        constraints_file = tempfile.NamedTemporaryFile(delete=False, suffix='.txt', dir=self.temp_dir.name)
-        output_file = tempfile.NamedTemporaryFile(delete=False, suffix='.pdb', dir=self.temp_dir.name)
-        self.__output_lines = []
-        self.__updates_done = {}
-        self.__packet_id = 0
 
-        (saved_atoms, indices) = self.__save__atoms(input_file.name, workspace)
-        Logs.debug("Wrote input file:", input_file.name)
-        self.__save__constraints(constraints_file.name, saved_atoms)
-        Logs.debug("Wrote constraints file:", constraints_file.name)
+        try:
+            runs = self.__save__atoms(workspace, cutoff, ff, steps, steepest, engine, protocol)
+        except OSError as e:
+            Logs.error(f"Could not write nanobabel input files: {e}")
+            self.__stop_profile()
+            self.__plugin.minimization_done()
+            return
+        telemetry.mark('atoms_saved')
+        indices = [index for run in runs for index in run.system.indices]
         self.__stream, error = await self.__plugin.create_writing_stream(indices, StreamType.position)
+        telemetry.mark('stream_created')
+
+        if error != StreamCreationError.NoError:
+            # the runs never start, so their input files go now
+            for run in runs:
+                run.stop()
 
         if error == StreamCreationError.AtomNotFound:
             # User deleted atom in time between start_process() and create_writing_stream().
             # so lets update the workspace and try again
             Logs.warning(f"User deleted atoms while setting up process, retrying")
             updated_workspace = await self.__plugin.request_workspace()
-            await self.start_process(updated_workspace, ff, steps, steepest)
+            await self.start_process(updated_workspace, ff, steps, steepest, cutoff, priority, telemetry.requested_at, engine, protocol)
             return
 
         elif error != StreamCreationError.NoError:
             Logs.error(f"Error while creating stream: {error}")
+            self.__stop_profile()
+            self.__plugin.minimization_done()
             return
 
-        self.__data_queue = deque()
-        cwd_path = self.__nanobabel_dir
-        exe = 'nanobabel.exe' if IS_WIN else 'nanobabel'
-        exe_path = os.path.join(cwd_path, exe)
-        args = ['minimize', '-h', '-l', '20', '-n', str(steps), '-ff', ff, '-i', input_file.name, '-cx', constraints_file.name, '-o', output_file.name]
-        if IS_WIN:
-            args += ['-dd', 'data']
-        if steepest:
-            args.append('-sd')
-        Logs.debug(args)
-
-        p = Process(exe_path, args, True)
-        p.on_error = self.__on_process_error
-        p.on_output = self.__on_process_output
-        p.on_done = self.__on_process_done
+        self.telemetry = telemetry
+        self.__runs = runs
+        # replaced once the runs end, where they left the atoms
+        self.__warm_start = None
+        self.__cutoff = cutoff
+        self.__protocol = protocol
+        self.__flow_control = FlowControl(self.target_update_rate)
+        # every run streams into its own slice of the positions sent to Nanome
+        self.__positions = np.concatenate([run.decoder.positions for run in runs])
+        self.__run_slices = []
+        offset = 0
+        for run in runs:
+            self.__run_slices.append(slice(offset, offset + len(run.decoder.positions)))
+            offset += len(run.decoder.positions)
+        self.__recorder = self.__start_recording(runs, indices)
+
         self.calculation_start_time = time.time()
         log_data = {
-            'exe_path': exe_path,
+            'engine': engine,
             'force_field': ff,
             'steps': steps,
-            'steepest': steepest
+            'steepest': steepest,
+            'protocol': protocol,
+            'cutoff': cutoff,
+            'atom_count': len(indices),
+            'cluster_count': len(runs),
+            'cached_count': sum(1 for run in runs if isinstance(run, CachedRun)),
+            'priority': priority
         }
         Logs.message("Starting Minimization Process", extra=log_data)
-        p.start()
+        self.__frame_ready = asyncio.Event()
+        self.__acked = asyncio.Event()
+        self.is_running = True
+        self.__queued = False
+        self.__task = asyncio.ensure_future(self.__run((ff, steps, steepest), priority))
+        self.__task.add_done_callback(self.__on_done)
+
+    async def start_frames(self, workspace, ff, steps, steepest, cutoff=SHELL_CUTOFF, priority=MENU_PRIORITY, engine=None, protocol=False):
+        """Minimize every frame of the complexes holding the selection, writing the results back as those frames.
+
+        Each frame is minimized with the other complexes fixed as displayed.
+        Frames made of other atoms than the displayed one, like poses stored
+        as molecules, move the atoms selected in the displayed frame when they
+        have as many. Runs of every frame share max_parallel_runs and the
+        server wide queue, nothing is streamed, and the complexes are updated
+        once all of them are done.
+        """
+        engine = self.__check_engine(engine, ff)
+        if engine is None:
+            return
+        start = time.perf_counter()
+        try:
+            jobs = self.__save_frames(workspace, cutoff, ff, steps, steepest, engine, protocol)
+        except OSError as e:
+            Logs.error(f"Could not write nanobabel input files: {e}")
+            self.__plugin.minimization_done()
+            return
+        if len(jobs) == 0:
+            Logs.message('No frames to minimize')
+            self.__plugin.minimization_done()
+            return
 
-        self.__process = p
-        self.__process_running = True
+        self.__runs = [run for _, runs in jobs for run in runs]
+        self.__protocol = protocol
+        # frames move atoms the warm start knows nothing about
+        self.__warm_start = None
+        self.__frames_done = 0
+        log_data = {
+            'engine': engine,
+            'force_field': ff,
+            'steps': steps,
+            'steepest': steepest,
+            'protocol': protocol,
+            'cutoff': cutoff,
+            'frame_count': len(jobs),
+            'cluster_count': len(self.__runs),
+            'cached_count': sum(1 for run in self.__runs if isinstance(run, CachedRun)),
+            'save_atoms_seconds': time.perf_counter() - start,
+            'priority': priority
+        }
+        Logs.message("Starting Frames Minimization", extra=log_data)
         self.is_running = True
+        self.__queued = False
+        self.__task = asyncio.ensure_future(self.__run_frames(jobs, (ff, steps, steepest), priority))
+        self.__task.add_done_callback(partial(self.__on_frames_done, jobs, start))
 
     def stop_process(self):
-        if self.__process_running:
-            self.__process.stop()
-        if self.__stream is not None:
-            self.__stream.destroy()
-            self.__stream = None
-        self.is_running = False
-        self.__plugin.minimization_done()
-
-    def update(self):
-        if not self.is_running or \
-                self.__packet_id > PACKET_QUEUE_LEN and \
-                not self.__updates_done[self.__packet_id - PACKET_QUEUE_LEN]:
-            return
+        """Cancel the running minimization.
+
+        Returns a future done once every nanobabel process exited and the stream is destroyed.
+        """
+        if self.__replay is not None:
+            self.__replay.cancel()
+        task = self.__task
+        if task is None or task.done():
+            self.is_running = False
+            self.__plugin.minimization_done()
+        else:
+            task.cancel()
+        return asyncio.ensure_future(self.__wait(task))
+
+    async def wait(self):
+        """Wait until the current minimization completes or is cancelled."""
+        await self.__wait(self.__task)
+
+    @property
+    def stream_stats(self):
+        return {
+            'frames_received': sum(run.frames.received for run in self.__runs),
+            'frames_sent': self.__flow_control.sent,
+            'frames_coalesced': sum(run.frames.coalesced for run in self.__runs),
+            'frames_dropped': sum(run.frames.dropped for run in self.__runs),
+            'frames_in_flight': self.__flow_control.in_flight,
+            'window': self.__flow_control.window,
+            'round_trip_time': self.__flow_control.round_trip_time
+        }
 
-        if len(self.__data_queue) > 0:
-            data_chunk = self.__data_queue.popleft()
-            complex = nanome.api.structure.Complex.io.from_pdb(lines=data_chunk)
-            self.__match_and_move(complex)
-        elif not self.__process_running:
+    async def __wait(self, task):
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def __run(self, run_args, priority):
+        limit = asyncio.Semaphore(self.max_parallel_runs)
+        runs = asyncio.ensure_future(self.__run_together(self.__run_limited(limit, run, run_args, priority) for run in self.__runs))
+        sender = asyncio.ensure_future(self.__send_frames())
+        try:
+            await asyncio.wait([runs, sender], return_when=asyncio.FIRST_COMPLETED)
+            # nothing reaches the workspace once the sender failed, so the runs stop with it
+            if sender.done() and sender.exception() is not None:
+                runs.cancel()
+                sender.result()
+            await runs
+            self.__frame_ready.set()
+            await sender
+            self.__cache_results()
             Logs.debug('Minimization complete')
-            self.stop_process()
-
-    def __on_process_error(self, error):
-        Logs.warning('Error in nanobabel process:')
-        Logs.warning(error)
-
-    def __on_process_output(self, output):
-        output = output.strip()
-        if output != '':
-            split_output = output.split('\n')
-            self.__processing_output(split_output)
-
-    def __on_process_done(self, code):
-        self.__process_running = False
-
-    def __match_and_move(self, complex):
-        positions = [0] * (len(self.__atom_position_index_by_serial) * 3)
-        for atom in complex.atoms:
-            if atom.serial in self.__atom_position_index_by_serial:
-                (idx, complex) = self.__atom_position_index_by_serial[atom.serial]
-                complex_absolute_to_relative = complex.get_workspace_to_complex_matrix()
-                atom_relative_pos = complex_absolute_to_relative * atom.position
-                positions[idx * 3] = atom_relative_pos.x
-                positions[idx * 3 + 1] = atom_relative_pos.y
-                positions[idx * 3 + 2] = atom_relative_pos.z
+        finally:
+            sender.cancel()
+            if not runs.done():
+                # stopping only returns once every run really ended
+                runs.cancel()
+                await asyncio.gather(runs, return_exceptions=True)
+            if self.warm_start:
+                self.__keep_resume_point()
+
+    async def __run_together(self, coroutines):
+        """Run coroutines concurrently. Once one fails, or this is cancelled, the others are cancelled and waited for."""
+        tasks = [asyncio.ensure_future(coroutine) for coroutine in coroutines]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in tasks:
+                if task.done():
+                    task.result()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def __run_frames(self, jobs, run_args, priority):
+        limit = asyncio.Semaphore(self.max_parallel_runs)
+        self.__plugin.minimization_progress(0, len(jobs))
+        await self.__run_together(self.__run_frame(limit, runs, run_args, priority, len(jobs)) for _, runs in jobs)
+        self.__cache_results()
+        complexes = self.__write_frames(jobs)
+        await self.__plugin.update_structures_deep(complexes)
+        Logs.debug('Frames minimization complete')
+
+    async def __run_frame(self, limit, runs, run_args, priority, frame_count):
+        await self.__run_together(self.__run_limited(limit, run, run_args, priority) for run in runs)
+        # only the newest frame of each run is kept, and recorded for the cache
+        for run in runs:
+            while run.has_frames:
+                run.pop_positions()
+        self.__frames_done += 1
+        self.__plugin.minimization_progress(self.__frames_done, frame_count)
+
+    def __write_frames(self, jobs):
+        """Move the movable atoms of every frame where its runs left them, returning the complexes changed."""
+        complexes = []
+        for frame, runs in jobs:
+            for run in runs:
+                if not isinstance(run, CachedRun) and not run.succeeded:
+                    continue
+                positions = run.decoder.positions.reshape(-1, 3).tolist()
+                for atom, selected, position in zip(run.system.atoms, run.system.selected.tolist(), positions):
+                    if selected:
+                        atom.positions[frame.conformer] = Vector3(*position)
+            if frame.complex not in complexes:
+                complexes.append(frame.complex)
+        return complexes
+
+    def __on_frames_done(self, jobs, start, task):
+        try:
+            self.__log_failure(task)
+            for run in self.__runs:
+                run.stop()
+            summary = {
+                'frame_count': len(jobs),
+                'frames_done': self.__frames_done,
+                'failed_count': sum(1 for run in self.__runs if not isinstance(run, CachedRun) and run.is_done and not run.succeeded),
+                'total_seconds': time.perf_counter() - start,
+                'cancelled': task.cancelled()
+            }
+            Logs.message("Frames Minimization Finished", extra=summary)
+        finally:
+            self.is_running = False
+            self.__plugin.minimization_done()
+
+    def __on_done(self, task):
+        # also reached when the task is cancelled before it got to run
+        try:
+            self.__log_failure(task)
+            for run in self.__runs:
+                run.stop()
+            if self.__stream is not None:
+                self.__stream.destroy()
+                self.__stream = None
+            summary = self.telemetry.summary(self.__runs, self.__flow_control)
+            summary['cancelled'] = task.cancelled()
+            if self.__recorder is not None:
+                self.__recorder.close()
+                self.recording = self.__recorder.path
+                self.__recorder = None
+                summary['recording'] = self.recording
+            profile_files = self.__stop_profile()
+            if profile_files is not None:
+                summary['profile_files'] = profile_files
+            self.metrics.add(summary)
+            Logs.message("Minimization Process Finished", extra=summary)
+        finally:
+            self.is_running = False
+            self.__plugin.minimization_done()
+
+    def __log_failure(self, task):
+        if task.cancelled():
+            return
+        try:
+            task.result()
+        except Exception:
+            Logs.error("Minimization failed")
+
+    def __keep_resume_point(self):
+        warm_start = WarmStart(self.__cutoff)
+        try:
+            for run in self.__runs:
+                sent = run.decoder.workspace_positions.copy()
+                # frames computed but never streamed are still worth resuming from
+                while run.has_frames:
+                    run.pop_positions()
+                warm_start.add(run.system, sent, run.decoder.workspace_positions.copy())
+        except Exception:
+            Logs.warning("Could not keep where the minimization left the atoms")
+            warm_start = None
+        self.__warm_start = warm_start
+
+    async def replay(self, path=None):
+        """Stream the frames of a recording, the last one by default, back onto the workspace.
+
+        Frames are sent at the target update rate, each once the previous one
+        was applied. Returns whether the replay went through.
+        """
+        path = path or self.recording
+        if path is None or self.is_running or self.__replay is not None:
+            return False
+        reader = TrajectoryReader(path)
+        stream, error = await self.__plugin.create_writing_stream(reader.indices.tolist(), StreamType.position)
+        if error != StreamCreationError.NoError:
+            Logs.error(f"Error while creating replay stream: {error}")
+            return False
+        self.__replay = asyncio.ensure_future(self.__replay_frames(reader, stream))
+        try:
+            await self.__replay
+        except asyncio.CancelledError:
+            return False
+        finally:
+            self.__replay = None
+            stream.destroy()
+        return True
+
+    async def export_recording(self, path=None, max_frames=EXPORT_FRAMES):
+        """Add a copy of every complex of a recording, the last one by default, to the workspace, with the recorded frames as conformers."""
+        path = path or self.recording
+        if path is None:
+            return []
+        reader = TrajectoryReader(path)
+        if len(reader) == 0:
+            return []
+        complexes = await self.__plugin.request_complexes(sorted(set(reader.complex_indices.tolist())))
+        exported = [export_frames(reader, complex, max_frames) for complex in complexes if complex is not None]
+        if len(exported) > 0:
+            await self.__plugin.add_to_workspace(exported)
+        return exported
+
+    async def __replay_frames(self, reader, stream):
+        loop = asyncio.get_event_loop()
+        for _, positions in reader.frames():
+            applied = loop.create_future()
+            stream.update(positions.tolist(), lambda applied=applied: applied.done() or applied.set_result(None))
+            await asyncio.gather(applied, asyncio.sleep(1.0 / self.target_update_rate))
+
+    def __start_recording(self, runs, indices):
+        if self.record_directory is None:
+            return None
+        complex_indices = [complex.index for run in runs for complex in run.system.complexes]
+        try:
+            os.makedirs(self.record_directory, exist_ok=True)
+            fd, path = tempfile.mkstemp(prefix='minimization-', suffix='.traj', dir=self.record_directory)
+            os.close(fd)
+            return TrajectoryWriter(path, indices, complex_indices, self.__positions, self.record_encoding)
+        except OSError as e:
+            Logs.warning(f"Could not record minimization: {e}")
+            return None
+
+    def __record(self):
+        # cached results carry no energies
+        monitors = [run.convergence for run in self.__runs if not isinstance(run, CachedRun) and len(run.convergence.steps) > 0]
+        step = max((monitor.steps[-1] for monitor in monitors), default=-1)
+        energy = sum(monitor.energy for monitor in monitors) if len(monitors) > 0 else None
+        try:
+            self.__recorder.append(self.__positions, step, energy)
+        except OSError as e:
+            Logs.warning(f"Could not record frame, recording stopped: {e}")
+            self.__recorder.close()
+            self.__recorder = None
+
+    def __start_profile(self):
+        # a retried start_process keeps profiling into the same capture
+        if self.__profile_directory is None or self.__profile is not None:
+            return
+        self.__profile = ProfileCapture(self.__profile_directory)
+        self.__profile_directory = None
+        self.__profile.start()
+
+    def __stop_profile(self):
+        if self.__profile is None:
+            return None
+        profile, self.__profile = self.__profile, None
+        try:
+            return profile.stop()
+        except OSError as e:
+            Logs.warning(f"Could not write profile: {e}")
+            return None
+
+    async def __run_limited(self, limit, run, run_args, priority):
+        async with limit:
+            if run.is_done:
+                return
+            if isinstance(run, CachedRun):
+                await run.replay(1.0 / self.target_update_rate)
+                return
+            async with self.__scheduler.slot(priority, self.__on_queue_position) as cpu:
+                if self.__queued:
+                    self.__queued = False
+                    self.__plugin.minimization_queued(None)
+                try:
+                    if isinstance(run, EngineRun):
+                        await run.run(*run_args, protocol=self.__protocol)
+                    else:
+                        await run.run(self.__nanobabel_dir, *run_args, cpu=cpu, protocol=self.__protocol)
+                except OSError as e:
+                    Logs.error(f"Could not run nanobabel: {e}")
+
+    def __on_queue_position(self, position):
+        # queue feedback only matters until the first run of this minimization starts
+        if any(run.is_running or run.is_done for run in self.__runs):
+            return
+        self.__queued = True
+        self.__plugin.minimization_queued(position)
+
+    async def __send_frames(self):
+        while True:
+            if not any(run.has_frames for run in self.__runs):
+                if all(run.is_done for run in self.__runs):
+                    return
+                self.__frame_ready.clear()
+                await self.__frame_ready.wait()
+                continue
+            await self.__wait_for_send()
+            self.__match_and_move([i for i, run in enumerate(self.__runs) if run.has_frames])
+
+    async def __wait_for_send(self):
+        while True:
+            delay = self.__flow_control.send_delay(time.time())
+            if delay == 0:
+                return
+            if delay is None:
+                self.__acked.clear()
+                await self.__acked.wait()
+            else:
+                await asyncio.sleep(delay)
+
+    def __on_frame(self):
+        self.telemetry.mark('first_frame_received')
+        self.__frame_ready.set()
+
+    def __match_and_move(self, pending):
+        queue_depth = sum(len(run.frames) for run in self.__runs)
+        start = time.perf_counter()
+        for i in pending:
+            run = self.__runs[i]
+            self.__positions[self.__run_slices[i]] = run.pop_positions()
+        self.telemetry.decode_seconds += time.perf_counter() - start
+        if self.__recorder is not None:
+            self.__record()
         if self.__stream == None:
             return
-        self.__updates_done[self.__packet_id] = False
-        self.__stream.update(positions, partial(self.__update_done, self.__packet_id))
+        self.__flow_control.on_sent(self.__packet_id, time.time())
+        self.telemetry.on_sent(queue_depth)
+        self.__stream.update(self.__positions.tolist(), partial(self.__update_done, self.__flow_control, self.telemetry, self.__packet_id))
         self.__packet_id += 1
 
-    def __update_done(self, packet_id):
-        self.__updates_done[packet_id] = True
+    def __update_done(self, flow_control, telemetry, packet_id):
+        round_trip_time = flow_control.on_acked(packet_id, time.time())
+        if round_trip_time is not None:
+            telemetry.on_acked(round_trip_time)
+        self.__acked.set()
 
-    def __processing_output(self, split_output):
-        for line in split_output:
-            if "Step update start" in line:
-                self.__output_lines.clear()
-            elif "Step update end" in line:
-                self.__data_queue.append(self.__output_lines.copy())
-            else:
-                self.__output_lines.append(line)
-
-    def __save__atoms(self, path, workspace):
-        visible_complexes = []
-        for complex in workspace.complexes:
-            if not complex.visible:
+    def __cache_results(self):
+        for run in self.__runs:
+            if isinstance(run, CachedRun) or not run.succeeded or len(run.trajectory) == 0:
                 continue
-
-            current_frame = complex.current_frame
-            if len(list(complex.molecules)) == 1:
-                current_frame = next(complex.molecules).current_conformer
-
-            complex = complex.convert_to_frames()
-            complex.current_frame = current_frame
-            visible_complexes.append(complex)
-
-        selected_atoms = Octree()
-
-        for complex in visible_complexes:
-            complex_local_to_workspace_matrix = complex.get_complex_to_workspace_matrix()
-            molecule = complex._molecules[complex.current_frame]
-
-            for atom in molecule.atoms:
-                if atom.selected is True:
-                    atom_absolute_pos = complex_local_to_workspace_matrix * atom.position
-                    selected_atoms.add(atom, atom_absolute_pos)
-
-        self.__atom_position_index_by_serial = dict()
-        atom_by_index = dict()
-        saved_atoms = []
-        saved_atoms_indices = []
-        atom_position_index = 0
-        serial = 1
-        found_atoms = []
-        bonds = []
-        result_complex = nanome.structure.Complex()
-        result_molecule = nanome.structure.Molecule()
-        result_chain = nanome.structure.Chain()
-        result_residue = nanome.structure.Residue()
-        result_complex.add_molecule(result_molecule)
-        result_molecule.add_chain(result_chain)
-        result_chain.add_residue(result_residue)
-
-        for complex in visible_complexes:
-            complex_local_to_workspace_matrix = complex.get_complex_to_workspace_matrix()
-            molecule = complex._molecules[complex.current_frame]
-
-            for atom in molecule.atoms:
-                atom_absolute_pos = complex_local_to_workspace_matrix * atom.position
-                selected_atoms.get_near_append(atom_absolute_pos, 7, found_atoms, 1)
-
-                if len(found_atoms) > 0 and atom not in saved_atoms:
-                    atom.serial = serial
-                    serial += 1
-                    self.__atom_position_index_by_serial[atom.serial] = (atom_position_index, complex)
-                    atom_position_index += 1
-                    atom.position = atom_absolute_pos
-                    saved_atoms.append(atom)
-                    saved_atoms_indices.append(atom.index)
-                    result_residue.add_atom(atom)
-                    atom_by_index[atom.index] = atom
-
-                    for bond in atom.bonds:
-                        if bond not in bonds \
-                            and bond.atom1.index in atom_by_index \
-                                and bond.atom2.index in atom_by_index:
-                            bonds.append(bond)
-
-                found_atoms.clear()
-
-        for bond in bonds:
-            result_residue.add_bond(bond)
-
-        result_complex.io.to_sdf(path, SDFOPTIONS)
-        return (saved_atoms, saved_atoms_indices)
-
-    def __save__constraints(self, path, saved_atoms):
-        file = open(path, 'w')
-        for atom in saved_atoms:
-            if atom.selected is False:
-                file.write("ATOM:FIXED:" + str(atom.serial) + "\n")
-        file.close()
+            trajectory = run.trajectory.result()
+            self.__cache.put(run.key, trajectory if self.cache_trajectory else trajectory[-1:])
+
+    def __check_engine(self, engine, ff):
+        engine = engine or self.engine
+        if engine not in ENGINES:
+            Logs.error(f"Unknown minimization engine: {engine}")
+            return None
+        if engine == NUMPY_ENGINE and ff != 'Uff':
+            Logs.warning(f"The {NUMPY_ENGINE} engine only implements Uff, using it instead of {ff}")
+        return engine
+
+    def __save__atoms(self, workspace, cutoff, ff, steps, steepest, engine=None, protocol=False):
+        system = prepare_system(workspace, cutoff, engine_interaction_cutoff(ff, engine or self.engine), topologies=self.__topologies)
+        clusters = None
+        warm_start = self.__warm_start
+        if warm_start is not None and warm_start.cutoff == cutoff:
+            resumed = warm_start.resume(system)
+            clusters = warm_start.clusters(system)
+            Logs.debug(f"Resuming {resumed} of {len(system)} atoms from the last minimization")
+        if clusters is None:
+            clusters = split_clusters(system, cutoff)
+        return self.__make_runs(clusters, ff, steps, steepest, engine, protocol, self.__on_frame)
+
+    def __save_frames(self, workspace, cutoff, ff, steps, steepest, engine=None, protocol=False):
+        """(frame, runs) of every frame of the complexes holding the selection, each frame a ComplexFrame."""
+        displayed = displayed_frames(workspace, self.__topologies)
+        self.__topologies.retain(frame.complex.index for frame in displayed)
+        # other complexes are collected once, and stay fixed in every frame's system,
+        # after the frame so it keeps the atoms it shares with them
+        fixed = [frame.fixed() for frame in displayed]
+        jobs = []
+        try:
+            for i, framed in enumerate(displayed):
+                if not framed.selected.any():
+                    continue
+                for molecule, conformer in all_frames(framed.complex):
+                    if molecule is framed.molecule and conformer == framed.conformer:
+                        frame = framed
+                    else:
+                        frame = ComplexFrame(framed.complex, molecule, conformer, topologies=self.__topologies)
+                        if molecule is not framed.molecule and len(frame) == len(framed):
+                            frame.selected = framed.selected.copy()
+                    system = assemble_system([frame] + fixed[:i] + fixed[i + 1:], cutoff, engine_interaction_cutoff(ff, engine or self.engine))
+                    clusters = [cluster for cluster in split_clusters(system, cutoff) if cluster.selected.any()]
+                    if len(clusters) > 0:
+                        jobs.append((frame, self.__make_runs(clusters, ff, steps, steepest, engine, protocol)))
+        except OSError:
+            for _, runs in jobs:
+                for run in runs:
+                    run.stop()
+            raise
+        return jobs
+
+    def __make_runs(self, clusters, ff, steps, steepest, engine=None, protocol=False, on_frame=None):
+        engine = engine or self.engine
+        runs = []
+        try:
+            for cluster in clusters:
+                key = system_key(cluster, ff, steps, steepest, self.energy_threshold, self.convergence_window, engine, protocol)
+                trajectory = self.__cache.get(key)
+                if trajectory is not None and trajectory.shape[1] == len(cluster):
+                    run = CachedRun(cluster, trajectory, on_frame)
+                elif engine == NUMPY_ENGINE:
+                    run = EngineRun(cluster, self.coalesce_frames, on_frame, self.energy_threshold, self.convergence_window)
+                else:
+                    run = NanobabelRun(cluster, self.temp_dir.name, self.coalesce_frames, on_frame, self.energy_threshold, self.convergence_window)
+                run.key = key
+                runs.append(run)
+        except OSError:
+            # the input files of the runs made so far would be left behind
+            for run in runs:
+                run.stop()
+            raise
+        return runs
@@ -0,0 +1,201 @@
+import numpy as np
+
+from nanome.util import Vector3
+
+from .system import active_frame
+
+FLOAT32_ENCODING = 'float32'
+DELTA_ENCODING = 'delta'
+ENCODINGS = (DELTA_ENCODING, FLOAT32_ENCODING)
+# smallest coordinate change kept by the delta encoding, in angstroms
+DELTA_PRECISION = 1e-3
+# frames mapped at once, so memory stays flat however long the recording
+CHUNK_FRAMES = 64
+# frames a recording is thinned down to when exported onto a complex
+EXPORT_FRAMES = 100
+INDEX_SUFFIX = '.index'
+MAGIC = b'NMTRAJ01'
+HEADER_DTYPE = np.dtype([('magic', 'S8'), ('encoding', 'S8'), ('atom_count', '<i8'), ('precision', '<f8')])
+INDEX_DTYPE = np.dtype([('step', '<i8'), ('energy', '<f8')])
+DELTA_LIMIT = np.iinfo(np.int16).max
+
+
+def header_size(atom_count):
+    """Bytes before the first frame: the header, stream indices, complex indices and origin, padded to 8 bytes."""
+    size = HEADER_DTYPE.itemsize + 2 * 8 * atom_count + 4 * 3 * atom_count
+    return size + (-size % 8)
+
+
+def frame_dtype(encoding, atom_count):
+    return np.dtype(('<i2' if encoding == DELTA_ENCODING else '<f4', (3 * atom_count,)))
+
+
+class TrajectoryWriter():
+    """Appends the stream positions of every frame of a minimization to a file.
+
+    Frames hold the flat float32 positions streamed for indices, atoms of
+    complexes complex_indices, starting from origin. With the delta encoding,
+    a frame stores the change from the previous one as int16 multiples of
+    precision: a third of float32's size. Changes too large for int16 are
+    caught up with on the following frames. The step and energy of every
+    frame are appended to an index file next to it.
+
+    Only CHUNK_FRAMES frames are mapped in memory at a time.
+    """
+
+    def __init__(self, path, indices, complex_indices, origin, encoding=DELTA_ENCODING, precision=DELTA_PRECISION):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown trajectory encoding: {encoding}")
+        self.path = path
+        self.encoding = encoding
+        self.precision = precision
+        self.atom_count = len(indices)
+        self.frame_count = 0
+        self.__origin = np.array(origin, dtype=np.float32).reshape(-1)
+        self.__quantized = np.zeros(3 * self.atom_count, dtype=np.int64)
+        self.__frame_dtype = frame_dtype(encoding, self.atom_count)
+        self.__header_size = header_size(self.atom_count)
+        self.__chunk = None
+
+        with open(path, 'wb') as f:
+            header = np.zeros(1, dtype=HEADER_DTYPE)
+            header[0] = (MAGIC, encoding.encode(), self.atom_count, precision)
+            f.write(header.tobytes())
+            f.write(np.asarray(indices, dtype='<i8').tobytes())
+            f.write(np.asarray(complex_indices, dtype='<i8').tobytes())
+            f.write(self.__origin.astype('<f4').tobytes())
+            f.write(bytes(self.__header_size - f.tell()))
+        self.__index = open(path + INDEX_SUFFIX, 'wb')
+
+    def append(self, positions, step, energy):
+        position = self.frame_count % CHUNK_FRAMES
+        if position == 0:
+            self.__map_chunk(self.frame_count // CHUNK_FRAMES)
+        if self.encoding == DELTA_ENCODING:
+            quantized = np.rint((positions - self.__origin) / self.precision).astype(np.int64)
+            delta = np.clip(quantized - self.__quantized, -DELTA_LIMIT, DELTA_LIMIT)
+            self.__quantized += delta
+            self.__chunk[position] = delta
+        else:
+            self.__chunk[position] = positions
+        self.__index.write(np.array([(step, np.nan if energy is None else energy)], dtype=INDEX_DTYPE).tobytes())
+        self.frame_count += 1
+
+    def close(self):
+        if self.__index.closed:
+            return
+        self.__unmap_chunk()
+        self.__index.close()
+        with open(self.path, 'r+b') as f:
+            f.truncate(self.__header_size + self.frame_count * self.__frame_dtype.itemsize)
+
+    def __map_chunk(self, chunk):
+        self.__unmap_chunk()
+        offset = self.__header_size + chunk * CHUNK_FRAMES * self.__frame_dtype.itemsize
+        with open(self.path, 'r+b') as f:
+            f.truncate(offset + CHUNK_FRAMES * self.__frame_dtype.itemsize)
+        self.__chunk = np.memmap(self.path, dtype=self.__frame_dtype, mode='r+', offset=offset, shape=(CHUNK_FRAMES,))
+
+    def __unmap_chunk(self):
+        if self.__chunk is not None:
+            self.__chunk.flush()
+            self.__chunk = None
+
+
+class TrajectoryReader():
+    """Frames of a file written by a TrajectoryWriter, decoded back to flat float32 positions."""
+
+    def __init__(self, path):
+        self.path = path
+        header = np.fromfile(path, dtype=HEADER_DTYPE, count=1)
+        if len(header) == 0 or header[0]['magic'] != MAGIC:
+            raise ValueError(f"Not a minimization trajectory: {path}")
+        self.encoding = header[0]['encoding'].decode()
+        self.precision = float(header[0]['precision'])
+        self.atom_count = int(header[0]['atom_count'])
+        self.__frame_dtype = frame_dtype(self.encoding, self.atom_count)
+        self.__header_size = header_size(self.atom_count)
+        arrays = np.fromfile(path, dtype='<i8', count=2 * self.atom_count, offset=HEADER_DTYPE.itemsize)
+        self.indices = arrays[:self.atom_count]
+        self.complex_indices = arrays[self.atom_count:]
+        self.origin = np.fromfile(path, dtype='<f4', count=3 * self.atom_count, offset=HEADER_DTYPE.itemsize + 16 * self.atom_count)
+        # frames are indexed once written, and the file only grows a chunk ahead of them
+        self.index = np.fromfile(path + INDEX_SUFFIX, dtype=INDEX_DTYPE)
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def steps(self):
+        return self.index['step']
+
+    @property
+    def energies(self):
+        return self.index['energy']
+
+    def frames(self, frame_numbers=None):
+        """Yield (frame number, positions) for frame_numbers, increasing, or every frame.
+
+        Positions are a flat float32 array, overwritten by the next frame.
+        """
+        if frame_numbers is None:
+            frame_numbers = range(len(self))
+        wanted = iter(frame_numbers)
+        next_frame = next(wanted, None)
+        quantized = np.zeros(3 * self.atom_count, dtype=np.int64)
+        positions = np.empty(3 * self.atom_count, dtype=np.float32)
+        for start in range(0, len(self), CHUNK_FRAMES):
+            if next_frame is None:
+                return
+            stop = min(start + CHUNK_FRAMES, len(self))
+            if self.encoding != DELTA_ENCODING and next_frame >= stop:
+                continue
+            chunk = np.memmap(self.path, dtype=self.__frame_dtype, mode='r', offset=self.__header_size + start * self.__frame_dtype.itemsize, shape=(stop - start,))
+            for frame in range(start, stop):
+                if self.encoding == DELTA_ENCODING:
+                    quantized += chunk[frame - start]
+                if frame != next_frame:
+                    continue
+                if self.encoding == DELTA_ENCODING:
+                    positions[:] = self.origin + quantized * self.precision
+                else:
+                    positions[:] = chunk[frame - start]
+                yield frame, positions
+                next_frame = next(wanted, None)
+                if next_frame is None:
+                    break
+            del chunk
+
+    def frame(self, frame_number):
+        return next(self.frames([frame_number]))[1].copy()
+
+
+def export_frames(reader, complex, max_frames=EXPORT_FRAMES):
+    """Turn complex, as requested from the workspace, into the recorded frames of its atoms.
+
+    Only its displayed molecule is kept, with one conformer per frame, thinned
+    evenly down to max_frames, always ending on the last frame.
+    """
+    if len(reader) == 0:
+        raise ValueError(f"No frames recorded in {reader.path}")
+    molecule, conformer = active_frame(complex)
+    for other in list(complex.molecules):
+        if other is not molecule:
+            complex.remove_molecule(other)
+    recorded = np.flatnonzero(reader.complex_indices == complex.index)
+    atom_by_index = {atom.index: atom for atom in molecule.atoms}
+    atoms = [(atom_by_index[index], 3 * i) for index, i in zip(reader.indices[recorded].tolist(), recorded.tolist()) if index in atom_by_index]
+
+    frame_count = len(reader)
+    frame_numbers = np.unique(np.linspace(0, frame_count - 1, min(frame_count, max_frames)).round().astype(int))
+    conformer_count = molecule.conformer_count
+    for i, (_, positions) in enumerate(reader.frames(frame_numbers.tolist())):
+        molecule.copy_conformer(conformer, conformer_count + i)
+        for atom, offset in atoms:
+            atom.positions[conformer_count + i] = Vector3(*positions[offset:offset + 3].tolist())
+    for i in reversed(range(conformer_count)):
+        molecule.delete_conformer(i)
+    molecule.set_current_conformer(len(frame_numbers) - 1)
+    complex.set_current_frame(0)
+    complex.name = f'{complex.name} (minimization)'
+    return complex
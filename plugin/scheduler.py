@@ -0,0 +1,191 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import partial
+from multiprocessing.managers import BaseManager
+from nanome.util import Logs
+
+MAX_CONCURRENT_RUNS = os.cpu_count() or 1
+INTEGRATION_PRIORITY = 0
+MENU_PRIORITY = 1
+POLL_INTERVAL = 0.1
+# seconds a ticket lives without being renewed, so a crashed session cannot hold slots forever
+LEASE_TIMEOUT = 30
+
+
+def available_cpus():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class RunScheduler():
+    """Hands out nanobabel slots to every session of a plugin server.
+
+    Waiting tickets are served by priority, then round robin across sessions,
+    so a session queueing many runs does not starve the others. With
+    cpu_affinity, each running ticket is given a CPU of its own. Calls are
+    thread safe, as the scheduler manager serves each session from its own thread.
+    """
+
+    def __init__(self, max_runs=MAX_CONCURRENT_RUNS, cpu_affinity=False):
+        self.max_runs = max(1, max_runs)
+        self.cpu_affinity = cpu_affinity
+        self.__cpus = available_cpus()
+        self.__lock = threading.Lock()
+        self.__next_ticket = 0
+        self.__grants = 0
+        # ticket -> (priority, session), oldest first
+        self.__waiting = OrderedDict()
+        # ticket -> (session, cpu)
+        self.__running = {}
+        self.__deadlines = {}
+        # session -> grant count when it was last served
+        self.__served = {}
+
+    def request(self, session, priority=MENU_PRIORITY):
+        with self.__lock:
+            ticket = self.__next_ticket
+            self.__next_ticket += 1
+            self.__waiting[ticket] = (priority, session)
+            self.__deadlines[ticket] = time.monotonic() + LEASE_TIMEOUT
+            self.__dispatch()
+            return ticket
+
+    def poll(self, ticket):
+        """Renew ticket, returning (queue position, None) while it waits and (None, cpu) once it runs."""
+        with self.__lock:
+            if ticket not in self.__deadlines:
+                raise KeyError(f"Unknown or expired ticket {ticket}")
+            self.__deadlines[ticket] = time.monotonic() + LEASE_TIMEOUT
+            self.__dispatch()
+            if ticket in self.__running:
+                return (None, self.__running[ticket][1])
+            return (self.__order().index(ticket), None)
+
+    def release(self, ticket):
+        with self.__lock:
+            self.__remove(ticket)
+            self.__dispatch()
+
+    def stats(self):
+        with self.__lock:
+            return {'running': len(self.__running), 'waiting': len(self.__waiting), 'max_runs': self.max_runs}
+
+    def __order(self):
+        queues = OrderedDict()
+        for ticket, key in self.__waiting.items():
+            queues.setdefault(key, []).append(ticket)
+        # sessions served least recently go first, then each session gets a turn per round
+        keys = sorted(queues, key=lambda key: (key[0], self.__served.get(key[1], -1)))
+        order = []
+        for priority in sorted(set(key[0] for key in keys)):
+            rounds = [queues[key] for key in keys if key[0] == priority]
+            for i in range(max(len(tickets) for tickets in rounds)):
+                order.extend(tickets[i] for tickets in rounds if i < len(tickets))
+        return order
+
+    def __dispatch(self):
+        now = time.monotonic()
+        for ticket in [ticket for ticket, deadline in self.__deadlines.items() if deadline < now]:
+            self.__remove(ticket)
+
+        while len(self.__running) < self.max_runs and len(self.__waiting) > 0:
+            ticket = self.__order()[0]
+            _, session = self.__waiting.pop(ticket)
+            self.__running[ticket] = (session, self.__free_cpu())
+            self.__served[session] = self.__grants
+            self.__grants += 1
+
+    def __free_cpu(self):
+        if not self.cpu_affinity:
+            return None
+        used = set(cpu for _, cpu in self.__running.values())
+        return next((cpu for cpu in self.__cpus if cpu not in used), None)
+
+    def __remove(self, ticket):
+        self.__deadlines.pop(ticket, None)
+        if ticket in self.__running:
+            session, _ = self.__running.pop(ticket)
+        elif ticket in self.__waiting:
+            _, session = self.__waiting.pop(ticket)
+        else:
+            return
+        # sessions with nothing left queued or running start afresh next time
+        if all(key[1] != session for key in self.__waiting.values()) and all(other != session for other, _ in self.__running.values()):
+            self.__served.pop(session, None)
+
+
+class SchedulerManager(BaseManager):
+    pass
+
+
+SchedulerManager.register('RunScheduler', RunScheduler)
+
+
+def start_scheduler(max_runs=MAX_CONCURRENT_RUNS, cpu_affinity=False):
+    """Start a RunScheduler in its own process, returning a proxy that session processes can share."""
+    manager = SchedulerManager()
+    manager.start()
+    return manager, manager.RunScheduler(max_runs, cpu_affinity)
+
+
+class SchedulerClient():
+    """Session side of a RunScheduler, waiting for slots without blocking the plugin loop.
+
+    Each session runs in its own process, so its pid tells sessions apart.
+    Scheduler calls go through the manager proxy, so they are made from the
+    loop's executor.
+    """
+
+    def __init__(self, scheduler, session=None):
+        self.scheduler = scheduler
+        self.session = os.getpid() if session is None else session
+
+    @asynccontextmanager
+    async def slot(self, priority=MENU_PRIORITY, on_position=None):
+        """Wait for a slot, yielding the CPU to pin to, or None.
+
+        on_position is called with the queue position every time it changes
+        while waiting.
+        """
+        request = asyncio.ensure_future(self.__call(self.scheduler.request, self.session, priority))
+        try:
+            ticket = await asyncio.shield(request)
+        except asyncio.CancelledError:
+            # the scheduler hands the ticket out anyway, and it would hold its place until the lease runs out
+            await self.__call(self.scheduler.release, await request)
+            raise
+        try:
+            last_position = None
+            position, cpu = await self.__call(self.scheduler.poll, ticket)
+            while position is not None:
+                if on_position is not None and position != last_position:
+                    on_position(position)
+                last_position = position
+                await asyncio.sleep(POLL_INTERVAL)
+                position, cpu = await self.__call(self.scheduler.poll, ticket)
+
+            renew = asyncio.ensure_future(self.__renew(ticket))
+            try:
+                yield cpu
+            finally:
+                renew.cancel()
+        finally:
+            await self.__call(self.scheduler.release, ticket)
+
+    async def __renew(self, ticket):
+        while True:
+            await asyncio.sleep(LEASE_TIMEOUT / 3)
+            try:
+                await self.__call(self.scheduler.poll, ticket)
+            except KeyError:
+                # the lease ran out, the slot is already handed to someone else
+                Logs.warning(f"Run slot {ticket} expired before its run finished")
+                return
+
+    async def __call(self, method, *args):
+        return await asyncio.get_event_loop().run_in_executor(None, partial(method, *args))
@@ -0,0 +1,93 @@
+import math
+from collections import deque
+
+PACKET_QUEUE_LEN = 20
+TARGET_UPDATE_RATE = 30
+RTT_SMOOTHING = 0.2
+
+
+class FrameQueue():
+    """Frames waiting to be streamed.
+
+    When coalescing, a new frame replaces every frame still waiting, so only the
+    newest coordinates are ever sent and memory stays bounded to one frame.
+    """
+
+    def __init__(self, coalesce=True):
+        self.coalesce = coalesce
+        self.received = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.__frames = deque()
+
+    def __len__(self):
+        return len(self.__frames)
+
+    def push(self, frame):
+        self.received += 1
+        if self.coalesce and len(self.__frames) > 0:
+            self.coalesced += len(self.__frames)
+            self.__frames.clear()
+        self.__frames.append(frame)
+
+    def pop(self):
+        return self.__frames.popleft()
+
+    def clear(self):
+        self.dropped += len(self.__frames)
+        self.__frames.clear()
+
+
+class FlowControl():
+    """Paces stream updates to a target rate, sizing the unacked window from measured round trips."""
+
+    def __init__(self, target_rate=TARGET_UPDATE_RATE, max_in_flight=PACKET_QUEUE_LEN):
+        self.target_rate = target_rate
+        self.max_in_flight = max_in_flight
+        self.round_trip_time = None
+        self.sent = 0
+        self.acked = 0
+        self.__sent_times = {}
+        self.__last_sent_time = None
+
+    @property
+    def in_flight(self):
+        return len(self.__sent_times)
+
+    @property
+    def window(self):
+        # enough packets in flight to keep target_rate updates per second over the measured latency
+        if self.round_trip_time is None:
+            return 1
+        window = math.ceil(self.round_trip_time * self.target_rate)
+        return max(1, min(self.max_in_flight, window))
+
+    def can_send(self, now):
+        return self.send_delay(now) == 0
+
+    def send_delay(self, now):
+        """Seconds to wait before the next send, or None while the window is full and an ack is needed."""
+        if self.in_flight >= self.window:
+            return None
+        interval = 1.0 / self.target_rate
+        if self.__last_sent_time is None or now - self.__last_sent_time >= interval:
+            return 0
+        return self.__last_sent_time + interval - now
+
+    def on_sent(self, packet_id, now):
+        self.sent += 1
+        self.__sent_times[packet_id] = now
+        self.__last_sent_time = now
+
+    def on_acked(self, packet_id, now):
+        """Returns the round trip measured for packet_id, None if it was not in flight."""
+        sent_time = self.__sent_times.pop(packet_id, None)
+        if sent_time is None:
+            return None
+        self.acked += 1
+        round_trip_time = now - sent_time
+        if self.round_trip_time is None:
+            self.round_trip_time = round_trip_time
+        else:
+            self.round_trip_time += RTT_SMOOTHING * (round_trip_time - self.round_trip_time)
+        return round_trip_time
@@ -0,0 +1,451 @@
+import copy
+
+import numpy as np
+
+from .geometry import CellList, connected_components, matrix_to_array, positions_to_array, transform_positions
+
+# OpenBabel's default van der Waals cutoff, past which fixed atoms no longer interact with movable ones
+NONBONDED_CUTOFF = 6.0
+# force fields whose only nonbonded term is van der Waals, the others add electrostatics nanobabel does not cut off
+VAN_DER_WAALS_FORCE_FIELDS = ('Uff',)
+# bonds, angles and torsions reach up to 3 bonds away from a movable atom
+VALENCE_DEPTH = 3
+# atoms found back within this distance, in angstroms, of where they were last streamed were not moved by the user
+RESUME_TOLERANCE = 1e-3
+
+
+def interaction_cutoff(ff):
+    """Distance past which fixed atoms no longer interact with movable ones under ff, None when they always do."""
+    return NONBONDED_CUTOFF if ff in VAN_DER_WAALS_FORCE_FIELDS else None
+
+
+def active_frame(complex):
+    """Molecule and conformer currently displayed for complex, as convert_to_frames would number them."""
+    molecules = list(complex.molecules)
+    if len(molecules) == 1:
+        return (molecules[0], molecules[0].current_conformer)
+    frame = complex.current_frame
+    for molecule in molecules:
+        if frame < molecule.conformer_count:
+            return (molecule, frame)
+        frame -= molecule.conformer_count
+    return (None, 0)
+
+
+def all_frames(complex):
+    """Molecule and conformer of every frame of complex, in the order convert_to_frames numbers them."""
+    for molecule in complex.molecules:
+        for conformer in range(molecule.conformer_count):
+            yield (molecule, conformer)
+
+
+class PreparedSystem():
+    """Atoms handed to nanobabel, in serial order, with their workspace positions and bonds.
+
+    Atoms are the workspace's own objects and are never modified. The serial of
+    atoms[i] in the written files is i + 1. Atoms are movable when selected,
+    unless a mask of the movable atoms is given.
+    """
+
+    def __init__(self, atoms, complexes, positions, bonds, bond_kinds, selected=None):
+        self.atoms = atoms
+        self.complexes = complexes
+        self.positions = positions
+        self.bonds = bonds
+        self.bond_kinds = bond_kinds
+        if selected is None:
+            selected = np.array([atom.selected is True for atom in atoms], dtype=bool)
+        self.selected = selected
+
+    def __len__(self):
+        return len(self.atoms)
+
+    @property
+    def serials(self):
+        return np.arange(1, len(self.atoms) + 1)
+
+    @property
+    def indices(self):
+        return [atom.index for atom in self.atoms]
+
+    def moved_to(self, positions):
+        """The same system, with its atoms at positions."""
+        return PreparedSystem(self.atoms, self.complexes, positions, self.bonds, self.bond_kinds, self.selected)
+
+    def subset(self, mask):
+        """System made of the atoms flagged in mask, keeping the bonds between them."""
+        kept = np.flatnonzero(mask)
+        kept_bonds = mask[self.bonds[:, 0]] & mask[self.bonds[:, 1]]
+        new_serials = np.cumsum(mask) - 1
+        return PreparedSystem(
+            [self.atoms[i] for i in kept],
+            [self.complexes[i] for i in kept],
+            self.positions[kept],
+            new_serials[self.bonds[kept_bonds]],
+            self.bond_kinds[kept_bonds],
+            self.selected[kept])
+
+    def sdf_text(self):
+        """V3000 SDF of the system, formatted from its arrays in one pass per block."""
+        atom_count = len(self.atoms)
+        charges = ["CHG=%d" % atom.formal_charge if atom.formal_charge != 0 else "" for atom in self.atoms]
+        atom_fields = [None] * (6 * atom_count)
+        atom_fields[0::6] = self.serials.tolist()
+        atom_fields[1::6] = [atom.symbol for atom in self.atoms]
+        atom_fields[2::6] = self.positions[:, 0].tolist()
+        atom_fields[3::6] = self.positions[:, 1].tolist()
+        atom_fields[4::6] = self.positions[:, 2].tolist()
+        atom_fields[5::6] = charges
+        bond_fields = np.column_stack((np.arange(1, len(self.bonds) + 1), self.bond_kinds, self.bonds + 1)).ravel().tolist()
+        return "".join((
+            "\nNanome Inc. SDF Saver\n\n",
+            "  0  0  0     0  0            999 V3000\n",
+            "M  V30 BEGIN CTAB\n",
+            "M  V30 COUNTS %d %d 0 0 0\n" % (atom_count, len(self.bonds)),
+            "M  V30 BEGIN ATOM\n",
+            "M  V30 %d %s %.4f %.4f %.4f 0 %s\n" * atom_count % tuple(atom_fields),
+            "M  V30 END ATOM\n",
+            "M  V30 BEGIN BOND\n",
+            "M  V30 %d %d %d %d\n" * len(self.bonds) % tuple(bond_fields),
+            "M  V30 END BOND\n",
+            "M  V30 END CTAB\n",
+            "M  END"))
+
+    def constraints_text(self):
+        fixed = self.serials[~self.selected]
+        return "ATOM:FIXED:%d\n" * len(fixed) % tuple(fixed.tolist())
+
+    def write_sdf(self, path):
+        with open(path, 'w') as f:
+            f.write(self.sdf_text())
+
+    def write_constraints(self, path):
+        with open(path, 'w') as f:
+            f.write(self.constraints_text())
+
+
+def bonded_within(mask, bonds, depth):
+    """Grow mask along bonds by up to depth bonds."""
+    result = mask.copy()
+    for _ in range(depth):
+        grown = result.copy()
+        grown[bonds[:, 0][result[bonds[:, 1]]]] = True
+        grown[bonds[:, 1][result[bonds[:, 0]]]] = True
+        if np.array_equal(grown, result):
+            break
+        result = grown
+    return result
+
+
+def trim_fixed_atoms(positions, selected, bonds, interaction_cutoff):
+    """Mask of the atoms worth minimizing: movable atoms, fixed atoms close enough to
+    interact with them, and the bonded neighbours every valence term needs."""
+    near = CellList(positions[selected], interaction_cutoff).within(positions)
+    keep = bonded_within(selected, bonds, VALENCE_DEPTH) | near
+    # keep the first neighbours of every kept atom so force field typing still sees its full valence
+    return bonded_within(keep, bonds, 1)
+
+
+def ordered_bonds(bonds, bond_kinds):
+    """Bonds listed once each, in the order they were always written in: by their later atom, then as it lists them.
+
+    Pairs are compared regardless of their atoms' order. Of a bond listed
+    more than once, the last listing is kept, as a bond is listed by its
+    later atom after its earlier one.
+    """
+    distinct = bonds[:, 0] != bonds[:, 1]
+    bonds = bonds[distinct]
+    bond_kinds = bond_kinds[distinct]
+    pairs = np.sort(bonds, axis=1)
+    _, last = np.unique(pairs[::-1], axis=0, return_index=True)
+    kept = np.sort(len(pairs) - 1 - last)
+    kept = kept[np.argsort(pairs[kept, 1], kind='stable')]
+    return bonds[kept], bond_kinds[kept]
+
+
+class Topology():
+    """Bonds between the atoms a complex displays, as pairs of positions in its atom list.
+
+    atom_indices and bond_indices are the Nanome indices of the atoms and bonds
+    it was built from, which change whenever one is added or removed.
+    """
+
+    def __init__(self, atoms, bonds, conformer):
+        self.atom_indices = np.array([atom.index for atom in atoms], dtype=np.int64)
+        self.bond_indices = np.array([bond.index for bond in bonds], dtype=np.int64)
+        position_by_atom = {atom: i for i, atom in enumerate(atoms)}
+        pairs = []
+        kinds = []
+        for bond in bonds:
+            if not bond.in_conformer[conformer]:
+                continue
+            i = position_by_atom.get(bond.atom1)
+            j = position_by_atom.get(bond.atom2)
+            if i is None or j is None:
+                continue
+            pairs.append((i, j))
+            kinds.append(int(bond.kinds[conformer]))
+        self.bonds, self.bond_kinds = ordered_bonds(np.array(pairs, dtype=np.int64).reshape(-1, 2), np.array(kinds, dtype=np.int64))
+
+    def matches(self, atom_indices, bond_indices):
+        return np.array_equal(self.atom_indices, atom_indices) and np.array_equal(self.bond_indices, bond_indices)
+
+
+class TopologyCache():
+    """Topologies of the complexes minimized so far, by complex, molecule and conformer index.
+
+    A topology is reused until an atom or bond of its frame is added or
+    removed. Structures without Nanome indices, like those read from files,
+    are never cached, as nothing tells them apart between workspaces.
+    """
+
+    def __init__(self):
+        self.__topologies = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__topologies)
+
+    def get(self, complex, molecule, conformer, atoms):
+        bonds = list(molecule.bonds)
+        atom_indices = np.array([atom.index for atom in atoms], dtype=np.int64)
+        if complex.index < 0 or (len(atom_indices) > 0 and atom_indices.min() < 0):
+            return Topology(atoms, bonds, conformer)
+        key = (complex.index, molecule.index, conformer)
+        topology = self.__topologies.get(key)
+        if topology is not None and topology.matches(atom_indices, [bond.index for bond in bonds]):
+            self.hits += 1
+            return topology
+        self.misses += 1
+        topology = Topology(atoms, bonds, conformer)
+        self.__topologies[key] = topology
+        return topology
+
+    def retain(self, complex_indices):
+        """Forget the topologies of every complex but those of complex_indices."""
+        complex_indices = set(complex_indices)
+        for key in [key for key in self.__topologies if key[0] not in complex_indices]:
+            del self.__topologies[key]
+
+
+class ComplexFrame():
+    """Atoms complex displays in one of its frames, with their workspace positions and selection.
+
+    selected, a mask over those atoms or one flag for all of them, replaces
+    their own selection. Bonds come from topologies, a TopologyCache, when
+    given, and are otherwise read for the atoms a system keeps only.
+    """
+
+    def __init__(self, complex, molecule, conformer, selected=None, topologies=None):
+        self.complex = complex
+        self.molecule = molecule
+        self.conformer = conformer
+        self.atoms = [atom for atom in molecule.atoms if atom.in_conformer[conformer]]
+        complex_local_to_workspace_matrix = matrix_to_array(complex.get_complex_to_workspace_matrix())
+        positions = positions_to_array([atom.positions[conformer] for atom in self.atoms])
+        self.positions = transform_positions(positions, complex_local_to_workspace_matrix)
+        if selected is None:
+            self.selected = np.array([atom.selected is True for atom in self.atoms], dtype=bool)
+        else:
+            self.selected = np.broadcast_to(np.asarray(selected, dtype=bool), len(self.atoms)).copy()
+        self.topology = topologies.get(complex, molecule, conformer, self.atoms) if topologies is not None else None
+
+    def __len__(self):
+        return len(self.atoms)
+
+    def fixed(self):
+        """The same frame, with none of its atoms movable."""
+        frame = copy.copy(self)
+        frame.selected = np.zeros(len(self.atoms), dtype=bool)
+        return frame
+
+    def bonds(self, in_shell):
+        """Bonds between the frame's atoms, as pairs of positions in atoms, and their kinds.
+
+        Without a topology, only the bonds of the atoms flagged in in_shell are read.
+        """
+        if self.topology is not None:
+            return self.topology.bonds, self.topology.bond_kinds
+        shell = np.flatnonzero(in_shell)
+        shell_atoms = [self.atoms[i] for i in shell]
+        topology = Topology(shell_atoms, [bond for atom in shell_atoms for bond in atom.bonds], self.conformer)
+        return shell[topology.bonds], topology.bond_kinds
+
+
+def displayed_frames(workspace, topologies=None):
+    """ComplexFrame of every visible complex, as it is displayed."""
+    frames = []
+    for complex in workspace.complexes:
+        if not complex.visible:
+            continue
+        molecule, conformer = active_frame(complex)
+        if molecule is not None:
+            frames.append(ComplexFrame(complex, molecule, conformer, topologies=topologies))
+    return frames
+
+
+def prepare_system(workspace, cutoff, interaction_cutoff=NONBONDED_CUTOFF, trim=True, topologies=None):
+    """Collect the atoms of the visible complexes closer than cutoff to a selected atom.
+
+    When trim is set, fixed atoms further than interaction_cutoff from every
+    selected atom are dropped, unless they are bonded close to a kept atom.
+    Without an interaction_cutoff, every fixed atom interacts and none is dropped.
+    Bonds come from topologies, a TopologyCache, when given, so repeated runs
+    on the same structures only gather positions and selections.
+    """
+    frames = displayed_frames(workspace, topologies)
+    if topologies is not None:
+        topologies.retain(frame.complex.index for frame in frames)
+    return assemble_system(frames, cutoff, interaction_cutoff, trim)
+
+
+def first_listings(indices):
+    """Position of the first atom with the same Nanome index as each of indices.
+
+    Atoms without an index cannot be told apart, and are each their own first listing.
+    """
+    keys = np.array(indices, dtype=np.int64).reshape(-1)
+    unindexed = keys < 0
+    keys[unindexed] = -1 - np.arange(np.count_nonzero(unindexed))
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    return first[inverse.reshape(-1)]
+
+
+def merge_listings(mask, first_listing):
+    """mask flagging each first listing of an atom when any of its listings is flagged."""
+    merged = np.zeros(len(mask), dtype=bool)
+    merged[first_listing[mask]] = True
+    return merged
+
+
+def assemble_system(frames, cutoff, interaction_cutoff=NONBONDED_CUTOFF, trim=True):
+    """Collect the atoms of frames, ComplexFrames, closer than cutoff to a movable atom, like prepare_system."""
+    atoms = [atom for frame in frames for atom in frame.atoms]
+    owners = [frame.complex for frame in frames for _ in frame.atoms]
+    if len(atoms) > 0:
+        atom_absolute_positions = np.concatenate([frame.positions for frame in frames])
+        selected_mask = np.concatenate([frame.selected for frame in frames])
+    else:
+        atom_absolute_positions = np.empty((0, 3))
+        selected_mask = np.empty(0, dtype=bool)
+    # an atom listed by several complexes is saved once, where it is first listed
+    first_listing = first_listings([atom.index for atom in atoms])
+    duplicated = not np.array_equal(first_listing, np.arange(len(atoms)))
+    if duplicated:
+        selected_mask = merge_listings(selected_mask, first_listing)
+    selected_atoms = CellList(atom_absolute_positions[selected_mask], cutoff)
+    in_shell = selected_atoms.within(atom_absolute_positions)
+    if duplicated:
+        in_shell &= first_listing == np.arange(len(atoms))
+    shell = np.flatnonzero(in_shell)
+
+    frame_bonds = [np.empty((0, 2), dtype=np.int64)]
+    frame_bond_kinds = [np.empty(0, dtype=np.int64)]
+    offset = 0
+    for frame in frames:
+        bonds, bond_kinds = frame.bonds(in_shell[offset:offset + len(frame)])
+        frame_bonds.append(bonds + offset)
+        frame_bond_kinds.append(bond_kinds)
+        offset += len(frame)
+
+    # bonds are written once both of their atoms are saved
+    bonds = np.concatenate(frame_bonds)
+    bond_kinds = np.concatenate(frame_bond_kinds)
+    if duplicated:
+        bonds, bond_kinds = ordered_bonds(first_listing[bonds], bond_kinds)
+    kept_bonds = in_shell[bonds[:, 0]] & in_shell[bonds[:, 1]]
+    serials = np.cumsum(in_shell) - 1
+    system = PreparedSystem(
+        [atoms[i] for i in shell],
+        [owners[i] for i in shell],
+        atom_absolute_positions[shell],
+        serials[bonds[kept_bonds]],
+        bond_kinds[kept_bonds],
+        selected_mask[shell])
+    if trim and interaction_cutoff is not None:
+        system = system.subset(trim_fixed_atoms(system.positions, system.selected, system.bonds, min(cutoff, interaction_cutoff)))
+    return system
+
+
+def split_clusters(system, cutoff):
+    """Split system into independent parts, whose selected atoms are more than twice cutoff apart.
+
+    Every atom goes with the selected atoms it is within cutoff of, and bonded
+    atoms always stay together.
+    """
+    selected = np.flatnonzero(system.selected)
+    if len(selected) <= 1:
+        return [system]
+    selected_positions = system.positions[selected]
+    edges = [system.bonds]
+    for i, j in CellList(selected_positions, 2 * cutoff).pairs(selected_positions):
+        edges.append(np.stack((selected[i], selected[j]), axis=1))
+    # a single selected neighbour is enough to attach an atom to its cluster
+    attached = np.zeros(len(system), dtype=bool)
+    for i, j in CellList(selected_positions, cutoff).pairs(system.positions, attached):
+        attached[i] = True
+        edges.append(np.stack((i, selected[j]), axis=1))
+
+    labels = connected_components(len(system), np.concatenate(edges))
+    if labels.max() == 0:
+        return [system]
+    return [system.subset(labels == label) for label in range(labels.max() + 1)]
+
+
+class WarmStart():
+    """Where the atoms of a finished minimization were left, to resume the next one from.
+
+    For each of its clusters, sent holds the workspace positions last streamed
+    to Nanome, and latest the newest ones computed, which may not have been
+    sent yet. Atoms found back where they were sent were left alone by the
+    user, and resume from latest.
+    """
+
+    def __init__(self, cutoff):
+        self.cutoff = cutoff
+        self.__clusters = []
+        self.__indices = np.empty(0, dtype=np.int64)
+        self.__selected = np.empty(0, dtype=bool)
+        self.__sent = np.empty((0, 3))
+        self.__latest = np.empty((0, 3))
+
+    def __len__(self):
+        return len(self.__indices)
+
+    def add(self, system, sent, latest):
+        indices = np.array(system.indices, dtype=np.int64)
+        self.__clusters.append(indices)
+        self.__indices = np.concatenate((self.__indices, indices))
+        self.__selected = np.concatenate((self.__selected, system.selected))
+        self.__sent = np.concatenate((self.__sent, sent))
+        self.__latest = np.concatenate((self.__latest, latest))
+
+    def resume(self, system, tolerance=RESUME_TOLERANCE):
+        """Move the atoms of system the user left alone to their latest positions. Returns how many moved."""
+        found, positions = self.__lookup(system)
+        untouched = found & (np.abs(system.positions - self.__sent[positions]).max(axis=1, initial=0) < tolerance)
+        system.positions[untouched] = self.__latest[positions[untouched]]
+        return int(np.count_nonzero(untouched))
+
+    def clusters(self, system, tolerance=RESUME_TOLERANCE):
+        """The previous split of system into clusters, None unless it has the same atoms and selection, none of them moved by the user."""
+        found, positions = self.__lookup(system)
+        if len(system) != len(self) or not found.all() or not np.array_equal(system.selected, self.__selected[positions]):
+            return None
+        # atoms are either where they were sent, or already resumed
+        left = np.abs(system.positions - self.__sent[positions]).max(axis=1, initial=0) < tolerance
+        resumed = np.abs(system.positions - self.__latest[positions]).max(axis=1, initial=0) < tolerance
+        if not (left | resumed).all():
+            return None
+        indices = np.array(system.indices, dtype=np.int64)
+        return [system.subset(np.isin(indices, cluster)) for cluster in self.__clusters]
+
+    def __lookup(self, system):
+        """Whether each atom of system was part of the last minimization, and where."""
+        indices = np.array(system.indices, dtype=np.int64)
+        if len(self.__indices) == 0:
+            return np.zeros(len(indices), dtype=bool), np.zeros(len(indices), dtype=np.int64)
+        order = np.argsort(self.__indices)
+        positions = order[np.minimum(np.searchsorted(self.__indices, indices, sorter=order), len(order) - 1)]
+        return self.__indices[positions] == indices, positions
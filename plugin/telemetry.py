@@ -0,0 +1,165 @@
+import cProfile
+import os
+import sys
+import time
+import tracemalloc
+from collections import deque
+
+from .engine import EngineRun
+from .nanobabel import NanobabelRun
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, where peak memory is not reported
+    resource = None
+
+# run summaries kept by a MetricsStore
+MAX_STORED_RUNS = 100
+# queue depth samples kept per run, the most recent ones
+MAX_DEPTH_SAMPLES = 1000
+# stack frames kept per allocation in tracemalloc snapshots
+TRACEMALLOC_FRAMES = 10
+
+
+def peak_memory():
+    """Peak resident set size of this process, and the largest of its exited children, in bytes.
+
+    Both are peaks since the process started, not of one minimization: they
+    only grow, and stay at the largest run seen so far. Both are None where
+    the platform does not report them.
+    """
+    if resource is None:
+        return None, None
+    # ru_maxrss is in kilobytes, except on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * scale)
+
+
+def elapsed(start, end):
+    return None if start is None or end is None else end - start
+
+
+class RunTelemetry():
+    """Timings and counters of one minimization, from its request to its last frame.
+
+    Times are time.perf_counter() values. Each phase is marked the first time it is reached.
+    """
+
+    def __init__(self, requested_at=None):
+        self.started_at = time.perf_counter()
+        self.requested_at = requested_at if requested_at is not None else self.started_at
+        self.marks = {}
+        self.frames_sent = 0
+        self.decode_seconds = 0.0
+        # (seconds since start, frames waiting in every run's queue) at each send
+        self.queue_depths = deque(maxlen=MAX_DEPTH_SAMPLES)
+        self.__depth_total = 0
+        self.__depth_max = 0
+        self.__round_trip_count = 0
+        self.__round_trip_total = 0.0
+        self.__round_trip_max = None
+
+    def mark(self, phase):
+        self.marks.setdefault(phase, time.perf_counter())
+
+    def on_sent(self, queue_depth):
+        self.mark('first_frame_sent')
+        self.frames_sent += 1
+        self.queue_depths.append((time.perf_counter() - self.started_at, queue_depth))
+        self.__depth_total += queue_depth
+        self.__depth_max = max(self.__depth_max, queue_depth)
+
+    def on_acked(self, round_trip_time):
+        self.__round_trip_count += 1
+        self.__round_trip_total += round_trip_time
+        self.__round_trip_max = max(self.__round_trip_max or 0.0, round_trip_time)
+
+    def summary(self, runs, flow_control):
+        """Flat dict of this run's figures, fit for log extras. Durations are in seconds."""
+        finished_at = time.perf_counter()
+        spawned = [run for run in runs if isinstance(run, (NanobabelRun, EngineRun)) and run.started_at is not None]
+        startups = [run.first_output_at - run.started_at for run in spawned if run.first_output_at is not None]
+        first_received = self.marks.get('first_frame_received')
+        first_sent = self.marks.get('first_frame_sent')
+        frames_received = sum(run.frames.received for run in runs)
+        self_peak, children_peak = peak_memory()
+        return {
+            'workspace_fetch_seconds': self.started_at - self.requested_at,
+            'save_atoms_seconds': elapsed(self.started_at, self.marks.get('atoms_saved')),
+            'stream_creation_seconds': elapsed(self.marks.get('atoms_saved'), self.marks.get('stream_created')),
+            'queue_wait_seconds': elapsed(self.marks.get('stream_created'), min((run.started_at for run in spawned), default=None)),
+            'process_startup_seconds': sum(startups) / len(startups) if startups else None,
+            'compute_seconds': elapsed(min((run.started_at for run in spawned), default=None), max((run.finished_at or finished_at for run in spawned), default=None)),
+            'parse_seconds': sum(run.parse_seconds for run in spawned),
+            'decode_seconds': self.decode_seconds,
+            'first_frame_seconds': elapsed(self.requested_at, first_sent),
+            'total_seconds': finished_at - self.requested_at,
+            'frames_received': frames_received,
+            'frames_sent': self.frames_sent,
+            'frames_coalesced': sum(run.frames.coalesced for run in runs),
+            'frames_dropped': sum(run.frames.dropped for run in runs),
+            'received_fps': frames_received / (finished_at - first_received) if first_received is not None and finished_at > first_received else None,
+            'sent_fps': self.frames_sent / (finished_at - first_sent) if first_sent is not None and finished_at > first_sent else None,
+            'queue_depth_max': self.__depth_max,
+            'queue_depth_mean': self.__depth_total / self.frames_sent if self.frames_sent else None,
+            'round_trip_mean': self.__round_trip_total / self.__round_trip_count if self.__round_trip_count else None,
+            'round_trip_max': self.__round_trip_max,
+            'round_trip_smoothed': flow_control.round_trip_time,
+            'frames_unacked': flow_control.in_flight,
+            'converged_count': sum(1 for run in spawned if run.convergence.is_converged),
+            'lifetime_peak_memory_bytes': self_peak,
+            'children_lifetime_peak_memory_bytes': children_peak
+        }
+
+
+class MetricsStore():
+    """Summaries of the last max_runs minimizations, oldest first."""
+
+    def __init__(self, max_runs=MAX_STORED_RUNS):
+        self.__runs = deque(maxlen=max_runs)
+
+    def __len__(self):
+        return len(self.__runs)
+
+    @property
+    def runs(self):
+        return list(self.__runs)
+
+    def add(self, summary):
+        self.__runs.append(summary)
+
+    def stats(self, key):
+        """count, mean, min and max of key over the stored runs that report it, None if none do."""
+        values = [run[key] for run in self.__runs if run.get(key) is not None]
+        if len(values) == 0:
+            return None
+        return {'count': len(values), 'mean': sum(values) / len(values), 'min': min(values), 'max': max(values)}
+
+
+class ProfileCapture():
+    """cProfile stats and a tracemalloc snapshot of one minimization, written to directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__profile = cProfile.Profile()
+        self.__started_tracing = False
+
+    def start(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+            self.__started_tracing = True
+        self.__profile.enable()
+
+    def stop(self):
+        """Write the capture, returning the paths of the .prof and .tracemalloc files."""
+        self.__profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        if self.__started_tracing:
+            tracemalloc.stop()
+        os.makedirs(self.directory, exist_ok=True)
+        name = os.path.join(self.directory, f'minimization-{os.getpid()}-{time.strftime("%Y%m%d-%H%M%S")}')
+        self.__profile.dump_stats(name + '.prof')
+        snapshot.dump(name + '.tracemalloc')
+        return [name + '.prof', name + '.tracemalloc']
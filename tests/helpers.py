@@ -0,0 +1,30 @@
+import asyncio
+import os
+
+import numpy as np
+from nanome.api.structure import Atom, Complex
+from plugin.system import PreparedSystem
+
+# scripted stand-in for nanobabel, so runs do not depend on a local install
+FAKE_NANOBABEL = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'bin')
+
+
+def build_system(positions, selected, bonds):
+    atoms = []
+    for is_selected in selected:
+        atom = Atom()
+        atom.selected = is_selected
+        atoms.append(atom)
+    complex = Complex()
+    bonds = np.array(bonds, dtype=np.int64).reshape(-1, 2)
+    return PreparedSystem(atoms, [complex] * len(atoms), np.array(positions, dtype=np.float64), bonds, np.ones(len(bonds), dtype=np.int64))
+
+
+def run_awaitable(awaitable, *args, **kwargs):
+    loop = asyncio.get_event_loop()
+    if loop.is_running:
+        loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(awaitable(*args, **kwargs))
+    finally:
+        loop.close()
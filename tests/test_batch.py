@@ -0,0 +1,60 @@
+import argparse
+import os
+import tempfile
+import unittest
+
+from nanome.api.structure import Complex
+from plugin.batch import minimize_record, read_records, run_batch, select_atoms, split_pdb_models
+from tests.helpers import FAKE_NANOBABEL
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def ligand_lines():
+    with open(os.path.join(fixtures_dir, '1tyl.pdb')) as f:
+        return [line.rstrip('\n') for line in f if line.startswith('HETATM') and line[17:20] == 'TYL']
+
+
+class BatchTestCase(unittest.TestCase):
+
+    def settings(self, output):
+        return argparse.Namespace(output=output, selection='ligands', cutoff=7, engine='nanobabel', nanobabel=FAKE_NANOBABEL, force_field='Uff', steps=100, steepest=True, protocol=False)
+
+    def test_split_pdb_models(self):
+        lines = ['HEADER    TEST', 'MODEL        1', 'ATOM      1  N   ALA A   1', 'ENDMDL', 'MODEL        2', 'ATOM      1  N   ALA A   1', 'ENDMDL', 'CONECT    1']
+        models = list(split_pdb_models(lines))
+        self.assertEqual(len(models), 2)
+        self.assertEqual(models[1], ['HEADER    TEST', 'ATOM      1  N   ALA A   1', 'END'])
+        self.assertEqual(list(split_pdb_models(lines[:1] + lines[2:3])), [lines[:1] + lines[2:3]])
+
+    def test_ligand_selection(self):
+        complex = Complex.io.from_pdb(path=os.path.join(fixtures_dir, '1tyl.pdb'))
+        select_atoms(complex, 'ligands')
+        self.assertEqual(set(atom.residue.name for atom in complex.atoms if atom.selected), {'TYL', 'ZN', 'CL'})
+        # without hetero atoms, as in ligand libraries, the whole record moves
+        ligand = Complex.io.from_sdf(lines=['', '', '', '  1  0  0  0  0  0            999 V2000', '    0.0000    0.0000    0.0000 C   0  0', 'M  END'])
+        self.assertEqual(select_atoms(ligand, 'ligands'), 1)
+
+    def test_minimizes_every_model(self):
+        lines = ligand_lines()
+        with tempfile.TemporaryDirectory() as temp_dir:
+            input_path = os.path.join(temp_dir, 'poses.pdb')
+            with open(input_path, 'w') as f:
+                for model in range(2):
+                    f.write(f'MODEL     {model + 1}\n' + '\n'.join(lines) + '\nENDMDL\n')
+            output = os.path.join(temp_dir, 'out')
+            os.makedirs(output)
+
+            results = []
+            run_batch(read_records(input_path), self.settings(output), 2, results.append)
+            self.assertEqual(sorted(result['name'] for result in results), ['poses_1', 'poses_2'])
+            self.assertTrue(all(result['status'] == 'ok' for result in results))
+
+            minimized = Complex.io.from_pdb(path=os.path.join(output, 'poses_1.pdb'))
+            self.assertEqual(sum(1 for _ in minimized.atoms), len(lines))
+
+    def test_reports_errors(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            result = minimize_record(('bad', '.pdb', ligand_lines()), self.settings(os.path.join(temp_dir, 'missing')))
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('missing', result['error'])
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+
+import numpy as np
+from nanome.api.structure import Complex, Workspace
+from nanome.util.stream import StreamCreationError
+from plugin.cache import ResultCache, TrajectoryRecorder, system_key
+from plugin.process import MinimizationProcess
+from tests.helpers import FAKE_NANOBABEL, build_system, run_awaitable
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class SystemKeyTestCase(unittest.TestCase):
+
+    def test_key_follows_inputs(self):
+        system = build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]])
+        key = system_key(system, 'Uff', 100, True)
+        self.assertEqual(key, system_key(build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]]), 'Uff', 100, True))
+        self.assertNotEqual(key, system_key(system, 'Uff', 200, True))
+        self.assertNotEqual(key, system_key(system, 'Uff', 100, False))
+        self.assertNotEqual(key, system_key(build_system([[0, 0, 0], [1.5, 0, 0]], [False, True], [[0, 1]]), 'Uff', 100, True))
+        self.assertNotEqual(key, system_key(build_system([[0, 0, 0], [1.6, 0, 0]], [True, False], [[0, 1]]), 'Uff', 100, True))
+        self.assertNotEqual(key, system_key(build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], []), 'Uff', 100, True))
+
+
+class ResultCacheTestCase(unittest.TestCase):
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ResultCache(max_entries=2)
+        cache.put('a', np.zeros((1, 1, 3)))
+        cache.put('b', np.ones((1, 1, 3)))
+        cache.get('a')
+        cache.put('c', np.ones((1, 1, 3)))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_disk_store_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            trajectory = np.arange(12, dtype=np.float32).reshape(2, 2, 3)
+            ResultCache(directory=directory).put('a', trajectory)
+            np.testing.assert_array_equal(ResultCache(directory=directory).get('a'), trajectory)
+
+            cache = ResultCache(directory=directory, max_stored=1)
+            cache.put('b', trajectory)
+            self.assertEqual(os.listdir(directory), ['b.npy'])
+
+    def test_recorder_thins_and_keeps_last_frame(self):
+        recorder = TrajectoryRecorder(max_frames=4)
+        for i in range(7):
+            recorder.add(np.full((1, 3), i))
+        np.testing.assert_array_equal(recorder.result()[:, 0, 0], [0, 4, 6])
+
+
+class CachedMinimizationTestCase(unittest.TestCase):
+
+    def test_repeated_request_is_replayed(self):
+        """A second identical minimization streams the cached result without running nanobabel."""
+        complex = Complex.io.from_pdb(path=f'{fixtures_dir}/1tyl.pdb')
+        for i, atom in enumerate(complex.atoms):
+            atom.index = i
+        for atom in next(iter(complex.residues)).atoms:
+            atom.selected = True
+        workspace = Workspace()
+        workspace.add_complex(complex)
+
+        stream = MagicMock()
+        stream.update.side_effect = lambda data, done_callback: done_callback()
+        plugin = MagicMock()
+
+        async def create_writing_stream(indices, stream_type):
+            return (stream, StreamCreationError.NoError)
+        plugin.create_writing_stream = create_writing_stream
+
+        async def minimize(process):
+            await process.start_process(workspace, 'Uff', 100, True)
+            await process.wait()
+            return stream.update.call_args[0][0]
+
+        process = MinimizationProcess(plugin, FAKE_NANOBABEL)
+        first = run_awaitable(minimize, process)
+        with patch('asyncio.create_subprocess_exec') as create_subprocess_exec:
+            second = run_awaitable(minimize, process)
+            create_subprocess_exec.assert_not_called()
+        np.testing.assert_allclose(second, first, atol=1e-4)
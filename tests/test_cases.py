@@ -1,26 +1,27 @@
 import asyncio
+import errno
 import os
+import tempfile
+import time
 import unittest
 from unittest.mock import patch
 from random import randint
 
+import numpy as np
+
 from unittest.mock import MagicMock
 from nanome.api.structure import Chain, Complex, Molecule, Workspace
+from nanome.util import Quaternion, Vector3
 from nanome.util.stream import StreamCreationError
 from plugin.Minimization import Minimization
+from plugin.nanobabel import NanobabelRun
+from plugin.system import NONBONDED_CUTOFF, PreparedSystem, prepare_system
+from tests.helpers import FAKE_NANOBABEL, run_awaitable
 
 
 fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
 
 
-def run_awaitable(awaitable, *args, **kwargs):
-    loop = asyncio.get_event_loop()
-    if loop.is_running:
-        loop = asyncio.new_event_loop()
-    loop.run_until_complete(awaitable(*args, **kwargs))
-    loop.close()
-
-
 class MinimizationTestCase(unittest.TestCase):
     """Test different combinations of args for calculate_interactions."""
 
@@ -32,8 +33,11 @@ class MinimizationTestCase(unittest.TestCase):
             atom.index = randint(1000000000, 9999999999)
 
         self.plugin_instance = Minimization()
-        self.plugin_instance.start()
+        with patch('plugin.Minimization.NANOBABEL', FAKE_NANOBABEL):
+            self.plugin_instance.start()
         self.plugin_instance._network = MagicMock()
+        self.plugin_instance.set_plugin_list_button = MagicMock()
+        self.plugin_instance.update_content = MagicMock()
 
         # Split out ligand into separate complex
         target_complex = self.complex
@@ -55,23 +59,24 @@ class MinimizationTestCase(unittest.TestCase):
         ligand_complex.index = 99
         self.workspace.add_complex(self.complex)
         self.workspace.add_complex(ligand_complex)
+        for atom in ligand_complex.atoms:
+            atom.selected = True
+
+        network_patcher = patch('nanome._internal.network.PluginNetwork._instance')
+        self.addCleanup(network_patcher.stop)
+        network_patcher.start()
+
+        # Nanome acks every streamed frame unless a test says otherwise
+        self.stream = MagicMock()
+        self.stream.update.side_effect = lambda data, done_callback: done_callback()
+        self.create_writing_stream_mock = self.mock_request('create_writing_stream', (self.stream, StreamCreationError.NoError))
+        self.mock_request('request_workspace', self.workspace)
 
-    @patch('nanome._internal.network.PluginNetwork._instance')
-    @patch('nanome.api.plugin_instance.PluginInstance.create_writing_stream')
-    @patch('nanome.api.plugin_instance.PluginInstance.request_workspace')
-    def test_start_minimization(self, request_workspace_mock, create_writing_stream_mock, mock_network):
+    def test_start_minimization(self):
         """Validate calculate_interactions call where ligand is on a separate complex."""
         ff = 'Uff'
         steps = 100
         steepest = True
-        # Set up mocked result for create_writing_stream_mock
-        stream_fut = asyncio.Future()
-        stream_fut.set_result((MagicMock(), StreamCreationError.NoError))
-        create_writing_stream_mock.return_value = stream_fut
-
-        ws_fut = asyncio.Future()
-        ws_fut.set_result(self.workspace)
-        request_workspace_mock.return_value = ws_fut
 
         return run_awaitable(self.validate_start_minimization, ff, steps, steepest)
 
@@ -79,3 +84,253 @@ class MinimizationTestCase(unittest.TestCase):
             self, ff, steps, steepest):
         """Run plugin.calculate_interactions with provided args and make sure lines are added to LineManager."""
         await self.plugin_instance.start_minimization(ff, steps, steepest)
+        process = self.plugin_instance._process
+        await process.wait()
+        self.assertFalse(process.is_running)
+        self.assertGreater(self.stream.update.call_count, 0)
+        self.stream.destroy.assert_called_once()
+        summary = process.metrics.runs[-1]
+        self.assertEqual(summary['frames_sent'], self.stream.update.call_count)
+        self.assertIsNotNone(summary['first_frame_seconds'])
+        self.assertFalse(summary['cancelled'])
+
+    def test_start_minimization_in_process(self):
+        """The numpy engine streams frames without nanobabel."""
+        self.plugin_instance._process.engine = 'numpy'
+        return run_awaitable(self.validate_start_minimization, 'Uff', 100, False)
+
+    def test_restart_resumes(self):
+        """A restart starts from the streamed positions, except for atoms the user moved since."""
+        return run_awaitable(self.validate_restart_resumes)
+
+    async def validate_restart_resumes(self):
+        await self.plugin_instance.start_minimization('Uff', 100, True)
+        process = self.plugin_instance._process
+        await process.wait()
+
+        # Nanome applies the last streamed positions, then the user nudges one ligand atom
+        atoms = {atom.index: atom for complex in self.workspace.complexes for atom in complex.atoms}
+        data = self.stream.update.call_args[0][0]
+        for i, index in enumerate(self.create_writing_stream_mock.call_args[0][0]):
+            atoms[index].position = Vector3(*data[3 * i:3 * i + 3])
+        ligand_atoms = list(self.workspace.complexes[1].atoms)
+        nudged = ligand_atoms[0]
+        nudged.position = Vector3(nudged.position.x + 1, nudged.position.y, nudged.position.z)
+
+        runs = process._MinimizationProcess__save__atoms(self.workspace, 7, 'Uff', 100, True, 'nanobabel')
+        system = runs[0].system
+        positions = {atom.index: position for atom, position in zip(system.atoms, system.positions.tolist())}
+        for atom in ligand_atoms:
+            expected = [atom.position.x, atom.position.y, atom.position.z]
+            np.testing.assert_allclose(positions[atom.index], expected, atol=1e-4)
+        runs[0].stop()
+
+    def test_record_and_replay(self):
+        """Recorded frames replay as they were streamed, and export onto copies of their complexes."""
+        with tempfile.TemporaryDirectory() as temp_dir:
+            self.plugin_instance._process.record_directory = temp_dir
+            self.plugin_instance._process.record_encoding = 'float32'
+            return run_awaitable(self.validate_record_and_replay)
+
+    async def validate_record_and_replay(self):
+        process = self.plugin_instance._process
+        await self.plugin_instance.start_minimization('Uff', 100, True)
+        await process.wait()
+        self.assertIsNotNone(process.recording)
+        streamed = [call[0][0] for call in self.stream.update.call_args_list]
+
+        self.stream.reset_mock()
+        process.target_update_rate = 1000
+        self.assertTrue(await process.replay())
+        replayed = [call[0][0] for call in self.stream.update.call_args_list]
+        np.testing.assert_array_equal(replayed, streamed)
+        self.stream.destroy.assert_called_once()
+
+        async def request_complexes(indices):
+            return [complex for complex in self.workspace.complexes if complex.index in indices]
+        self.plugin_instance.request_complexes = request_complexes
+        self.plugin_instance.add_to_workspace = MagicMock(side_effect=lambda complexes: asyncio.sleep(0))
+        exported = await process.export_recording()
+        self.assertEqual(len(exported), 2)
+        self.plugin_instance.add_to_workspace.assert_called_once_with(exported)
+
+    def test_minimize_all_frames(self):
+        """Every conformer of the selected complex is minimized and written back, without streaming."""
+        ligand_complex = self.workspace.complexes[1]
+        molecule = next(ligand_complex.molecules)
+        for conformer in (1, 2):
+            molecule.copy_conformer(0, conformer)
+        for atom in ligand_complex.atoms:
+            atom.positions[2] = Vector3(atom.positions[0].x, atom.positions[0].y + 0.5, atom.positions[0].z)
+        self.original = [[(p.x, p.y, p.z) for p in atom.positions] for atom in ligand_complex.atoms]
+        self.plugin_instance.update_structures_deep = MagicMock(side_effect=lambda complexes: asyncio.sleep(0))
+        self.plugin_instance.minimization_progress = MagicMock()
+        return run_awaitable(self.validate_minimize_all_frames)
+
+    async def validate_minimize_all_frames(self):
+        process = self.plugin_instance._process
+        ligand_complex = self.workspace.complexes[1]
+        await self.plugin_instance.start_minimization('Uff', 100, True, all_frames=True)
+        await process.wait()
+        self.assertFalse(process.is_running)
+        create_writing_stream = self.plugin_instance.create_writing_stream
+        create_writing_stream.assert_not_called()
+        # the fixture's ligand atoms are also listed in the protein, whose single frame is minimized too
+        self.plugin_instance.update_structures_deep.assert_called_once_with(list(self.workspace.complexes))
+        self.plugin_instance.minimization_progress.assert_called_with(4, 4)
+        minimized = np.array([[(p.x, p.y, p.z) for p in atom.positions] for atom in ligand_complex.atoms])
+        original = np.array(self.original)
+        # the scripted nanobabel shifts every atom along x, each conformer from where it was
+        for conformer in range(3):
+            self.assertTrue((minimized[:, conformer, 0] > original[:, conformer, 0]).all())
+            np.testing.assert_allclose(minimized[:, conformer, 1:], original[:, conformer, 1:], atol=1e-3)
+
+    def test_stop_minimization(self):
+        """Stopping a running minimization waits for nanobabel to exit and destroys the stream."""
+        self.stream.update.side_effect = None
+        return run_awaitable(self.validate_stop_minimization)
+
+    async def validate_stop_minimization(self):
+        await self.plugin_instance.start_minimization('Uff', 20000, True)
+        process = self.plugin_instance._process
+        # updates are never acked here, so the first frame holds the stream until stopped
+        deadline = time.monotonic() + 10
+        while self.stream.update.call_count == 0:
+            self.assertLess(time.monotonic(), deadline, 'No frame was streamed')
+            await asyncio.sleep(0.01)
+        self.assertTrue(process.is_running)
+        await process.stop_process()
+        self.assertFalse(process.is_running)
+        self.stream.destroy.assert_called_once()
+
+    def test_sender_failure(self):
+        """A failure to send frames is logged, stops the runs and still tears the minimization down."""
+        self.stream.update.side_effect = RuntimeError('stream closed')
+        self.plugin_instance._process.engine = 'numpy'
+        self.plugin_instance.minimization_done = MagicMock()
+        with patch('plugin.process.Logs.error') as error_mock:
+            run_awaitable(self.validate_sender_failure)
+        error_mock.assert_called_once_with('Minimization failed')
+
+    async def validate_sender_failure(self):
+        await self.plugin_instance.start_minimization('Uff', 20000, True)
+        process = self.plugin_instance._process
+        await asyncio.wait_for(process.wait(), 10)
+        self.assertFalse(process.is_running)
+        self.stream.destroy.assert_called_once()
+        self.plugin_instance.minimization_done.assert_called_once()
+        self.assertEqual(self.stream.update.call_count, 1)
+        self.assertFalse(process.metrics.runs[-1]['cancelled'])
+
+    def test_full_scratch_dir(self):
+        """Input files go to the regular temp directory when the scratch directory is full."""
+        scratch_dir = self.plugin_instance._process.temp_dir.name
+        write_sdf = PreparedSystem.write_sdf
+
+        def full_scratch(system, path):
+            if path.startswith(scratch_dir):
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            write_sdf(system, path)
+
+        with patch.object(PreparedSystem, 'write_sdf', full_scratch):
+            run_awaitable(self.validate_start_minimization, 'Uff', 100, True)
+
+    def test_unwritable_input_files(self):
+        """A minimization whose input files cannot be written is logged and reported done."""
+        self.plugin_instance.minimization_done = MagicMock()
+        with patch.object(PreparedSystem, 'write_sdf', side_effect=OSError(errno.ENOSPC, 'No space left on device')), \
+                patch('plugin.process.Logs.error') as error_mock:
+            run_awaitable(self.plugin_instance.start_minimization, 'Uff', 100, True)
+        error_mock.assert_called_once()
+        self.plugin_instance.minimization_done.assert_called_once()
+        self.assertFalse(self.plugin_instance._process.is_running)
+        self.create_writing_stream_mock.assert_not_called()
+
+    def test_stream_errors_remove_input_files(self):
+        """Runs set up for a stream that could not be created leave no files behind."""
+        errors = [StreamCreationError.AtomNotFound, StreamCreationError.UnsupportedStream]
+
+        async def create_writing_stream(indices, stream_type):
+            return (None, errors.pop(0))
+        self.create_writing_stream_mock.side_effect = create_writing_stream
+        self.plugin_instance.minimization_done = MagicMock()
+        run_awaitable(self.plugin_instance.start_minimization, 'Uff', 100, True)
+        self.assertEqual(self.create_writing_stream_mock.call_count, 2)
+        self.plugin_instance.minimization_done.assert_called_once()
+        self.assertFalse(self.plugin_instance._process.is_running)
+        self.assertEqual(os.listdir(self.plugin_instance._process.temp_dir.name), [])
+
+    def test_failed_run_stops_the_others(self):
+        """Once a run fails, the runs still going are stopped along with their nanobabel."""
+        # two atoms far enough apart to be minimized by separate runs
+        for atom in self.workspace.complexes[1].atoms:
+            atom.selected = False
+        atoms = list(self.complex.atoms)
+        first = atoms[0]
+        last = max(atoms, key=lambda atom: Vector3.distance(atom.position, first.position))
+        first.selected = last.selected = True
+        self.plugin_instance._process.max_parallel_runs = 2
+        failed = []
+        on_text = NanobabelRun._NanobabelRun__on_text
+
+        def fail_once(run, text):
+            if not failed:
+                failed.append(run)
+                raise ValueError('unreadable output')
+            on_text(run, text)
+
+        with patch.object(NanobabelRun, '_NanobabelRun__on_text', fail_once), \
+                patch.dict(os.environ, {'FAKE_NANOBABEL_FRAME_RATE': '20'}), \
+                patch('plugin.process.Logs.error') as error_mock:
+            run_awaitable(self.validate_failed_run_stops_the_others)
+        error_mock.assert_called_once_with('Minimization failed')
+
+    async def validate_failed_run_stops_the_others(self):
+        await self.plugin_instance.start_minimization('Uff', 100000, True)
+        process = self.plugin_instance._process
+        await asyncio.wait_for(process.wait(), 10)
+        runs = process._MinimizationProcess__runs
+        self.assertEqual(len(runs), 2)
+        self.assertTrue(all(run.is_done and not run.is_running for run in runs))
+        self.assertFalse(process.is_running)
+
+    def mock_request(self, name, result):
+        async def request(*args):
+            return result
+
+        patcher = patch(f'nanome.api.plugin_instance.PluginInstance.{name}', side_effect=request)
+        self.addCleanup(patcher.stop)
+        return patcher.start()
+
+    def shell_indices(self, radius):
+        # atoms listed by both complexes are only saved where they are first listed
+        positions = {}
+        for complex in self.workspace.complexes:
+            matrix = complex.get_complex_to_workspace_matrix()
+            for atom in complex.atoms:
+                positions.setdefault(atom.index, (atom, matrix * atom.position))
+        selected_positions = [pos for atom, pos in positions.values() if atom.selected]
+        indices = []
+        for index, (atom, pos) in positions.items():
+            if any(Vector3.distance(pos, selected) < radius for selected in selected_positions):
+                indices.append(index)
+        return indices
+
+    def test_save_atoms_shell(self):
+        """Make sure the saved shell matches a brute force search around the selected atoms."""
+        self.complex.position = Vector3(2, -3, 5)
+        self.complex.rotation = Quaternion(0, 0.3826834, 0, 0.9238795)
+        original_positions = [(atom.serial, atom.position.x, atom.position.y, atom.position.z) for atom in self.complex.atoms]
+        self.assertEqual(prepare_system(self.workspace, 7, trim=False).indices, self.shell_indices(7))
+
+        process = self.plugin_instance._process
+        runs = process._MinimizationProcess__save__atoms(self.workspace, 7, 'Uff', 100, True, 'nanobabel')
+        self.assertEqual(len(runs), 1)
+        system = runs[0].system
+        self.assertTrue(os.path.exists(runs[0].input_path))
+        # without bonds in the fixture, trimming keeps only the fixed atoms within nonbonded range
+        self.assertEqual(system.indices, self.shell_indices(NONBONDED_CUTOFF))
+        # workspace atoms are read in place and must be left untouched
+        self.assertEqual([(atom.serial, atom.position.x, atom.position.y, atom.position.z) for atom in self.complex.atoms], original_positions)
+        runs[0].stop()
+        self.assertFalse(os.path.exists(runs[0].run_dir))
@@ -0,0 +1,124 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+from unittest.mock import patch
+
+import numpy as np
+
+from plugin.convergence import ConvergenceMonitor
+from plugin.nanobabel import NanobabelRun
+from tests.helpers import FAKE_NANOBABEL, build_system
+
+
+class ConvergenceMonitorTestCase(unittest.TestCase):
+
+    def test_reads_openbabel_log(self):
+        monitor = ConvergenceMonitor(threshold=0.5, window=60)
+        log = (b"\nS T E E P E S T   D E S C E N T\n\nSTEPS = 100\n\n"
+               b"STEP n       E(n)         E(n-1)    \n------------------------------------\n"
+               b"    0    120.000      ----\n   20    110.000    110.500\n")
+        self.assertFalse(monitor.feed(memoryview(log)))
+        self.assertEqual((monitor.steps, monitor.energies), ([0, 20], [120.0, 110.0]))
+
+        self.assertFalse(monitor.feed(b"   40    109.800    109.810\n   60    109.700    109.710\n"))
+        # stable from step 20 to 80, long enough
+        self.assertTrue(monitor.feed(b"   80    109.600    109.610\n"))
+        self.assertEqual(monitor.converged_step, 80)
+        self.assertEqual(monitor.energy, 109.6)
+
+    def test_large_change_restarts_window(self):
+        monitor = ConvergenceMonitor(threshold=0.5, window=40)
+        monitor.feed(b"    0    10.0    ----\n   20    10.1    10.1\n   40    5.0    5.0\n   60    5.1    5.1\n")
+        self.assertFalse(monitor.is_converged)
+        self.assertTrue(monitor.feed(b"   80    5.2    5.2\n"))
+
+    def test_disabled_without_threshold(self):
+        monitor = ConvergenceMonitor(threshold=None, window=0)
+        self.assertFalse(monitor.feed(b"    0    10.0    ----\n   20    10.0    10.0\n"))
+        self.assertEqual(len(monitor.steps), 2)
+
+
+class EarlyStopTestCase(unittest.TestCase):
+
+    def test_stops_after_the_converged_frame(self):
+        system = build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]])
+        for atom in system.atoms:
+            atom.symbol = 'C'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            run = NanobabelRun(system, temp_dir, coalesce_frames=False, energy_threshold=0.01, convergence_window=100)
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(run.run(FAKE_NANOBABEL, 'Uff', 5000, True))
+            loop.close()
+
+        self.assertTrue(run.succeeded)
+        converged_step = run.convergence.converged_step
+        self.assertIsNotNone(converged_step)
+        self.assertLess(converged_step, 5000)
+        frames = []
+        while run.has_frames:
+            frames.append(run.pop_positions()[0])
+        # frames move x by 0.001 per step, the last one streamed is the converged one
+        self.assertEqual(len(frames), converged_step // 20 + 1)
+        self.assertAlmostEqual(float(frames[-1]), converged_step * 0.001, places=3)
+
+
+class ProtocolTestCase(unittest.TestCase):
+
+    def test_prepass_switches_once_energy_drops_slowly(self):
+        monitor = ConvergenceMonitor(threshold=None, window=0)
+        monitor.feed(b"    0    500.0    ----\n   20    100.0    100.0\n   40    80.0    80.0\n")
+        self.assertEqual(monitor.drop_rate, 1.0)
+        self.assertFalse(monitor.prepass_over())
+        monitor.feed(b"   60    79.0    79.0\n")
+        self.assertTrue(monitor.prepass_over())
+
+    def test_refinement_continues_from_the_prepass(self):
+        system = build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]])
+        for atom in system.atoms:
+            atom.symbol = 'C'
+        with tempfile.TemporaryDirectory() as temp_dir:
+            run = NanobabelRun(system, temp_dir, coalesce_frames=False, energy_threshold=None)
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(run.run(FAKE_NANOBABEL, 'Uff', 200, True, protocol=True))
+            loop.close()
+
+        self.assertTrue(run.succeeded)
+        self.assertEqual(run.convergence.steps, list(range(0, 201, 20)))
+        frames = []
+        while run.has_frames:
+            frames.append(float(run.pop_positions()[0]))
+        # the pre-pass stops at step 60, the refinement picks up from its last frame without jumping back
+        np.testing.assert_allclose(frames[:4], [0.0, 0.02, 0.04, 0.06], atol=1e-6)
+        self.assertTrue(all(later >= earlier for earlier, later in zip(frames, frames[1:])))
+        self.assertAlmostEqual(frames[-1], 0.2, places=3)
+
+
+class StopTestCase(unittest.TestCase):
+
+    def test_stop_terminates_nanobabel(self):
+        """Stopping a run terminates its nanobabel, even when nothing cancels the run itself."""
+        system = build_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]])
+        for atom in system.atoms:
+            atom.symbol = 'C'
+
+        async def main(run):
+            task = asyncio.ensure_future(run.run(FAKE_NANOBABEL, 'Uff', 100000, True))
+            deadline = time.monotonic() + 10
+            while not run.has_frames:
+                self.assertLess(time.monotonic(), deadline, 'nanobabel never streamed a frame')
+                await asyncio.sleep(0.01)
+            await asyncio.wait_for(run.stop(), 5)
+            await asyncio.wait_for(task, 5)
+
+        with tempfile.TemporaryDirectory() as temp_dir, patch.dict(os.environ, {'FAKE_NANOBABEL_FRAME_RATE': '20'}):
+            run = NanobabelRun(system, temp_dir)
+            loop = asyncio.new_event_loop()
+            loop.run_until_complete(main(run))
+            loop.close()
+            self.assertFalse(os.path.exists(run.run_dir))
+        self.assertTrue(run.is_done)
+        self.assertFalse(run.is_running)
+        self.assertNotEqual(run.return_code, 0)
+        self.assertIsNone(run.stop())
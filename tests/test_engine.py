@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+import numpy as np
+
+from plugin.engine import EngineRun, Minimizer
+from plugin.forcefield import ForceField
+from tests.helpers import build_system
+
+
+def butene(selected=(True, True, True, True, False)):
+    """Bent 2-butene with its double bond, next to a fixed atom."""
+    positions = [[0, 0, 0], [1.4, 0.3, 0], [2.1, 1.5, 0.2], [3.6, 1.6, 0.5], [2.0, -1.5, 2.5]]
+    system = build_system(positions, list(selected), [[0, 1], [1, 2], [2, 3]])
+    system.bond_kinds[1] = 2
+    return system
+
+
+class ForceFieldTestCase(unittest.TestCase):
+
+    def test_gradient_matches_energy(self):
+        system = butene()
+        force_field = ForceField(system)
+        positions = system.positions
+        gradient = np.zeros_like(positions)
+        force_field.energy(positions, gradient)
+
+        step = 1e-6
+        numeric = np.zeros_like(positions)
+        for i in range(len(positions)):
+            for axis in range(3):
+                shift = np.zeros_like(positions)
+                shift[i, axis] = step
+                numeric[i, axis] = (force_field.energy(positions + shift) - force_field.energy(positions - shift)) / (2 * step)
+        # the fixed atom's own gradient is left out with every term between fixed atoms only
+        np.testing.assert_allclose(gradient[:4], numeric[:4], rtol=1e-5, atol=1e-5)
+
+
+class MinimizerTestCase(unittest.TestCase):
+
+    def test_lowers_energy_and_keeps_fixed_atoms(self):
+        for conjugate in (False, True):
+            system = butene(selected=(True, True, False, False, False))
+            minimizer = Minimizer(ForceField(system), system.positions, conjugate)
+            start = minimizer.energy
+            minimizer.run(200)
+            self.assertLess(minimizer.energy, start)
+            np.testing.assert_array_equal(minimizer.positions[2:], system.positions[2:])
+            # the short C1-C2 bond relaxes toward UFF's single bond length
+            self.assertLess(abs(np.linalg.norm(minimizer.positions[1] - minimizer.positions[0]) - 1.514), 0.05)
+
+
+class EngineRunTestCase(unittest.TestCase):
+
+    def test_streams_frames(self):
+        run = EngineRun(butene(), coalesce_frames=False)
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(run.run('Uff', 100, False))
+        loop.close()
+
+        self.assertTrue(run.succeeded)
+        self.assertEqual(len(run.frames), len(run.convergence.steps) - 1)
+        last = None
+        while run.has_frames:
+            last = run.pop_positions().reshape(-1, 3)
+        np.testing.assert_array_equal(last[4], run.system.positions[4])
+        self.assertEqual(len(run.trajectory), len(run.convergence.steps) - 1)
+
+    def test_protocol_refines_the_prepass(self):
+        # without an energy threshold, every run takes all of its steps
+        runs = [EngineRun(butene(), coalesce_frames=False, energy_threshold=None) for _ in range(3)]
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(runs[0].run('Uff', 2000, True, protocol=True))
+        loop.run_until_complete(runs[1].run('Uff', 2000, False))
+        loop.run_until_complete(runs[2].run('Uff', 2000, True))
+        loop.close()
+
+        protocol, conjugate, steepest = (run.convergence.energy for run in runs)
+        self.assertTrue(runs[0].succeeded)
+        self.assertAlmostEqual(protocol, conjugate, places=3)
+        self.assertLess(protocol, steepest)
@@ -0,0 +1,102 @@
+import os
+import unittest
+
+import numpy as np
+from nanome.api.structure import Complex
+from nanome.util import Quaternion, Vector3
+from plugin.frames import FrameDecoder, StepParser
+
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class FrameDecoderTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.pdb_path = f'{fixtures_dir}/1tyl.pdb'
+        self.complex = Complex.io.from_pdb(path=self.pdb_path)
+        self.complex.position = Vector3(2, -3, 5)
+        self.complex.rotation = Quaternion(0, 0.3826834, 0, 0.9238795)
+        self.atoms = list(self.complex.atoms)
+
+    def test_decode_matches_pdb_parser(self):
+        """Decoded positions should match parsing the frame with Complex.io.from_pdb."""
+        decoder = FrameDecoder([atom.serial for atom in self.atoms], [self.complex] * len(self.atoms))
+        with open(self.pdb_path, 'rb') as f:
+            positions = decoder.decode(f.read())
+
+        matrix = self.complex.get_workspace_to_complex_matrix()
+        expected = []
+        for atom in self.atoms:
+            relative = matrix * atom.position
+            expected.extend([relative.x, relative.y, relative.z])
+        np.testing.assert_array_equal(positions, np.array(expected, dtype=np.float32))
+
+    def test_decode_matches_records_in_serial_order(self):
+        """Records should be matched to atoms in serial order, whatever their serial field says."""
+        decoder = FrameDecoder([5, 3], [self.complex, self.complex])
+        frame = b'\n'.join([
+            b'REMARK this line is not a record and is long enough to be checked',
+            b'HETATM    3  C1  UNL     1      -1.000 100.500  -0.250  1.00  0.00           C',
+            b'HETATM*****  C2  UNL     1    -100.125   0.000   1.000  1.00  0.00           C',
+            b'HETATM    4  C3  UNL     1       9.000   9.000   9.000  1.00  0.00           C',
+        ])
+        positions = decoder.decode(frame).reshape(-1, 3)
+        matrix = self.complex.get_workspace_to_complex_matrix()
+        for position, source in zip(positions, [(-100.125, 0, 1), (-1, 100.5, -0.25)]):
+            relative = matrix * Vector3(*source)
+            np.testing.assert_allclose(position, [relative.x, relative.y, relative.z], rtol=1e-6)
+
+    def test_decode_past_99999_atoms(self):
+        """Serials wrap or overflow past 99,999 atoms, and every atom should still get its own position."""
+        atom_count = 100005
+        decoder = FrameDecoder(np.arange(1, atom_count + 1), [Complex()] * atom_count)
+        expected = np.zeros((atom_count, 3))
+        expected[:, 0] = np.arange(atom_count) % 1000
+        expected[:, 1] = np.arange(atom_count) // 1000
+        for serial_field in [lambda serial: '%5d' % (serial % 100000), lambda serial: '%5d' % serial if serial < 100000 else '*****']:
+            lines = []
+            for i, (x, y, z) in enumerate(expected):
+                lines.append('HETATM%s  C   UNL     1    %8.3f%8.3f%8.3f  1.00  0.00           C' % (serial_field(i + 1), x, y, z))
+            positions = decoder.decode('\n'.join(lines).encode())
+            np.testing.assert_array_equal(positions.reshape(-1, 3), expected.astype(np.float32))
+            decoder.place(np.zeros((atom_count, 3)))
+
+
+class StepParserTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.frames = [
+            b'HETATM    1  C1  UNL     1       0.000   0.000   0.000\nHETATM    2  O1  UNL     1       1.000   0.000   0.000\n',
+            b'HETATM    1  C1  UNL     1       0.100   0.000   0.000\nHETATM    2  O1  UNL     1       0.900   0.000   0.000\n',
+        ]
+        self.output = b''.join([
+            b'    0     12.500    ----\n',
+            b'Step update start\n', self.frames[0], b'Step update end\n',
+            b'   20     10.000    12.500\n',
+            b'Step update start\n', self.frames[1], b'Step update end\n',
+            b'done',
+        ])
+
+    def parse(self, chunks):
+        frames = []
+        text = []
+        parser = StepParser(lambda frame: frames.append(bytes(frame)), lambda view: text.append(bytes(view)))
+        for chunk in chunks:
+            parser.feed(chunk)
+        parser.flush()
+        return frames, b''.join(text)
+
+    def test_single_chunk(self):
+        frames, text = self.parse([self.output])
+        self.assertEqual(frames, self.frames)
+        self.assertEqual(text, b'    0     12.500    ----\n   20     10.000    12.500\ndone')
+
+    def test_split_chunks(self):
+        """Frames should survive output split at any byte, including inside markers."""
+        expected = self.parse([self.output])
+        for size in [1, 2, 5, 17, 64]:
+            chunks = [self.output[i:i + size] for i in range(0, len(self.output), size)]
+            self.assertEqual(self.parse(chunks), expected)
+        for split in range(len(self.output)):
+            self.assertEqual(self.parse([self.output[:split], self.output[split:]]), expected)
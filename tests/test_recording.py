@@ -0,0 +1,75 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from nanome.api.structure import Complex
+from plugin.recording import CHUNK_FRAMES, DELTA_ENCODING, DELTA_PRECISION, FLOAT32_ENCODING, TrajectoryReader, TrajectoryWriter, export_frames
+
+fixtures_dir = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+class RecordingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.temp_dir.name, 'run.traj')
+        rng = np.random.default_rng(0)
+        self.origin = rng.uniform(-50, 50, 30).astype(np.float32)
+        # more frames than a chunk holds, drifting a little at every frame
+        self.frames = (self.origin + np.cumsum(rng.normal(0, 0.05, (CHUNK_FRAMES + 10, 30)), axis=0)).astype(np.float32)
+
+    def tearDown(self):
+        self.temp_dir.cleanup()
+
+    def record(self, encoding, frames):
+        writer = TrajectoryWriter(self.path, np.arange(10) + 100, [7] * 10, self.origin, encoding)
+        for step, frame in enumerate(frames):
+            writer.append(frame, 20 * step, -float(step))
+        writer.close()
+        return TrajectoryReader(self.path)
+
+    def test_float32_round_trip(self):
+        reader = self.record(FLOAT32_ENCODING, self.frames)
+        self.assertEqual(len(reader), len(self.frames))
+        np.testing.assert_array_equal(reader.indices, np.arange(10) + 100)
+        np.testing.assert_array_equal(reader.complex_indices, [7] * 10)
+        np.testing.assert_array_equal(np.stack([positions.copy() for _, positions in reader.frames()]), self.frames)
+        np.testing.assert_array_equal(reader.frame(CHUNK_FRAMES + 3), self.frames[CHUNK_FRAMES + 3])
+        self.assertEqual(reader.steps[-1], 20 * (len(self.frames) - 1))
+        self.assertEqual(reader.energies[2], -2.0)
+
+    def test_delta_is_compact_and_precise(self):
+        reader = self.record(DELTA_ENCODING, self.frames)
+        frames = np.stack([positions.copy() for _, positions in reader.frames()])
+        np.testing.assert_allclose(frames, self.frames, atol=DELTA_PRECISION)
+        np.testing.assert_allclose(reader.frame(CHUNK_FRAMES + 3), self.frames[CHUNK_FRAMES + 3], atol=DELTA_PRECISION)
+        self.assertEqual([number for number, _ in reader.frames([1, CHUNK_FRAMES + 5])], [1, CHUNK_FRAMES + 5])
+        delta_size = os.path.getsize(self.path)
+        float32_size = os.path.getsize(self.record(FLOAT32_ENCODING, self.frames).path)
+        # half the size, but for the header
+        self.assertLess(delta_size, 0.6 * float32_size)
+
+    def test_delta_catches_up_on_large_moves(self):
+        jumped = self.origin + 40
+        reader = self.record(DELTA_ENCODING, [jumped, jumped])
+        self.assertGreater(np.abs(reader.frame(0) - jumped).max(), 1)
+        np.testing.assert_allclose(reader.frame(1), jumped, atol=DELTA_PRECISION)
+
+    def test_export_frames(self):
+        complex = Complex.io.from_pdb(path=os.path.join(fixtures_dir, '1tyl.pdb'))
+        complex.index = 7
+        atoms = list(complex.atoms)[:10]
+        for i, atom in enumerate(atoms):
+            atom.index = 100 + i
+        reader = self.record(DELTA_ENCODING, self.frames)
+
+        export_frames(reader, complex, max_frames=5)
+        molecule = next(complex.molecules)
+        self.assertEqual(molecule.conformer_count, 5)
+        self.assertEqual(molecule.current_conformer, 4)
+        last = [atoms[1].positions[4].x, atoms[1].positions[4].y, atoms[1].positions[4].z]
+        np.testing.assert_allclose(last, self.frames[-1][3:6], atol=DELTA_PRECISION)
+        # atoms that were not recorded keep their position in every frame
+        unrecorded = list(complex.atoms)[20]
+        self.assertEqual(unrecorded.positions[0].x, unrecorded.positions[4].x)
@@ -0,0 +1,145 @@
+import asyncio
+import threading
+import unittest
+from unittest.mock import MagicMock, patch
+
+from plugin import scheduler
+from plugin.scheduler import INTEGRATION_PRIORITY, MENU_PRIORITY, RunScheduler, SchedulerClient, start_scheduler
+
+
+class RunSchedulerTestCase(unittest.TestCase):
+
+    def test_sessions_take_turns(self):
+        runs = RunScheduler(max_runs=1)
+        first = runs.request('a')
+        queued = [runs.request('a'), runs.request('a'), runs.request('b'), runs.request('b')]
+        # a was just served, so b goes first and the sessions then alternate
+        self.assertEqual([runs.poll(ticket)[0] for ticket in queued], [1, 3, 0, 2])
+        runs.release(first)
+        self.assertEqual(runs.poll(queued[2]), (None, None))
+        runs.release(queued[2])
+        self.assertIsNone(runs.poll(queued[0])[0])
+
+    def test_integration_goes_first(self):
+        runs = RunScheduler(max_runs=1)
+        first = runs.request('a', MENU_PRIORITY)
+        menu = runs.request('a', MENU_PRIORITY)
+        integration = runs.request('b', INTEGRATION_PRIORITY)
+        self.assertEqual(runs.poll(integration)[0], 0)
+        self.assertEqual(runs.poll(menu)[0], 1)
+        runs.release(first)
+        self.assertIsNone(runs.poll(integration)[0])
+
+    def test_cpu_affinity(self):
+        with patch.object(scheduler, 'available_cpus', return_value=[2, 5]):
+            runs = RunScheduler(max_runs=3, cpu_affinity=True)
+        tickets = [runs.request('a') for _ in range(3)]
+        self.assertEqual([runs.poll(ticket)[1] for ticket in tickets], [2, 5, None])
+        runs.release(tickets[0])
+        self.assertEqual(runs.poll(runs.request('a'))[1], 2)
+
+    def test_expired_tickets_free_their_slot(self):
+        runs = RunScheduler(max_runs=1)
+        crashed = runs.request('a')
+        waiting = runs.request('b')
+        later = scheduler.time.monotonic() + scheduler.LEASE_TIMEOUT + 1
+        with patch.object(scheduler.time, 'monotonic', return_value=later):
+            # only the ticket still being renewed survives
+            runs.poll(waiting)
+        self.assertEqual(runs.stats()['running'], 1)
+        self.assertIsNone(runs.poll(waiting)[0])
+        self.assertRaises(KeyError, runs.poll, crashed)
+
+    def test_shared_across_processes(self):
+        manager, shared = start_scheduler(max_runs=1)
+        try:
+            ticket = shared.request('a')
+            self.assertEqual(shared.poll(shared.request('b')), (0, None))
+            shared.release(ticket)
+            self.assertEqual(shared.stats()['running'], 1)
+        finally:
+            manager.shutdown()
+
+
+class SchedulerClientTestCase(unittest.TestCase):
+
+    def test_slot_reports_queue_position(self):
+        runs = RunScheduler(max_runs=1)
+        blocking = runs.request('other')
+        positions = []
+
+        async def wait_for_slot():
+            async with SchedulerClient(runs, 'session').slot(on_position=positions.append):
+                self.assertEqual(runs.stats(), {'running': 1, 'waiting': 0, 'max_runs': 1})
+
+        async def main():
+            waiting = asyncio.ensure_future(wait_for_slot())
+            await asyncio.sleep(0.05)
+            runs.release(blocking)
+            await waiting
+
+        loop = asyncio.new_event_loop()
+        with patch.object(scheduler, 'POLL_INTERVAL', 0.01):
+            loop.run_until_complete(main())
+        loop.close()
+        self.assertEqual(positions, [0])
+        self.assertEqual(runs.stats()['running'], 0)
+
+    def test_expired_slot_is_released(self):
+        """Renewing a slot whose lease ran out stops renewing instead of failing, off the plugin loop."""
+        threads = []
+
+        def poll(ticket):
+            threads.append(threading.current_thread())
+            if len(threads) > 1:
+                raise KeyError(ticket)
+            return (None, None)
+
+        runs = MagicMock()
+        runs.request.return_value = 0
+        runs.poll.side_effect = poll
+
+        async def main():
+            async with SchedulerClient(runs, 'session').slot():
+                await asyncio.sleep(0.05)
+
+        loop = asyncio.new_event_loop()
+        with patch.object(scheduler, 'LEASE_TIMEOUT', 0.03), patch.object(scheduler.Logs, 'warning') as warning_mock:
+            loop.run_until_complete(main())
+        loop.close()
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+        warning_mock.assert_called_once()
+        runs.release.assert_called_once_with(0)
+
+    def test_cancelled_request_is_released(self):
+        """A slot cancelled while its request is on its way still gives the ticket back."""
+        requested = threading.Event()
+        answer = threading.Event()
+
+        def request(session, priority):
+            requested.set()
+            answer.wait(5)
+            return 7
+
+        runs = MagicMock()
+        runs.request.side_effect = request
+
+        async def wait_for_slot():
+            async with SchedulerClient(runs, 'session').slot():
+                self.fail('the slot was cancelled before it was granted')
+
+        async def main():
+            waiting = asyncio.ensure_future(wait_for_slot())
+            await asyncio.get_event_loop().run_in_executor(None, requested.wait, 5)
+            waiting.cancel()
+            await asyncio.sleep(0.01)
+            answer.set()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(main())
+        loop.close()
+        runs.release.assert_called_once_with(7)
+        runs.poll.assert_not_called()
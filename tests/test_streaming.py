@@ -0,0 +1,50 @@
+import unittest
+
+from plugin.streaming import FlowControl, FrameQueue
+
+
+class FrameQueueTestCase(unittest.TestCase):
+
+    def test_coalesce_keeps_newest_frame(self):
+        queue = FrameQueue(coalesce=True)
+        for frame in range(5):
+            queue.push(frame)
+        self.assertEqual(len(queue), 1)
+        self.assertEqual(queue.pop(), 4)
+        self.assertEqual((queue.received, queue.coalesced, queue.dropped), (5, 4, 0))
+
+    def test_sequential_keeps_every_frame(self):
+        queue = FrameQueue(coalesce=False)
+        for frame in range(3):
+            queue.push(frame)
+        self.assertEqual(queue.pop(), 0)
+        queue.clear()
+        self.assertEqual((queue.received, queue.coalesced, queue.dropped), (3, 0, 2))
+
+
+class FlowControlTestCase(unittest.TestCase):
+
+    def test_window_follows_round_trip_time(self):
+        flow = FlowControl(target_rate=10, max_in_flight=4)
+        self.assertTrue(flow.can_send(0.0))
+        flow.on_sent(0, 0.0)
+        # a single packet is in flight until the first round trip is measured
+        self.assertFalse(flow.can_send(1.0))
+        self.assertIsNone(flow.send_delay(1.0))
+        self.assertAlmostEqual(flow.on_acked(0, 0.3), 0.3)
+        self.assertAlmostEqual(flow.round_trip_time, 0.3)
+        self.assertEqual(flow.window, 3)
+
+        flow.on_sent(1, 1.0)
+        # paced to the target rate even when the window has room
+        self.assertFalse(flow.can_send(1.05))
+        self.assertAlmostEqual(flow.send_delay(1.05), 0.05)
+        self.assertTrue(flow.can_send(1.1))
+
+    def test_window_is_bounded(self):
+        flow = FlowControl(target_rate=30, max_in_flight=4)
+        flow.on_sent(0, 0.0)
+        flow.on_acked(0, 10.0)
+        self.assertEqual(flow.window, 4)
+        flow.on_acked(0, 20.0)
+        self.assertEqual(flow.acked, 1)
@@ -0,0 +1,216 @@
+import unittest
+
+import numpy as np
+from nanome.api.structure import Bond, Complex, Workspace
+from plugin.forcefield import ForceField
+from plugin.geometry import connected_components
+from nanome.util import Vector3
+from plugin.system import NONBONDED_CUTOFF, ComplexFrame, TopologyCache, WarmStart, all_frames, assemble_system, interaction_cutoff, prepare_system, split_clusters, trim_fixed_atoms
+from tests.helpers import build_system
+
+
+class TrimFixedAtomsTestCase(unittest.TestCase):
+
+    def test_keeps_bonded_neighbours(self):
+        """A chain leaving the interaction range stays bonded up to a torsion away, plus one typing neighbour."""
+        positions = np.array([[i * 10.0, 0, 0] for i in range(7)] + [[0, 3.0, 0], [0, 20.0, 0]])
+        selected = np.zeros(len(positions), dtype=bool)
+        selected[0] = True
+        bonds = np.array([[i, i + 1] for i in range(6)])
+        keep = trim_fixed_atoms(positions, selected, bonds, 6.0)
+        np.testing.assert_array_equal(keep, [True] * 5 + [False, False, True, False])
+
+
+def scattered_workspace():
+    """Workspace of a selected carbon, with fixed carbons from 3 to 12 A away, indexed as Nanome would."""
+    distances = [0, 3, 5, 7, 9, 12]
+    lines = ['', '', '', '%3d  0  0  0  0  0            999 V2000' % len(distances)]
+    lines += ['%10.4f    0.0000    0.0000 C   0  0' % distance for distance in distances]
+    lines += ['M  END']
+    complex = Complex.io.from_sdf(lines=lines)
+    workspace = Workspace()
+    workspace.add_complex(complex)
+    complex.index = 1
+    for i, atom in enumerate(complex.atoms):
+        atom.index = 10 + i
+        atom.selected = i == 0
+    return workspace
+
+
+def coulomb_energy(system):
+    """Electrostatic energy between movable and fixed atoms, with alternating unit charges."""
+    charges = np.where(np.array(system.indices) % 2 == 0, 1.0, -1.0)
+    movable = system.selected
+    distances = np.linalg.norm(system.positions[movable][:, None] - system.positions[~movable][None], axis=2)
+    return float((charges[movable][:, None] * charges[~movable][None] / distances).sum())
+
+
+class TrimEnergyTestCase(unittest.TestCase):
+
+    def test_charged_force_fields_keep_every_fixed_atom(self):
+        """Trimming must not change the energy the movable atoms see under a force field with electrostatics."""
+        workspace = scattered_workspace()
+        untrimmed = prepare_system(workspace, 13, trim=False)
+        for ff in ['Gaff', 'Ghemical', 'MMFF94', 'MMFF94s']:
+            self.assertIsNone(interaction_cutoff(ff))
+            trimmed = prepare_system(workspace, 13, interaction_cutoff(ff))
+            self.assertAlmostEqual(coulomb_energy(trimmed), coulomb_energy(untrimmed))
+        # the van der Waals range alone would drop atoms that still attract the movable one
+        vdw_trimmed = prepare_system(workspace, 13, NONBONDED_CUTOFF)
+        self.assertNotAlmostEqual(coulomb_energy(vdw_trimmed), coulomb_energy(untrimmed))
+
+    def test_uff_trims_to_van_der_waals_range(self):
+        workspace = scattered_workspace()
+        untrimmed = prepare_system(workspace, 13, trim=False)
+        trimmed = prepare_system(workspace, 13, interaction_cutoff('Uff'))
+        self.assertEqual(len(trimmed), 3)
+        self.assertAlmostEqual(ForceField(trimmed).energy(trimmed.positions), ForceField(untrimmed).energy(untrimmed.positions))
+
+
+class SplitClustersTestCase(unittest.TestCase):
+
+    def test_connected_components(self):
+        labels = connected_components(6, np.array([[4, 5], [1, 3], [3, 0]]))
+        np.testing.assert_array_equal(labels, [0, 0, 1, 0, 2, 2])
+
+    def test_distant_selections_split(self):
+        positions = [[0, 0, 0], [3, 0, 0], [40, 0, 0], [43, 0, 0], [10, 0, 0]]
+        system = build_system(positions, [True, False, True, False, True], [])
+        clusters = split_clusters(system, 7)
+        self.assertEqual([cluster.positions[:, 0].tolist() for cluster in clusters], [[0, 3, 10], [40, 43]])
+
+    def test_bonded_atoms_stay_together(self):
+        # selections 15 A apart are independent at a 7 A cutoff, unless their shells are bonded
+        positions = [[0, 0, 0], [6.5, 0, 0], [8.5, 0, 0], [15, 0, 0]]
+        self.assertEqual(len(split_clusters(build_system(positions, [True, False, False, True], []), 7)), 2)
+        clusters = split_clusters(build_system(positions, [True, False, False, True], [[1, 2]]), 7)
+        self.assertEqual(len(clusters), 1)
+        np.testing.assert_array_equal(clusters[0].bonds, [[1, 2]])
+
+
+def butane_workspace():
+    """Workspace of a selected four carbon chain, indexed as Nanome would."""
+    lines = ['', '', '', '  4  3  0  0  0  0            999 V2000']
+    lines += ['%10.4f    0.0000    0.0000 C   0  0' % (1.5 * i) for i in range(4)]
+    lines += ['  1  2  1  0', '  2  3  2  0', '  3  4  1  0', 'M  END']
+    complex = Complex.io.from_sdf(lines=lines)
+    workspace = Workspace()
+    workspace.add_complex(complex)
+    complex.index = 1
+    for i, atom in enumerate(complex.atoms):
+        atom.index = 10 + i
+        atom.selected = True
+    for i, bond in enumerate(complex.bonds):
+        bond.index = 20 + i
+    return workspace
+
+
+class TopologyCacheTestCase(unittest.TestCase):
+
+    def test_reused_until_bonds_change(self):
+        workspace = butane_workspace()
+        topologies = TopologyCache()
+        system = prepare_system(workspace, 7, topologies=topologies)
+        np.testing.assert_array_equal(system.bonds, [[0, 1], [1, 2], [2, 3]])
+        np.testing.assert_array_equal(system.bond_kinds, [1, 2, 1])
+        np.testing.assert_array_equal(prepare_system(workspace, 7).bonds, system.bonds)
+
+        prepare_system(workspace, 7, topologies=topologies)
+        self.assertEqual((topologies.hits, topologies.misses), (1, 1))
+
+        atoms = list(workspace.complexes[0].atoms)
+        bond = Bond()
+        bond.atom1 = atoms[0]
+        bond.atom2 = atoms[3]
+        atoms[0].residue.add_bond(bond)
+        bond.index = 30
+        system = prepare_system(workspace, 7, topologies=topologies)
+        self.assertEqual((topologies.hits, topologies.misses), (1, 2))
+        # bonds are listed by their later atom, as it lists them
+        np.testing.assert_array_equal(system.bonds, [[0, 1], [1, 2], [2, 3], [0, 3]])
+
+    def test_shell_keeps_bonds_between_its_atoms(self):
+        workspace = butane_workspace()
+        for atom in workspace.complexes[0].atoms:
+            atom.selected = atom.index == 10
+        system = prepare_system(workspace, 2, trim=False, topologies=TopologyCache())
+        self.assertEqual(len(system), 2)
+        np.testing.assert_array_equal(system.bonds, [[0, 1]])
+
+    def test_unindexed_complexes_are_not_cached(self):
+        workspace = butane_workspace()
+        workspace.complexes[0].index = -1
+        topologies = TopologyCache()
+        prepare_system(workspace, 7, topologies=topologies)
+        self.assertEqual(len(topologies), 0)
+
+
+class ComplexFrameTestCase(unittest.TestCase):
+
+    def test_every_conformer_is_a_frame(self):
+        workspace = butane_workspace()
+        complex = workspace.complexes[0]
+        molecule = next(complex.molecules)
+        molecule.copy_conformer(0, 1)
+        for atom in complex.atoms:
+            atom.positions[1] = Vector3(atom.positions[0].x, 1, 0)
+        self.assertEqual(list(all_frames(complex)), [(molecule, 0), (molecule, 1)])
+
+        topologies = TopologyCache()
+        frame = ComplexFrame(complex, molecule, 1, [True, False, False, False], topologies)
+        system = assemble_system([frame], 2, trim=False)
+        np.testing.assert_array_equal(system.positions, [[0, 1, 0], [1.5, 1, 0]])
+        np.testing.assert_array_equal(system.selected, [True, False])
+        np.testing.assert_array_equal(system.bonds, [[0, 1]])
+        self.assertEqual(len(assemble_system([frame.fixed()], 2)), 0)
+        np.testing.assert_array_equal(frame.selected, [True, False, False, False])
+
+
+class SerializationTestCase(unittest.TestCase):
+
+    def test_sdf_text(self):
+        system = build_system([[0, 0, 0], [1.5, -0.25, 0]], [True, False], [[0, 1]])
+        system.atoms[1].symbol = 'O'
+        system.atoms[1].formal_charge = -1
+        lines = system.sdf_text().split('\n')
+        self.assertEqual(lines[5], 'M  V30 COUNTS 2 1 0 0 0')
+        self.assertEqual(lines[7:9], ['M  V30 1 C 0.0000 0.0000 0.0000 0 ', 'M  V30 2 O 1.5000 -0.2500 0.0000 0 CHG=-1'])
+        self.assertEqual(lines[11], 'M  V30 1 1 1 2')
+        self.assertEqual(lines[-1], 'M  END')
+        self.assertEqual(system.constraints_text(), 'ATOM:FIXED:2\n')
+
+
+class WarmStartTestCase(unittest.TestCase):
+
+    def indexed_system(self, positions, selected, bonds):
+        system = build_system(positions, selected, bonds)
+        for i, atom in enumerate(system.atoms):
+            atom.index = 100 + i
+        return system
+
+    def test_resumes_untouched_atoms(self):
+        system = self.indexed_system([[0, 0, 0], [1.5, 0, 0], [3, 0, 0]], [True, True, False], [[0, 1], [1, 2]])
+        warm_start = WarmStart(7)
+        sent = system.positions + 0.5
+        latest = system.positions + 1.0
+        warm_start.add(system, sent, latest)
+
+        # the first atom was nudged by the user, the others are where they were streamed to
+        restarted = self.indexed_system(sent + [[2, 0, 0], [0, 0, 0], [0, 0, 0]], [True, True, False], [[0, 1], [1, 2]])
+        self.assertEqual(warm_start.resume(restarted), 2)
+        np.testing.assert_array_equal(restarted.positions, [[2.5, 0.5, 0.5], [2.5, 1, 1], [4, 1, 1]])
+        # a moved atom may now reach other atoms, so the system is split again
+        self.assertIsNone(warm_start.clusters(restarted))
+
+        untouched = self.indexed_system(sent, [True, True, False], [[0, 1], [1, 2]])
+        self.assertEqual([len(cluster) for cluster in warm_start.clusters(untouched)], [3])
+        self.assertEqual(warm_start.resume(untouched), 3)
+        self.assertEqual([len(cluster) for cluster in warm_start.clusters(untouched)], [3])
+
+    def test_clusters_need_same_atoms(self):
+        system = self.indexed_system([[0, 0, 0], [1.5, 0, 0]], [True, False], [[0, 1]])
+        warm_start = WarmStart(7)
+        warm_start.add(system, system.positions, system.positions)
+        self.assertIsNone(warm_start.clusters(self.indexed_system([[0, 0, 0], [1.5, 0, 0]], [True, True], [[0, 1]])))
+        self.assertIsNone(warm_start.clusters(self.indexed_system([[0, 0, 0]], [True], [])))
+        self.assertEqual(warm_start.resume(build_system([[0, 0, 0]], [True], [])), 0)
@@ -0,0 +1,67 @@
+import os
+import pstats
+import tempfile
+import tracemalloc
+import unittest
+
+from plugin.streaming import FlowControl
+from plugin.telemetry import MetricsStore, ProfileCapture, RunTelemetry
+
+
+class RunTelemetryTestCase(unittest.TestCase):
+
+    def test_summary(self):
+        telemetry = RunTelemetry()
+        telemetry.mark('atoms_saved')
+        telemetry.mark('stream_created')
+        telemetry.mark('first_frame_received')
+        flow_control = FlowControl(target_rate=10)
+        for depth in [3, 1]:
+            telemetry.on_sent(depth)
+        telemetry.on_acked(0.1)
+        telemetry.on_acked(0.3)
+
+        summary = telemetry.summary([], flow_control)
+        self.assertEqual(summary['frames_sent'], 2)
+        self.assertEqual((summary['queue_depth_max'], summary['queue_depth_mean']), (3, 2))
+        self.assertAlmostEqual(summary['round_trip_mean'], 0.2)
+        self.assertAlmostEqual(summary['round_trip_max'], 0.3)
+        self.assertGreaterEqual(summary['stream_creation_seconds'], 0)
+        # nothing was spawned
+        self.assertIsNone(summary['compute_seconds'])
+        self.assertEqual([depth for _, depth in telemetry.queue_depths], [3, 1])
+        # memory peaks cover the whole process, and are named so
+        self.assertNotIn('peak_memory_bytes', summary)
+        self.assertIn('lifetime_peak_memory_bytes', summary)
+
+    def test_marks_keep_first_time(self):
+        telemetry = RunTelemetry(requested_at=0.0)
+        telemetry.mark('atoms_saved')
+        first = telemetry.marks['atoms_saved']
+        telemetry.mark('atoms_saved')
+        self.assertEqual(telemetry.marks['atoms_saved'], first)
+        self.assertEqual(telemetry.summary([], FlowControl())['workspace_fetch_seconds'], telemetry.started_at)
+
+
+class MetricsStoreTestCase(unittest.TestCase):
+
+    def test_keeps_latest_runs(self):
+        store = MetricsStore(max_runs=2)
+        for seconds in [1.0, 2.0, None, 4.0]:
+            store.add({'total_seconds': seconds})
+        self.assertEqual(len(store), 2)
+        self.assertEqual(store.stats('total_seconds'), {'count': 1, 'mean': 4.0, 'min': 4.0, 'max': 4.0})
+        self.assertIsNone(store.stats('missing'))
+
+
+class ProfileCaptureTestCase(unittest.TestCase):
+
+    def test_writes_profile_and_snapshot(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            capture = ProfileCapture(os.path.join(temp_dir, 'profiles'))
+            capture.start()
+            sorted(range(1000), key=lambda i: -i)
+            profile_path, snapshot_path = capture.stop()
+            self.assertFalse(tracemalloc.is_tracing())
+            self.assertGreater(pstats.Stats(profile_path).total_calls, 0)
+            tracemalloc.Snapshot.load(snapshot_path)